@@ -66,7 +66,17 @@ if strtobool(os.environ.get("SYNAPSE_ASYNC_IO_REACTOR", "0")):
 
     from twisted.internet import asyncioreactor
 
-    asyncioreactor.install(asyncio.get_event_loop())
+    # Run the asyncio reactor on uvloop when it is installed: its libuv-based
+    # loop has much lower per-callback overhead than the stock selector loop.
+    try:
+        import uvloop
+    except ImportError:
+        loop = asyncio.get_event_loop()
+    else:
+        loop = uvloop.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+    asyncioreactor.install(loop)
 
 # Twisted and canonicaljson will fail to import when this file is executed to
 # get the __version__ during a fresh install. That's OK and subsequent calls to
@@ -21,10 +21,54 @@ Matrix Synapse 消息API
 
 import json
 import logging
-from typing import Dict, Any, Optional, List
+from typing import TYPE_CHECKING, Dict, Any, Optional, List, Tuple
+
+from synapse._pydantic_compat import HAS_PYDANTIC_V2
+from synapse.api.errors import SynapseError
+from synapse.http.servlet import validate_json_object
+from synapse.metrics.background_process_metrics import run_as_background_process
+from synapse.rest.models import RequestBodyModel
+from synapse.util.caches.expiringcache import ExpiringCache
+
+if TYPE_CHECKING or HAS_PYDANTIC_V2:
+    from pydantic.v1 import Extra, StrictBool, StrictInt, StrictStr
+else:
+    from pydantic import Extra, StrictBool, StrictInt, StrictStr
 
 logger = logging.getLogger(__name__)
 
+# 输入状态和已读回执的合并写入间隔（毫秒）
+EPHEMERAL_FLUSH_INTERVAL_MS = 100
+
+# 启用Redis时，最新值已由Redis提供，数据库只需定期持久化已读回执（毫秒）
+REDIS_RECEIPT_PERSIST_INTERVAL_MS = 5000
+
+# Redis中已读回执哈希的有效期（秒），每次写入时刷新；数据库仍保存完整回执
+REDIS_RECEIPT_TTL_S = 24 * 60 * 60
+
+# 无效访问令牌的负缓存大小和有效期（毫秒）
+BAD_TOKEN_CACHE_SIZE = 4096
+BAD_TOKEN_CACHE_EXPIRY_MS = 60 * 1000
+
+
+class RoomMessageBody(RequestBodyModel):
+    """m.room.message 事件内容，未声明的字段原样保留"""
+
+    class Config:
+        extra = Extra.allow
+
+    msgtype: StrictStr
+    body: StrictStr
+
+
+class RedactEventBody(RequestBodyModel):
+    reason: Optional[StrictStr] = None
+
+
+class TypingBody(RequestBodyModel):
+    typing: StrictBool = False
+    timeout: StrictInt = 30000  # 默认30秒
+
 
 class MessageAPI:
     """
@@ -39,7 +83,159 @@ class MessageAPI:
         self.room_handler = hs.get_room_handler()
         self.message_handler = hs.get_message_handler()
         self.clock = hs.get_clock()
+
+        # 最近校验失败的访问令牌。扫描器和失效客户端会反复使用同一个无效
+        # 令牌，缓存否定结果可以避免每次请求都查询数据库。新签发的令牌是
+        # 随机生成的，不会与这里的条目冲突，因此无需在登录时清理。
+        self._bad_token_cache: ExpiringCache[str, bool] = ExpiringCache(
+            cache_name="message_api_bad_tokens",
+            clock=self.clock,
+            max_len=BAD_TOKEN_CACHE_SIZE,
+            expiry_ms=BAD_TOKEN_CACHE_EXPIRY_MS,
+        )
+
+        # 待写入的输入状态和已读回执。客户端发送频率很高，而后端只关心每个
+        # (用户, 房间) 的最新值，因此先在内存中合并，再由后台任务批量写入。
+        # (user_id, room_id) -> (typing, timeout, queued_at_ms)
+        self._typing_pending: Dict[Tuple[str, str], Tuple[bool, int, int]] = {}
+        # (user_id, room_id, receipt_type) -> event_id
+        self._receipt_pending: Dict[Tuple[str, str, str], str] = {}
+
+        # 启用Redis时，输入状态和已读回执额外发布到房间频道以便及时推送。
+        # 读取方仍以数据库为准，因此两者都照常排队写入；已读回执的最新值
+        # 可从Redis获取，数据库只需定期持久化
+        if hasattr(hs, 'get_redis_client') and hs.config.redis.redis_enabled:
+            self._redis_client = hs.get_redis_client()
+            self._use_redis_ephemeral = True
+            receipt_flush_interval_ms = REDIS_RECEIPT_PERSIST_INTERVAL_MS
+        else:
+            self._use_redis_ephemeral = False
+            receipt_flush_interval_ms = EPHEMERAL_FLUSH_INTERVAL_MS
+
+        self.clock.looping_call(
+            run_as_background_process,
+            EPHEMERAL_FLUSH_INTERVAL_MS,
+            "message_api.flush_typing",
+            self._flush_typing,
+        )
+        self.clock.looping_call(
+            run_as_background_process,
+            receipt_flush_interval_ms,
+            "message_api.flush_receipts",
+            self._flush_receipts,
+        )
+
+    async def _validate_access_token(
+        self, access_token: str
+    ) -> Optional[Dict[str, Any]]:
+        """
+        验证访问令牌，已知无效的令牌直接返回 None 而不查询数据库
+        
+        Args:
+            access_token: 访问令牌
+            
+        Returns:
+            用户信息，令牌无效时返回 None
+        """
+        if self._bad_token_cache.get(access_token):
+            return None
+            
+        user_info = await self.auth_handler.get_user_by_access_token(access_token)
+        if not user_info:
+            self._bad_token_cache[access_token] = True
+            
+        return user_info
+        
+    async def _set_typing_redis(self, user_id: str, room_id: str,
+                                typing: bool, timeout: int) -> None:
+        """
+        将输入状态写入Redis并发布到房间频道
         
+        失败只记录日志，输入状态仍会经由数据库路径写入
+        """
+        try:
+            pipeline = self._redis_client.pipeline()
+            pipeline.setex(
+                f"typing:{room_id}:{user_id}",
+                max(1, timeout // 1000),
+                "1" if typing else "0",
+            )
+            pipeline.publish(
+                f"typing:{room_id}",
+                json.dumps({'user_id': user_id, 'typing': typing}),
+            )
+            await pipeline.execute()
+        except Exception as e:
+            logger.error(
+                "Redis typing update failed for %s in %s: %s", user_id, room_id, e
+            )
+            
+    async def _set_receipt_redis(self, user_id: str, room_id: str,
+                                 event_id: str, receipt_type: str) -> None:
+        """
+        将已读回执写入Redis并发布到房间频道
+        
+        失败只记录日志，回执仍会经由数据库路径持久化
+        """
+        key = f"receipt:{room_id}:{receipt_type}"
+        try:
+            pipeline = self._redis_client.pipeline()
+            pipeline.hset(key, user_id, event_id)
+            pipeline.expire(key, REDIS_RECEIPT_TTL_S)
+            pipeline.publish(
+                f"receipt:{room_id}",
+                json.dumps({
+                    'user_id': user_id,
+                    'event_id': event_id,
+                    'receipt_type': receipt_type,
+                }),
+            )
+            await pipeline.execute()
+        except Exception as e:
+            logger.error(
+                "Redis receipt update failed for %s in %s: %s", user_id, room_id, e
+            )
+            
+    async def _flush_typing(self) -> None:
+        """将合并后的输入状态批量写入存储"""
+        if self._typing_pending:
+            typing_batch, self._typing_pending = self._typing_pending, {}
+            try:
+                await self.message_handler.set_typing_state_bulk(
+                    [
+                        (user_id, room_id, typing, timeout)
+                        for (user_id, room_id), (typing, timeout, _)
+                        in typing_batch.items()
+                    ]
+                )
+            except Exception:
+                logger.exception("Failed to flush %d typing updates", len(typing_batch))
+                # 重新排队，但不覆盖在此期间到达的更新值；已超时的输入状态
+                # 即使写入也会立即失效，直接丢弃
+                now = self.clock.time_msec()
+                for key, value in typing_batch.items():
+                    typing, timeout, queued_at_ms = value
+                    if typing and queued_at_ms + timeout <= now:
+                        continue
+                    self._typing_pending.setdefault(key, value)
+
+    async def _flush_receipts(self) -> None:
+        """将合并后的已读回执批量写入存储"""
+        if self._receipt_pending:
+            receipt_batch, self._receipt_pending = self._receipt_pending, {}
+            try:
+                await self.message_handler.set_receipt_bulk(
+                    [
+                        (user_id, room_id, event_id, receipt_type)
+                        for (user_id, room_id, receipt_type), event_id
+                        in receipt_batch.items()
+                    ]
+                )
+            except Exception:
+                logger.exception("Failed to flush %d receipts", len(receipt_batch))
+                for key, value in receipt_batch.items():
+                    self._receipt_pending.setdefault(key, value)
+
     async def handle_send_message(self, access_token: str, room_id: str,
                                 event_type: str, txn_id: str,
                                 request_data: Dict[str, Any]) -> Dict[str, Any]:
@@ -62,7 +258,7 @@ class MessageAPI:
         
         try:
             # 验证访问令牌
-            user_info = await self.auth_handler.get_user_by_access_token(access_token)
+            user_info = await self._validate_access_token(access_token)
             if not user_info:
                 return {
                     'errcode': 'M_UNKNOWN_TOKEN',
@@ -79,6 +275,10 @@ class MessageAPI:
                     'error': 'User not in room'
                 }, 403
                 
+            # 校验消息内容格式
+            if event_type == 'm.room.message':
+                validate_json_object(request_data, RoomMessageBody)
+                
             # 检查是否为重复事务
             existing_event = await self.message_handler.get_event_by_txn_id(
                 user_id, txn_id
@@ -103,18 +303,9 @@ class MessageAPI:
                 'event_id': event_id
             }, 200
             
-        except ValueError as e:
+        except SynapseError as e:
             logger.warning(f"Send message failed: {e}")
-            return {
-                'errcode': 'M_INVALID_PARAM',
-                'error': str(e)
-            }, 400
-        except Exception as e:
-            logger.error(f"Send message error: {e}")
-            return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
+            return e.error_dict(None), e.code
             
     async def handle_get_messages(self, access_token: str, room_id: str,
                                 from_token: Optional[str] = None,
@@ -143,7 +334,7 @@ class MessageAPI:
         
         try:
             # 验证访问令牌
-            user_info = await self.auth_handler.get_user_by_access_token(access_token)
+            user_info = await self._validate_access_token(access_token)
             if not user_info:
                 return {
                     'errcode': 'M_UNKNOWN_TOKEN',
@@ -177,18 +368,9 @@ class MessageAPI:
                 'state': messages_data.get('state', [])
             }, 200
             
-        except ValueError as e:
+        except SynapseError as e:
             logger.warning(f"Get messages failed: {e}")
-            return {
-                'errcode': 'M_NOT_FOUND',
-                'error': str(e)
-            }, 404
-        except Exception as e:
-            logger.error(f"Get messages error: {e}")
-            return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
+            return e.error_dict(None), e.code
             
     async def handle_get_event(self, access_token: str, room_id: str,
                              event_id: str) -> Dict[str, Any]:
@@ -209,7 +391,7 @@ class MessageAPI:
         
         try:
             # 验证访问令牌
-            user_info = await self.auth_handler.get_user_by_access_token(access_token)
+            user_info = await self._validate_access_token(access_token)
             if not user_info:
                 return {
                     'errcode': 'M_UNKNOWN_TOKEN',
@@ -237,18 +419,9 @@ class MessageAPI:
                 
             return event, 200
             
-        except ValueError as e:
+        except SynapseError as e:
             logger.warning(f"Get event failed: {e}")
-            return {
-                'errcode': 'M_NOT_FOUND',
-                'error': str(e)
-            }, 404
-        except Exception as e:
-            logger.error(f"Get event error: {e}")
-            return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
+            return e.error_dict(None), e.code
             
     async def handle_get_event_context(self, access_token: str, room_id: str,
                                      event_id: str, limit: int = 10) -> Dict[str, Any]:
@@ -270,7 +443,7 @@ class MessageAPI:
         
         try:
             # 验证访问令牌
-            user_info = await self.auth_handler.get_user_by_access_token(access_token)
+            user_info = await self._validate_access_token(access_token)
             if not user_info:
                 return {
                     'errcode': 'M_UNKNOWN_TOKEN',
@@ -309,18 +482,9 @@ class MessageAPI:
                 'state': context['state']
             }, 200
             
-        except ValueError as e:
+        except SynapseError as e:
             logger.warning(f"Get event context failed: {e}")
-            return {
-                'errcode': 'M_NOT_FOUND',
-                'error': str(e)
-            }, 404
-        except Exception as e:
-            logger.error(f"Get event context error: {e}")
-            return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
+            return e.error_dict(None), e.code
             
     async def handle_redact_event(self, access_token: str, room_id: str,
                                 event_id: str, txn_id: str,
@@ -344,7 +508,7 @@ class MessageAPI:
         
         try:
             # 验证访问令牌
-            user_info = await self.auth_handler.get_user_by_access_token(access_token)
+            user_info = await self._validate_access_token(access_token)
             if not user_info:
                 return {
                     'errcode': 'M_UNKNOWN_TOKEN',
@@ -395,7 +559,10 @@ class MessageAPI:
                 }, 403
                 
             # 删除事件
-            reason = request_data.get('reason') if request_data else None
+            reason = (
+                validate_json_object(request_data, RedactEventBody).reason
+                if request_data else None
+            )
             redaction_event_id = await self.message_handler.redact_event(
                 redacter_id=user_id,
                 room_id=room_id,
@@ -410,18 +577,9 @@ class MessageAPI:
                 'event_id': redaction_event_id
             }, 200
             
-        except ValueError as e:
+        except SynapseError as e:
             logger.warning(f"Redact event failed: {e}")
-            return {
-                'errcode': 'M_NOT_FOUND',
-                'error': str(e)
-            }, 404
-        except Exception as e:
-            logger.error(f"Redact event error: {e}")
-            return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
+            return e.error_dict(None), e.code
             
     async def handle_send_reaction(self, access_token: str, room_id: str,
                                  event_id: str, reaction: str,
@@ -445,7 +603,7 @@ class MessageAPI:
         
         try:
             # 验证访问令牌
-            user_info = await self.auth_handler.get_user_by_access_token(access_token)
+            user_info = await self._validate_access_token(access_token)
             if not user_info:
                 return {
                     'errcode': 'M_UNKNOWN_TOKEN',
@@ -485,18 +643,9 @@ class MessageAPI:
                 'event_id': reaction_event_id
             }, 200
             
-        except ValueError as e:
+        except SynapseError as e:
             logger.warning(f"Send reaction failed: {e}")
-            return {
-                'errcode': 'M_INVALID_PARAM',
-                'error': str(e)
-            }, 400
-        except Exception as e:
-            logger.error(f"Send reaction error: {e}")
-            return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
+            return e.error_dict(None), e.code
             
     async def handle_edit_message(self, access_token: str, room_id: str,
                                 event_id: str, new_content: Dict[str, Any],
@@ -520,7 +669,7 @@ class MessageAPI:
         
         try:
             # 验证访问令牌
-            user_info = await self.auth_handler.get_user_by_access_token(access_token)
+            user_info = await self._validate_access_token(access_token)
             if not user_info:
                 return {
                     'errcode': 'M_UNKNOWN_TOKEN',
@@ -537,6 +686,9 @@ class MessageAPI:
                     'error': 'User not in room'
                 }, 403
                 
+            # 校验新内容格式
+            validate_json_object(new_content, RoomMessageBody)
+                
             # 检查原始事件是否存在且属于该用户
             original_event = await self.message_handler.get_event(event_id, room_id)
             if not original_event:
@@ -566,18 +718,9 @@ class MessageAPI:
                 'event_id': edit_event_id
             }, 200
             
-        except ValueError as e:
+        except SynapseError as e:
             logger.warning(f"Edit message failed: {e}")
-            return {
-                'errcode': 'M_INVALID_PARAM',
-                'error': str(e)
-            }, 400
-        except Exception as e:
-            logger.error(f"Edit message error: {e}")
-            return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
+            return e.error_dict(None), e.code
             
     async def handle_typing(self, access_token: str, room_id: str,
                           request_data: Dict[str, Any]) -> Dict[str, Any]:
@@ -598,7 +741,7 @@ class MessageAPI:
         
         try:
             # 验证访问令牌
-            user_info = await self.auth_handler.get_user_by_access_token(access_token)
+            user_info = await self._validate_access_token(access_token)
             if not user_info:
                 return {
                     'errcode': 'M_UNKNOWN_TOKEN',
@@ -616,24 +759,23 @@ class MessageAPI:
                 }, 403
                 
             # 设置输入状态
-            typing = request_data.get('typing', False)
-            timeout = request_data.get('timeout', 30000)  # 默认30秒
+            body = validate_json_object(request_data, TypingBody)
+            typing = body.typing
+            timeout = body.timeout
             
-            await self.message_handler.set_typing_state(
-                user_id=user_id,
-                room_id=room_id,
-                typing=typing,
-                timeout=timeout
+            if self._use_redis_ephemeral:
+                await self._set_typing_redis(user_id, room_id, typing, timeout)
+                
+            # 只记录最新值，由后台任务批量写入
+            self._typing_pending[(user_id, room_id)] = (
+                typing, timeout, self.clock.time_msec()
             )
             
             return {}, 200
             
-        except Exception as e:
-            logger.error(f"Typing error: {e}")
-            return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
+        except SynapseError as e:
+            logger.warning(f"Typing failed: {e}")
+            return e.error_dict(None), e.code
             
     async def handle_receipt(self, access_token: str, room_id: str,
                            event_id: str, receipt_type: str = 'm.read') -> Dict[str, Any]:
@@ -655,7 +797,7 @@ class MessageAPI:
         
         try:
             # 验证访问令牌
-            user_info = await self.auth_handler.get_user_by_access_token(access_token)
+            user_info = await self._validate_access_token(access_token)
             if not user_info:
                 return {
                     'errcode': 'M_UNKNOWN_TOKEN',
@@ -673,18 +815,14 @@ class MessageAPI:
                 }, 403
                 
             # 设置已读回执
-            await self.message_handler.set_receipt(
-                user_id=user_id,
-                room_id=room_id,
-                event_id=event_id,
-                receipt_type=receipt_type
-            )
+            if self._use_redis_ephemeral:
+                await self._set_receipt_redis(user_id, room_id, event_id, receipt_type)
+                
+            # 只记录最新值，由后台任务批量写入
+            self._receipt_pending[(user_id, room_id, receipt_type)] = event_id
             
             return {}, 200
             
-        except Exception as e:
-            logger.error(f"Receipt error: {e}")
-            return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
\ No newline at end of file
+        except SynapseError as e:
+            logger.warning(f"Receipt failed: {e}")
+            return e.error_dict(None), e.code
\ No newline at end of file
@@ -19,12 +19,226 @@ Matrix Synapse 房间API
 这个模块实现了Matrix协议的房间相关API端点。
 """
 
-import json
+import functools
+import inspect
 import logging
-from typing import Dict, Any, Optional, List
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Type,
+)
+
+import ujson
+from immutabledict import immutabledict
+
+from synapse.logging.context import make_deferred_yieldable, run_in_background
+from synapse.util import unwrapFirstError
+from synapse.util.async_helpers import gather_results, yieldable_gather_results
+from synapse.util.caches.lrucache import LruCache
+from synapse.util.frozenutils import freeze
+
+if TYPE_CHECKING:
+    from twisted.internet import defer
 
 logger = logging.getLogger(__name__)
 
+# 权限等级检查结果的缓存有效期（秒）和容量
+POWER_CACHE_TTL_SECONDS = 10
+POWER_CACHE_SIZE = 10000
+
+# 房间状态与成员列表响应的缓存容量，条目以房间当前的状态组ID作为校验标记
+ROOM_STATE_CACHE_SIZE = 5000
+
+# 编码后成员列表缓存的总字节数，以及可缓存的单个响应最大字节数
+ROOM_MEMBERS_CACHE_MAX_BYTES = 64 * 1024 * 1024
+ROOM_MEMBERS_CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+
+# 已加入房间响应的缓存容量，按 (用户ID, 成员关系版本) 缓存编码后的响应体
+JOINED_ROOMS_CACHE_SIZE = 10000
+
+
+def _encode(json_object: Any) -> bytes:
+    """将响应体编码为 JSON 字节串，可直接交给 respond_with_json_bytes 输出"""
+    return ujson.dumps(json_object, ensure_ascii=False,
+                       escape_forward_slashes=False).encode('utf-8')
+
+
+def _err(errcode: str, error: str, status: int) -> Tuple[Dict[str, Any], int]:
+    """构造错误响应"""
+    return {'errcode': errcode, 'error': error}, status
+
+
+def _frozen_err(errcode: str, error: str,
+                status: int) -> Tuple[immutabledict, int]:
+    """构造可复用的不可变错误响应，避免在常见失败路径上反复分配字典"""
+    return immutabledict({'errcode': errcode, 'error': error}), status
+
+
+_ERR_UNKNOWN_TOKEN = _frozen_err('M_UNKNOWN_TOKEN', 'Invalid access token', 401)
+_ERR_NOT_IN_ROOM = _frozen_err('M_FORBIDDEN', 'User not in room', 403)
+_ERR_INSUFFICIENT_POWER = _frozen_err('M_FORBIDDEN', 'Insufficient power level', 403)
+_ERR_MISSING_USER_ID = _frozen_err('M_MISSING_PARAM', 'Missing user_id', 400)
+_ERR_NOT_FOUND_STATE = _frozen_err('M_NOT_FOUND', 'State not found', 404)
+_ERR_INTERNAL = _frozen_err('M_UNKNOWN', 'Internal server error', 500)
+
+
+# 处理器抛出的异常到 (errcode, HTTP状态码) 的映射，由 authenticated 统一处理
+_EXC_MAP: Dict[Type[Exception], Tuple[str, int]] = {
+    ValueError: ('M_NOT_FOUND', 404),
+    PermissionError: ('M_FORBIDDEN', 403),
+}
+_MAPPED_EXCEPTIONS = tuple(_EXC_MAP)
+
+
+def _map_exception(e: Exception, invalid_param: bool) -> Tuple[str, int]:
+    """查找异常对应的 (errcode, HTTP状态码)，子类沿 MRO 匹配"""
+    if invalid_param and isinstance(e, ValueError):
+        return 'M_INVALID_PARAM', 400
+    for cls in type(e).__mro__:
+        if cls in _EXC_MAP:
+            return _EXC_MAP[cls]
+    raise AssertionError(f"Unmapped exception type {type(e)}")
+
+
+def _discard(pending: Optional["defer.Deferred[Any]"]) -> None:
+    """丢弃投机执行的结果，同时吞掉其可能产生的异常"""
+    if pending is not None:
+        pending.addErrback(lambda _: None)
+
+
+def authenticated(
+    *,
+    membership: bool = False,
+    power_level: Optional[int] = None,
+    invalid_param: bool = False,
+    speculative: bool = False,
+) -> Callable[[Callable[..., Awaitable[Any]]], Callable[..., Awaitable[Any]]]:
+    """
+    处理器装饰器：统一完成访问令牌校验、房间成员/权限检查和异常映射
+    
+    被装饰的方法对外以 ``access_token`` 作为第一个参数调用；方法本身通过
+    关键字参数 ``user_id`` 接收已校验的用户ID。需要检查成员身份或权限等级时，
+    房间ID取自 ``room_id`` 参数，两项检查并发执行。
+    
+    被装饰的方法还提供 ``call_as_user(self, user_id, ...)``，用于在令牌已经
+    校验过的情况下（例如批量接口）直接调用。
+    
+    Args:
+        membership: 是否要求用户在房间中
+        power_level: 要求的最低权限等级，None 表示不检查
+        invalid_param: 为 True 时 ValueError 映射为 400 M_INVALID_PARAM，
+            否则按 _EXC_MAP 映射为 404 M_NOT_FOUND
+        speculative: 为 True 时方法与成员/权限检查并发执行，检查不通过则丢弃
+            其结果。仅适用于没有副作用的只读方法。
+    """
+    def decorator(
+        fn: Callable[..., Awaitable[Any]]
+    ) -> Callable[..., Awaitable[Any]]:
+        signature = inspect.signature(fn)
+        
+        async def invoke(self: "RoomAPI", access_token: Optional[str],
+                         user_id: Optional[str], args: Tuple[Any, ...],
+                         kwargs: Dict[str, Any]) -> Any:
+            try:
+                if user_id is None:
+                    # 验证访问令牌
+                    user_info = await self.auth_handler.get_user_by_access_token(access_token)
+                    if not user_info:
+                        return _ERR_UNKNOWN_TOKEN
+                        
+                    user_id = user_info['user_id']
+                
+                if membership or power_level is not None:
+                    room_id = signature.bind_partial(
+                        self, *args, **kwargs
+                    ).arguments['room_id']
+                    
+                    pending = None
+                    if speculative:
+                        # 只读查询与检查访问的是不同的数据，提前发出以重叠两次
+                        # 数据库往返
+                        pending = run_in_background(
+                            fn, self, *args, user_id=user_id, **kwargs
+                        )
+                    
+                    try:
+                        # 成员检查和权限检查互不依赖，并发执行
+                        is_member, has_permission = await make_deferred_yieldable(
+                            gather_results(
+                                (
+                                    run_in_background(
+                                        self._check_membership,
+                                        membership, user_id, room_id,
+                                    ),
+                                    run_in_background(
+                                        self._check_power_level,
+                                        power_level, user_id, room_id,
+                                    ),
+                                ),
+                                consumeErrors=True,
+                            ).addErrback(unwrapFirstError)
+                        )
+                    except Exception:
+                        _discard(pending)
+                        raise
+                    
+                    if not is_member:
+                        _discard(pending)
+                        return _ERR_NOT_IN_ROOM
+                        
+                    if not has_permission:
+                        _discard(pending)
+                        return _ERR_INSUFFICIENT_POWER
+                        
+                    if pending is not None:
+                        return await make_deferred_yieldable(pending)
+                        
+                return await fn(self, *args, user_id=user_id, **kwargs)
+                
+            except _MAPPED_EXCEPTIONS as e:
+                logger.warning("%s failed: %s", fn.__name__, e)
+                errcode, status = _map_exception(e, invalid_param)
+                return _err(errcode, str(e), status)
+            except Exception:
+                logger.exception("%s error", fn.__name__)
+                return _ERR_INTERNAL
+                
+        @functools.wraps(fn)
+        async def wrapper(self: "RoomAPI", access_token: str,
+                          *args: Any, **kwargs: Any) -> Any:
+            return await invoke(self, access_token, None, args, kwargs)
+            
+        async def call_as_user(self: "RoomAPI", user_id: str,
+                               *args: Any, **kwargs: Any) -> Any:
+            """以已校验的用户身份调用处理器，跳过令牌校验（供批量接口使用）"""
+            return await invoke(self, None, user_id, args, kwargs)
+            
+        wrapper.call_as_user = call_as_user  # type: ignore[attr-defined]
+        wrapper.signature = signature  # type: ignore[attr-defined]
+        wrapper.invalid_param = invalid_param  # type: ignore[attr-defined]
+        return wrapper
+        
+    return decorator
+
+
+def _batch_response(response: Tuple[Any, int]) -> Dict[str, Any]:
+    """将处理器返回的 (body, status) 转换为批量响应中的一项"""
+    body, status = response
+    if isinstance(body, bytes):
+        # 预编码的响应体需要还原后才能嵌入批量响应
+        body = ujson.loads(body)
+    return {'status': status, 'body': body}
+
+
+async def _run_task(task: Callable[[], Awaitable[None]]) -> None:
+    await task()
+
 
 class RoomAPI:
     """
@@ -39,9 +253,87 @@ class RoomAPI:
         self.room_handler = hs.get_room_handler()
         self.message_handler = hs.get_message_handler()
         self.clock = hs.get_clock()
+
+        # (用户ID, 房间ID, 所需等级) -> (过期时间, 房间权限版本, 是否满足)。
+        # 通过本 API 修改 m.room.power_levels 时推进房间的权限版本，使该房间
+        # 的全部缓存条目立即失效。
+        self._power_cache: LruCache[
+            Tuple[str, str, int], Tuple[float, int, bool]
+        ] = LruCache(
+            max_size=POWER_CACHE_SIZE,
+            cache_name="room_api_power_levels",
+        )
+        self._power_versions: Dict[str, int] = {}
+
+        # 房间状态变化时状态组ID随之改变，因此缓存条目只在状态组ID一致时
+        # 才会被使用，不会返回过期的状态。缓存的状态是冻结的不可变对象，
+        # 可以安全地返回给多个调用方。
+        # (房间ID, 事件类型, 状态键) -> (状态组ID, 状态)
+        self._state_cache: LruCache[
+            Tuple[str, Optional[str], Optional[str]], Tuple[int, Any]
+        ] = LruCache(
+            max_size=ROOM_STATE_CACHE_SIZE,
+            cache_name="room_api_state",
+        )
+        # (房间ID, 成员状态过滤, 排除成员状态) -> (状态组ID, 编码后的成员响应)，
+        # 按响应体字节数计算容量
+        self._members_cache: LruCache[
+            Tuple[str, Optional[str], Optional[str]], Tuple[int, bytes]
+        ] = LruCache(
+            max_size=ROOM_MEMBERS_CACHE_MAX_BYTES,
+            cache_name="room_api_members",
+            size_callback=lambda entry: len(entry[1]),
+        )
+
+        # (用户ID, 成员关系版本) -> 编码后的已加入房间响应。成员关系变化会推进
+        # 版本号，旧条目自然失效并由 LRU 淘汰。
+        self._joined_rooms_cache: LruCache[Tuple[str, int], bytes] = LruCache(
+            max_size=JOINED_ROOMS_CACHE_SIZE,
+            cache_name="room_api_joined_rooms",
+        )
+        
+    async def _check_membership(self, required: bool, user_id: str,
+                                room_id: str) -> bool:
+        """检查用户是否在房间中；不要求时直接通过"""
+        if not required:
+            return True
+        return await self.room_handler.is_user_in_room(user_id, room_id)
+        
+    async def _check_power_level(self, required_level: Optional[int],
+                                 user_id: str, room_id: str) -> bool:
+        """检查用户权限等级；不要求时直接通过，否则优先使用短期缓存的结果"""
+        if required_level is None:
+            return True
+            
+        key = (user_id, room_id, required_level)
+        now = self.clock.time()
+        version = self._power_versions.get(room_id, 0)
+        
+        cached = self._power_cache.get(key)
+        if cached is not None:
+            expiry, cached_version, allowed = cached
+            if expiry > now and cached_version == version:
+                return allowed
+            self._power_cache.pop(key)
+            
+        allowed = await self.room_handler.check_user_power_level(
+            user_id=user_id,
+            room_id=room_id,
+            required_level=required_level
+        )
+        self._power_cache.set(
+            key, (now + POWER_CACHE_TTL_SECONDS, version, allowed)
+        )
         
-    async def handle_create_room(self, access_token: str, 
-                               request_data: Dict[str, Any]) -> Dict[str, Any]:
+        return allowed
+        
+    def _invalidate_power_levels(self, room_id: str) -> None:
+        """推进房间的权限版本，使该房间所有缓存的权限检查结果失效"""
+        self._power_versions[room_id] = self._power_versions.get(room_id, 0) + 1
+        
+    @authenticated(invalid_param=True)
+    async def handle_create_room(self, request_data: Dict[str, Any],
+                                 *, user_id: str) -> Dict[str, Any]:
         """
         处理创建房间请求
         
@@ -49,6 +341,7 @@ class RoomAPI:
         
         Args:
             access_token: 访问令牌
+            user_id: 已校验的用户ID（由装饰器传入）
             request_data: 请求数据
             
         Returns:
@@ -56,60 +349,38 @@ class RoomAPI:
         """
         logger.info("Processing create room request")
         
-        try:
-            # 验证访问令牌
-            user_info = await self.auth_handler.get_user_by_access_token(access_token)
-            if not user_info:
-                return {
-                    'errcode': 'M_UNKNOWN_TOKEN',
-                    'error': 'Invalid access token'
-                }, 401
-                
-            user_id = user_info['user_id']
-            
-            # 解析房间创建参数
-            room_alias_name = request_data.get('room_alias_name')
-            name = request_data.get('name')
-            topic = request_data.get('topic')
-            invite = request_data.get('invite', [])
-            preset = request_data.get('preset', 'private_chat')
-            is_direct = request_data.get('is_direct', False)
-            visibility = request_data.get('visibility', 'private')
-            
-            # 创建房间
-            room_info = await self.room_handler.create_room(
-                creator_id=user_id,
-                room_alias_name=room_alias_name,
-                name=name,
-                topic=topic,
-                invite_list=invite,
-                preset=preset,
-                is_direct=is_direct,
-                visibility=visibility
-            )
-            
-            logger.info(f"Room created successfully: {room_info['room_id']}")
-            
-            return {
-                'room_id': room_info['room_id'],
-                'room_alias': room_info.get('room_alias')
-            }, 200
-            
-        except ValueError as e:
-            logger.warning(f"Create room failed: {e}")
-            return {
-                'errcode': 'M_INVALID_PARAM',
-                'error': str(e)
-            }, 400
-        except Exception as e:
-            logger.error(f"Create room error: {e}")
-            return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
-            
-    async def handle_join_room(self, access_token: str, room_id: str,
-                             request_data: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        # 解析房间创建参数
+        room_alias_name = request_data.get('room_alias_name')
+        name = request_data.get('name')
+        topic = request_data.get('topic')
+        invite = request_data.get('invite', [])
+        preset = request_data.get('preset', 'private_chat')
+        is_direct = request_data.get('is_direct', False)
+        visibility = request_data.get('visibility', 'private')
+        
+        # 创建房间
+        room_info = await self.room_handler.create_room(
+            creator_id=user_id,
+            room_alias_name=room_alias_name,
+            name=name,
+            topic=topic,
+            invite_list=invite,
+            preset=preset,
+            is_direct=is_direct,
+            visibility=visibility
+        )
+        
+        logger.info("Room created successfully: %s", room_info['room_id'])
+        
+        return {
+            'room_id': room_info['room_id'],
+            'room_alias': room_info.get('room_alias')
+        }, 200
+        
+    @authenticated()
+    async def handle_join_room(self, room_id: str,
+                             request_data: Optional[Dict[str, Any]] = None,
+                             *, user_id: str) -> Dict[str, Any]:
         """
         处理加入房间请求
         
@@ -118,57 +389,35 @@ class RoomAPI:
         
         Args:
             access_token: 访问令牌
+            user_id: 已校验的用户ID（由装饰器传入）
             room_id: 房间ID或别名
             request_data: 请求数据
             
         Returns:
             加入房间响应
         """
-        logger.info(f"Processing join room request: {room_id}")
+        logger.info("Processing join room request: %s", room_id)
         
-        try:
-            # 验证访问令牌
-            user_info = await self.auth_handler.get_user_by_access_token(access_token)
-            if not user_info:
-                return {
-                    'errcode': 'M_UNKNOWN_TOKEN',
-                    'error': 'Invalid access token'
-                }, 401
-                
-            user_id = user_info['user_id']
-            
-            # 加入房间
-            result = await self.room_handler.join_room(
-                user_id=user_id,
-                room_id=room_id
-            )
-            
-            if result['success']:
-                logger.info(f"User {user_id} joined room {room_id} successfully")
-                return {
-                    'room_id': result['room_id']
-                }, 200
-            else:
-                return {
-                    'errcode': 'M_FORBIDDEN',
-                    'error': result.get('error', 'Failed to join room')
-                }, 403
-                
-        except ValueError as e:
-            logger.warning(f"Join room failed: {e}")
-            return {
-                'errcode': 'M_NOT_FOUND',
-                'error': str(e)
-            }, 404
-        except Exception as e:
-            logger.error(f"Join room error: {e}")
+        # 加入房间
+        result = await self.room_handler.join_room(
+            user_id=user_id,
+            room_id=room_id
+        )
+        
+        if result['success']:
+            logger.info("User %s joined room %s successfully", user_id, room_id)
             return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
+                'room_id': result['room_id']
+            }, 200
+        else:
+            return _err(
+                'M_FORBIDDEN', result.get('error', 'Failed to join room'), 403
+            )
             
-    async def handle_leave_room(self, access_token: str, room_id: str,
-                              request_data: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    @authenticated()
+    async def handle_leave_room(self, room_id: str,
+                              request_data: Optional[Dict[str, Any]] = None,
+                              *, user_id: str) -> Dict[str, Any]:
         """
         处理离开房间请求
         
@@ -176,55 +425,31 @@ class RoomAPI:
         
         Args:
             access_token: 访问令牌
+            user_id: 已校验的用户ID（由装饰器传入）
             room_id: 房间ID
             request_data: 请求数据
             
         Returns:
             离开房间响应
         """
-        logger.info(f"Processing leave room request: {room_id}")
+        logger.info("Processing leave room request: %s", room_id)
         
-        try:
-            # 验证访问令牌
-            user_info = await self.auth_handler.get_user_by_access_token(access_token)
-            if not user_info:
-                return {
-                    'errcode': 'M_UNKNOWN_TOKEN',
-                    'error': 'Invalid access token'
-                }, 401
-                
-            user_id = user_info['user_id']
-            
-            # 离开房间
-            success = await self.room_handler.leave_room(
-                user_id=user_id,
-                room_id=room_id
-            )
-            
-            if success:
-                logger.info(f"User {user_id} left room {room_id} successfully")
-                return {}, 200
-            else:
-                return {
-                    'errcode': 'M_FORBIDDEN',
-                    'error': 'Failed to leave room'
-                }, 403
-                
-        except ValueError as e:
-            logger.warning(f"Leave room failed: {e}")
-            return {
-                'errcode': 'M_NOT_FOUND',
-                'error': str(e)
-            }, 404
-        except Exception as e:
-            logger.error(f"Leave room error: {e}")
-            return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
-            
-    async def handle_invite_user(self, access_token: str, room_id: str,
-                               request_data: Dict[str, Any]) -> Dict[str, Any]:
+        # 离开房间
+        success = await self.room_handler.leave_room(
+            user_id=user_id,
+            room_id=room_id
+        )
+        
+        if success:
+            logger.info("User %s left room %s successfully", user_id, room_id)
+            return {}, 200
+        else:
+            return _err('M_FORBIDDEN', 'Failed to leave room', 403)
+            
+    @authenticated()
+    async def handle_invite_user(self, room_id: str,
+                               request_data: Dict[str, Any],
+                               *, user_id: str) -> Dict[str, Any]:
         """
         处理邀请用户请求
         
@@ -232,64 +457,40 @@ class RoomAPI:
         
         Args:
             access_token: 访问令牌
+            user_id: 已校验的用户ID（由装饰器传入）
             room_id: 房间ID
             request_data: 请求数据
             
         Returns:
             邀请用户响应
         """
-        logger.info(f"Processing invite user request: {room_id}")
+        logger.info("Processing invite user request: %s", room_id)
         
-        try:
-            # 验证访问令牌
-            user_info = await self.auth_handler.get_user_by_access_token(access_token)
-            if not user_info:
-                return {
-                    'errcode': 'M_UNKNOWN_TOKEN',
-                    'error': 'Invalid access token'
-                }, 401
-                
-            user_id = user_info['user_id']
-            invitee_id = request_data.get('user_id')
-            
-            if not invitee_id:
-                return {
-                    'errcode': 'M_MISSING_PARAM',
-                    'error': 'Missing user_id'
-                }, 400
-                
-            # 邀请用户
-            success = await self.room_handler.invite_user(
-                inviter_id=user_id,
-                invitee_id=invitee_id,
-                room_id=room_id
+        invitee_id = request_data.get('user_id')
+        
+        if not invitee_id:
+            return _ERR_MISSING_USER_ID
+            
+        # 邀请用户
+        success = await self.room_handler.invite_user(
+            inviter_id=user_id,
+            invitee_id=invitee_id,
+            room_id=room_id
+        )
+        
+        if success:
+            logger.info(
+                "User %s invited to room %s by %s", invitee_id, room_id, user_id
             )
+            return {}, 200
+        else:
+            return _err('M_FORBIDDEN', 'Failed to invite user', 403)
             
-            if success:
-                logger.info(f"User {invitee_id} invited to room {room_id} by {user_id}")
-                return {}, 200
-            else:
-                return {
-                    'errcode': 'M_FORBIDDEN',
-                    'error': 'Failed to invite user'
-                }, 403
-                
-        except ValueError as e:
-            logger.warning(f"Invite user failed: {e}")
-            return {
-                'errcode': 'M_NOT_FOUND',
-                'error': str(e)
-            }, 404
-        except Exception as e:
-            logger.error(f"Invite user error: {e}")
-            return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
-            
-    async def handle_get_room_state(self, access_token: str, room_id: str,
+    @authenticated(membership=True, speculative=True)
+    async def handle_get_room_state(self, room_id: str,
                                   event_type: Optional[str] = None,
-                                  state_key: Optional[str] = None) -> Dict[str, Any]:
+                                  state_key: Optional[str] = None,
+                                  *, user_id: str) -> Dict[str, Any]:
         """
         处理获取房间状态请求
         
@@ -299,6 +500,7 @@ class RoomAPI:
         
         Args:
             access_token: 访问令牌
+            user_id: 已校验的用户ID（由装饰器传入）
             room_id: 房间ID
             event_type: 事件类型（可选）
             state_key: 状态键（可选）
@@ -306,59 +508,36 @@ class RoomAPI:
         Returns:
             房间状态响应
         """
-        logger.debug(f"Processing get room state request: {room_id}")
+        logger.debug("Processing get room state request: %s", room_id)
         
-        try:
-            # 验证访问令牌
-            user_info = await self.auth_handler.get_user_by_access_token(access_token)
-            if not user_info:
-                return {
-                    'errcode': 'M_UNKNOWN_TOKEN',
-                    'error': 'Invalid access token'
-                }, 401
-                
-            user_id = user_info['user_id']
-            
-            # 检查用户是否在房间中
-            is_member = await self.room_handler.is_user_in_room(user_id, room_id)
-            if not is_member:
-                return {
-                    'errcode': 'M_FORBIDDEN',
-                    'error': 'User not in room'
-                }, 403
-                
+        state_group = await self.room_handler.get_current_state_group(room_id)
+        key = (room_id, event_type, state_key)
+        
+        cached = self._state_cache.get(key)
+        if cached is not None and state_group is not None and cached[0] == state_group:
+            state = cached[1]
+        else:
             # 获取房间状态
-            state = await self.room_handler.get_room_state(
+            state = freeze(await self.room_handler.get_room_state(
                 room_id=room_id,
                 event_type=event_type,
                 state_key=state_key
-            )
-            
-            if state is None:
-                return {
-                    'errcode': 'M_NOT_FOUND',
-                    'error': 'State not found'
-                }, 404
-                
-            return state, 200
-            
-        except ValueError as e:
-            logger.warning(f"Get room state failed: {e}")
-            return {
-                'errcode': 'M_NOT_FOUND',
-                'error': str(e)
-            }, 404
-        except Exception as e:
-            logger.error(f"Get room state error: {e}")
-            return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
+            ))
+            # 无法确定状态组时不缓存
+            if state_group is not None:
+                self._state_cache.set(key, (state_group, state))
+        
+        if state is None:
+            return _ERR_NOT_FOUND_STATE
             
-    async def handle_get_room_members(self, access_token: str, room_id: str,
+        return state, 200
+        
+    @authenticated(membership=True, speculative=True)
+    async def handle_get_room_members(self, room_id: str,
                                     at: Optional[str] = None,
                                     membership: Optional[str] = None,
-                                    not_membership: Optional[str] = None) -> Dict[str, Any]:
+                                    not_membership: Optional[str] = None,
+                                    *, user_id: str) -> Tuple[bytes, int]:
         """
         处理获取房间成员请求
         
@@ -366,60 +545,40 @@ class RoomAPI:
         
         Args:
             access_token: 访问令牌
+            user_id: 已校验的用户ID（由装饰器传入）
             room_id: 房间ID
             at: 时间点（可选）
             membership: 成员状态过滤（可选）
             not_membership: 排除成员状态（可选）
             
         Returns:
-            房间成员响应
+            预编码的房间成员响应
         """
-        logger.debug(f"Processing get room members request: {room_id}")
+        logger.debug("Processing get room members request: %s", room_id)
         
-        try:
-            # 验证访问令牌
-            user_info = await self.auth_handler.get_user_by_access_token(access_token)
-            if not user_info:
-                return {
-                    'errcode': 'M_UNKNOWN_TOKEN',
-                    'error': 'Invalid access token'
-                }, 401
-                
-            user_id = user_info['user_id']
-            
-            # 检查用户是否在房间中
-            is_member = await self.room_handler.is_user_in_room(user_id, room_id)
-            if not is_member:
-                return {
-                    'errcode': 'M_FORBIDDEN',
-                    'error': 'User not in room'
-                }, 403
-                
-            # 获取房间成员
-            members = await self.room_handler.get_room_members(
-                room_id=room_id,
-                membership=membership,
-                not_membership=not_membership
-            )
-            
-            return {
-                'chunk': members
-            }, 200
-            
-        except ValueError as e:
-            logger.warning(f"Get room members failed: {e}")
-            return {
-                'errcode': 'M_NOT_FOUND',
-                'error': str(e)
-            }, 404
-        except Exception as e:
-            logger.error(f"Get room members error: {e}")
-            return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
-            
-    async def handle_get_joined_rooms(self, access_token: str) -> Dict[str, Any]:
+        state_group = await self.room_handler.get_current_state_group(room_id)
+        key = (room_id, membership, not_membership)
+        
+        cached = self._members_cache.get(key)
+        if cached is not None and state_group is not None and cached[0] == state_group:
+            return cached[1], 200
+            
+        # 获取房间成员
+        members = await self.room_handler.get_room_members(
+            room_id=room_id,
+            membership=membership,
+            not_membership=not_membership
+        )
+        
+        body = _encode({'chunk': members})
+        # 无法确定状态组或响应过大时不缓存
+        if state_group is not None and len(body) <= ROOM_MEMBERS_CACHE_MAX_ENTRY_BYTES:
+            self._members_cache.set(key, (state_group, body))
+        
+        return body, 200
+        
+    @authenticated()
+    async def handle_get_joined_rooms(self, *, user_id: str) -> Tuple[bytes, int]:
         """
         处理获取已加入房间请求
         
@@ -427,40 +586,32 @@ class RoomAPI:
         
         Args:
             access_token: 访问令牌
+            user_id: 已校验的用户ID（由装饰器传入）
             
         Returns:
-            已加入房间响应
+            预编码的已加入房间响应
         """
         logger.debug("Processing get joined rooms request")
         
-        try:
-            # 验证访问令牌
-            user_info = await self.auth_handler.get_user_by_access_token(access_token)
-            if not user_info:
-                return {
-                    'errcode': 'M_UNKNOWN_TOKEN',
-                    'error': 'Invalid access token'
-                }, 401
-                
-            user_id = user_info['user_id']
-            
+        version = await self.room_handler.get_membership_version(user_id)
+        key = (user_id, version)
+        
+        body = self._joined_rooms_cache.get(key) if version is not None else None
+        if body is None:
             # 获取用户已加入的房间
             joined_rooms = await self.room_handler.get_user_joined_rooms(user_id)
+            body = _encode({'joined_rooms': joined_rooms})
+            # 无法确定成员关系版本时不缓存
+            if version is not None:
+                self._joined_rooms_cache.set(key, body)
             
-            return {
-                'joined_rooms': joined_rooms
-            }, 200
-            
-        except Exception as e:
-            logger.error(f"Get joined rooms error: {e}")
-            return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
-            
-    async def handle_set_room_state(self, access_token: str, room_id: str,
+        return body, 200
+        
+    @authenticated(membership=True, power_level=50, invalid_param=True)
+    async def handle_set_room_state(self, room_id: str,
                                   event_type: str, state_key: str,
-                                  request_data: Dict[str, Any]) -> Dict[str, Any]:
+                                  request_data: Dict[str, Any],
+                                  *, user_id: str) -> Dict[str, Any]:
         """
         处理设置房间状态请求
         
@@ -468,6 +619,7 @@ class RoomAPI:
         
         Args:
             access_token: 访问令牌
+            user_id: 已校验的用户ID（由装饰器传入）
             room_id: 房间ID
             event_type: 事件类型
             state_key: 状态键
@@ -476,62 +628,33 @@ class RoomAPI:
         Returns:
             设置房间状态响应
         """
-        logger.info(f"Processing set room state request: {room_id}/{event_type}/{state_key}")
+        logger.info(
+            "Processing set room state request: %s/%s/%s",
+            room_id, event_type, state_key
+        )
         
-        try:
-            # 验证访问令牌
-            user_info = await self.auth_handler.get_user_by_access_token(access_token)
-            if not user_info:
-                return {
-                    'errcode': 'M_UNKNOWN_TOKEN',
-                    'error': 'Invalid access token'
-                }, 401
-                
-            user_id = user_info['user_id']
-            
-            # 检查用户权限
-            has_permission = await self.room_handler.check_user_power_level(
-                user_id=user_id,
-                room_id=room_id,
-                required_level=50  # 默认状态事件需要50级权限
-            )
-            
-            if not has_permission:
-                return {
-                    'errcode': 'M_FORBIDDEN',
-                    'error': 'Insufficient power level'
-                }, 403
-                
-            # 设置房间状态
-            event_id = await self.room_handler.send_state_event(
-                sender_id=user_id,
-                room_id=room_id,
-                event_type=event_type,
-                state_key=state_key,
-                content=request_data
-            )
-            
-            logger.info(f"Room state set successfully: {event_id}")
-            
-            return {
-                'event_id': event_id
-            }, 200
-            
-        except ValueError as e:
-            logger.warning(f"Set room state failed: {e}")
-            return {
-                'errcode': 'M_INVALID_PARAM',
-                'error': str(e)
-            }, 400
-        except Exception as e:
-            logger.error(f"Set room state error: {e}")
-            return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
+        # 设置房间状态
+        event_id = await self.room_handler.send_state_event(
+            sender_id=user_id,
+            room_id=room_id,
+            event_type=event_type,
+            state_key=state_key,
+            content=request_data
+        )
+        
+        if event_type == 'm.room.power_levels':
+            self._invalidate_power_levels(room_id)
             
-    async def handle_kick_user(self, access_token: str, room_id: str,
-                             request_data: Dict[str, Any]) -> Dict[str, Any]:
+        logger.info("Room state set successfully: %s", event_id)
+        
+        return {
+            'event_id': event_id
+        }, 200
+        
+    @authenticated(membership=True, power_level=50)
+    async def handle_kick_user(self, room_id: str,
+                             request_data: Dict[str, Any],
+                             *, user_id: str) -> Dict[str, Any]:
         """
         处理踢出用户请求
         
@@ -539,72 +662,156 @@ class RoomAPI:
         
         Args:
             access_token: 访问令牌
+            user_id: 已校验的用户ID（由装饰器传入）
             room_id: 房间ID
             request_data: 请求数据
             
         Returns:
             踢出用户响应
         """
-        logger.info(f"Processing kick user request: {room_id}")
+        logger.info("Processing kick user request: %s", room_id)
+        
+        target_user_id = request_data.get('user_id')
+        reason = request_data.get('reason')
+        
+        if not target_user_id:
+            return _ERR_MISSING_USER_ID
+            
+        # 踢出用户
+        success = await self.room_handler.kick_user(
+            kicker_id=user_id,
+            target_user_id=target_user_id,
+            room_id=room_id,
+            reason=reason
+        )
+        
+        if success:
+            logger.info(
+                "User %s kicked from room %s by %s", target_user_id, room_id, user_id
+            )
+            return {}, 200
+        else:
+            return _err('M_FORBIDDEN', 'Failed to kick user', 403)
+            
+    async def handle_batch(self, access_token: str,
+                           ops: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        处理批量操作请求
+        
+        访问令牌只校验一次，然后并发执行所有操作；对同一房间的多个邀请
+        合并为一次批量写入。
+        
+        Args:
+            access_token: 访问令牌
+            ops: 操作列表，每项形如 {'op': 'invite', 'params': {...}}，
+                params 为对应处理器除 access_token 以外的参数
+                
+        Returns:
+            与 ops 一一对应的 {'status': ..., 'body': ...} 列表
+        """
+        logger.info("Processing batch request with %s ops", len(ops))
         
         try:
             # 验证访问令牌
             user_info = await self.auth_handler.get_user_by_access_token(access_token)
             if not user_info:
-                return {
-                    'errcode': 'M_UNKNOWN_TOKEN',
-                    'error': 'Invalid access token'
-                }, 401
+                return _ERR_UNKNOWN_TOKEN
                 
             user_id = user_info['user_id']
-            target_user_id = request_data.get('user_id')
-            reason = request_data.get('reason')
             
-            if not target_user_id:
-                return {
-                    'errcode': 'M_MISSING_PARAM',
-                    'error': 'Missing user_id'
-                }, 400
-                
-            # 检查用户权限
-            has_permission = await self.room_handler.check_user_power_level(
-                user_id=user_id,
-                room_id=room_id,
-                required_level=50  # 踢人需要50级权限
-            )
+            responses: List[Optional[Dict[str, Any]]] = [None] * len(ops)
+            single_ops: List[int] = []
+            # room_id -> [(操作下标, 被邀请者ID)]
+            invites: Dict[str, List[Tuple[int, str]]] = {}
             
-            if not has_permission:
-                return {
-                    'errcode': 'M_FORBIDDEN',
-                    'error': 'Insufficient power level'
-                }, 403
+            for index, op in enumerate(ops):
+                handler = self._BATCH_OPS.get(op.get('op'))
+                params = op.get('params') or {}
                 
-            # 踢出用户
-            success = await self.room_handler.kick_user(
-                kicker_id=user_id,
-                target_user_id=target_user_id,
-                room_id=room_id,
-                reason=reason
-            )
-            
-            if success:
-                logger.info(f"User {target_user_id} kicked from room {room_id} by {user_id}")
-                return {}, 200
-            else:
-                return {
-                    'errcode': 'M_FORBIDDEN',
-                    'error': 'Failed to kick user'
-                }, 403
+                if handler is None:
+                    responses[index] = _batch_response(_err(
+                        'M_UNRECOGNIZED', f"Unknown batch op: {op.get('op')}", 400
+                    ))
+                    continue
+                    
+                try:
+                    handler.signature.bind(self, user_id=user_id, **params)
+                except TypeError as e:
+                    responses[index] = _batch_response(
+                        _err('M_INVALID_PARAM', str(e), 400)
+                    )
+                    continue
+                    
+                invitee_id = (params.get('request_data') or {}).get('user_id')
+                if op['op'] == 'invite' and invitee_id:
+                    invites.setdefault(params['room_id'], []).append(
+                        (index, invitee_id)
+                    )
+                else:
+                    single_ops.append(index)
+                    
+            # 只有一个邀请的房间不值得走批量路径
+            for room_id in [r for r, entries in invites.items() if len(entries) == 1]:
+                single_ops.append(invites.pop(room_id)[0][0])
                 
-        except ValueError as e:
-            logger.warning(f"Kick user failed: {e}")
-            return {
-                'errcode': 'M_NOT_FOUND',
-                'error': str(e)
-            }, 404
-        except Exception as e:
-            logger.error(f"Kick user error: {e}")
+            async def run_single(index: int) -> None:
+                op = ops[index]
+                response = await self._BATCH_OPS[op['op']].call_as_user(
+                    self, user_id, **(op.get('params') or {})
+                )
+                responses[index] = _batch_response(response)
+                
+            async def run_invites(room_id: str) -> None:
+                entries = invites[room_id]
+                try:
+                    failures = await self.room_handler.invite_users_bulk(
+                        inviter_id=user_id,
+                        invitee_ids=[invitee_id for _, invitee_id in entries],
+                        room_id=room_id
+                    )
+                except _MAPPED_EXCEPTIONS as e:
+                    logger.warning("Bulk invite failed: %s", e)
+                    failures = {invitee_id: e for _, invitee_id in entries}
+                except Exception:
+                    logger.exception("Bulk invite error")
+                    for index, _ in entries:
+                        responses[index] = _batch_response(_ERR_INTERNAL)
+                    return
+                    
+                # 与逐个邀请时 handle_invite_user 的异常映射保持一致
+                invalid_param = self._BATCH_OPS['invite'].invalid_param
+                for index, invitee_id in entries:
+                    failure = failures.get(invitee_id)
+                    if failure is None:
+                        responses[index] = _batch_response(({}, 200))
+                    else:
+                        errcode, status = _map_exception(failure, invalid_param)
+                        responses[index] = _batch_response(
+                            _err(errcode, str(failure), status)
+                        )
+                        
+            tasks: List[Callable[[], Awaitable[None]]] = [
+                functools.partial(run_single, index) for index in single_ops
+            ]
+            tasks.extend(functools.partial(run_invites, room_id) for room_id in invites)
+            
+            await yieldable_gather_results(_run_task, tasks)
+            
             return {
-                'errcode': 'M_UNKNOWN',
-                'error': 'Internal server error'
-            }, 500
\ No newline at end of file
+                'responses': responses
+            }, 200
+            
+        except Exception:
+            logger.exception("Batch error")
+            return _ERR_INTERNAL
+            
+    # 批量接口支持的操作
+    _BATCH_OPS = {
+        'join': handle_join_room,
+        'leave': handle_leave_room,
+        'invite': handle_invite_user,
+        'kick': handle_kick_user,
+        'get_state': handle_get_room_state,
+        'get_members': handle_get_room_members,
+        'set_state': handle_set_room_state,
+    }
@@ -13,13 +13,65 @@
 # limitations under the License.
 
 import logging
-from typing import Any, Dict, List, Optional
+from typing import TYPE_CHECKING, Any, Dict, List, Mapping, Optional, Type
+
+import attr
+
+from synapse._pydantic_compat import HAS_PYDANTIC_V2
+
+if TYPE_CHECKING or HAS_PYDANTIC_V2:
+    from pydantic.v1 import BaseModel, Extra, ValidationError
+else:
+    from pydantic import BaseModel, Extra, ValidationError
 
 from synapse.config._base import Config, ConfigError
-from synapse.config._util import validate_config
+from synapse.util.frozenutils import freeze
 
 logger = logging.getLogger(__name__)
 
+_SQLITE_ENGINES = frozenset({"sqlite3"})
+_POSTGRES_ENGINES = frozenset({"psycopg2", "psycopg2cffi"})
+_SUPPORTED_ENGINES = _SQLITE_ENGINES | _POSTGRES_ENGINES
+
+
+class _DatabaseArgsModel(BaseModel):
+    """Base schema for database connection args.
+
+    Unknown args are passed through untouched so that driver-specific options
+    still reach the connection pool. Parsed args are immutable.
+    """
+
+    class Config:
+        extra = Extra.allow
+        allow_mutation = False
+
+
+class _SqliteArgs(_DatabaseArgsModel):
+    """SQLite connection args, with defaults tuned for low-resource servers."""
+
+    database: str = "/data/homeserver.db"
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    cache_size: int = -2000  # 2MB cache
+    temp_store: str = "memory"
+    mmap_size: int = 268435456  # 256MB
+
+
+class _PostgresArgs(_DatabaseArgsModel):
+    """PostgreSQL connection args, with defaults tuned for low-resource servers."""
+
+    user: str
+    database: str
+    cp_min: int = 2
+    cp_max: int = 5
+    cp_reconnect: bool = True
+    host: str = "localhost"
+    port: int = 5432
+
+
+_SQLITE_SCHEMA: Type[_DatabaseArgsModel] = _SqliteArgs
+_POSTGRES_SCHEMA: Type[_DatabaseArgsModel] = _PostgresArgs
+
 DEFAULT_CONFIG = """
 # Database configuration
 database:
@@ -51,80 +103,44 @@ database:
 """
 
 
+@attr.s(slots=True, frozen=True, auto_attribs=True, init=False)
 class DatabaseConnectionConfig:
-    """Configuration for a database connection."""
+    """Configuration for a database connection.
+
+    The connection args are validated against the engine's schema once, at
+    construction time, and the defaults are filled in at the same point. The
+    result is immutable: normalised args are available as attributes on
+    `args`, and `config` is a frozen copy of the original config with the
+    normalised args.
+    """
+
+    name: str
+    config: Mapping[str, Any]
+    args: _DatabaseArgsModel
+    is_sqlite: bool
+    is_postgres: bool
     
-    def __init__(self, name: str, db_config: Dict[str, Any]):
-        self.name = name
-        self.config = db_config.copy()
-        
+    def __init__(self, name: str, db_config: Mapping[str, Any]):
         # Validate database name
-        if name not in ["sqlite3", "psycopg2", "psycopg2cffi"]:
+        if name not in _SUPPORTED_ENGINES:
             raise ConfigError(f"Unsupported database engine: {name}")
             
-        # Set default args if not provided
-        if "args" not in self.config:
-            self.config["args"] = {}
-            
-        # Database-specific validation and defaults
-        if name == "sqlite3":
-            self._setup_sqlite_config()
-        elif name in ["psycopg2", "psycopg2cffi"]:
-            self._setup_postgres_config()
-            
-        # Set database engine for compatibility
-        self.database_engine = name
-            
-    def _setup_sqlite_config(self) -> None:
-        """Setup SQLite-specific configuration."""
-        args = self.config["args"]
+        is_sqlite = name in _SQLITE_ENGINES
         
-        # Default database path
-        if "database" not in args:
-            args["database"] = "/data/homeserver.db"
-            
-        # SQLite optimization settings for low-resource servers
-        if "journal_mode" not in args:
-            args["journal_mode"] = "WAL"
-            
-        if "synchronous" not in args:
-            args["synchronous"] = "NORMAL"
-            
-        if "cache_size" not in args:
-            args["cache_size"] = -2000  # 2MB cache
-            
-        if "temp_store" not in args:
-            args["temp_store"] = "memory"
-            
-        if "mmap_size" not in args:
-            args["mmap_size"] = 268435456  # 256MB
+        schema = _SQLITE_SCHEMA if is_sqlite else _POSTGRES_SCHEMA
+        try:
+            args = schema.parse_obj(db_config.get("args") or {})
+        except ValidationError as e:
+            raise ConfigError(str(e), ("database", "args")) from e
             
-    def _setup_postgres_config(self) -> None:
-        """Setup PostgreSQL-specific configuration."""
-        args = self.config["args"]
+        config = freeze({**db_config, "args": args.dict()})
         
-        # Required PostgreSQL settings
-        required_keys = ["user", "database"]
-        for key in required_keys:
-            if key not in args:
-                raise ConfigError(f"Missing required PostgreSQL config: {key}")
-                
-        # Default connection pool settings for low-resource servers
-        if "cp_min" not in args:
-            args["cp_min"] = 2
-            
-        if "cp_max" not in args:
-            args["cp_max"] = 5
-            
-        if "cp_reconnect" not in args:
-            args["cp_reconnect"] = True
-            
-        # Default host and port
-        if "host" not in args:
-            args["host"] = "localhost"
-            
-        if "port" not in args:
-            args["port"] = 5432
+        self.__attrs_init__(name, config, args, is_sqlite, not is_sqlite)
+        
+    @property
+    def database_engine(self) -> str:
+        """The database engine name, kept for compatibility."""
+        return self.name
 
 
 class DatabaseConfig(Config):
@@ -208,34 +224,13 @@ class DatabaseConfig(Config):
         """
         return self.databases.copy()
         
-    def validate_database_config(self) -> None:
-        """Validate the database configuration."""
-        for db_config in self.databases:
-            # Check if database engine is supported
-            if db_config.name not in ["sqlite3", "psycopg2", "psycopg2cffi"]:
-                raise ConfigError(f"Unsupported database engine: {db_config.name}")
-                
-            # Validate SQLite configuration
-            if db_config.name == "sqlite3":
-                args = db_config.config.get("args", {})
-                if "database" not in args:
-                    raise ConfigError("SQLite database path is required")
-                    
-            # Validate PostgreSQL configuration
-            elif db_config.name in ["psycopg2", "psycopg2cffi"]:
-                args = db_config.config.get("args", {})
-                required_keys = ["user", "database"]
-                for key in required_keys:
-                    if key not in args:
-                        raise ConfigError(f"PostgreSQL {key} is required")
-                        
     def is_sqlite(self) -> bool:
         """Check if the main database is SQLite.
         
         Returns:
             True if using SQLite, False otherwise.
         """
-        return self.database_config.name == "sqlite3"
+        return self.database_config.is_sqlite
         
     def is_postgres(self) -> bool:
         """Check if the main database is PostgreSQL.
@@ -243,4 +238,4 @@ class DatabaseConfig(Config):
         Returns:
             True if using PostgreSQL, False otherwise.
         """
-        return self.database_config.name in ["psycopg2", "psycopg2cffi"]
\ No newline at end of file
+        return self.database_config.is_postgres
\ No newline at end of file
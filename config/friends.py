@@ -13,10 +13,26 @@
 # limitations under the License.
 
 import attr
-from typing import Optional
+from typing import Any, Callable, Optional, Tuple
 
 from synapse.config._base import Config
 
+# (attribute, predicate the value must satisfy, error message)
+_VALIDATIONS: Tuple[Tuple[str, Callable[[Any], bool], str], ...] = (
+    ("max_requests_per_hour", lambda v: v >= 1,
+     "max_requests_per_hour must be at least 1"),
+    ("rate_limit_window", lambda v: v >= 60,
+     "rate_limit_window must be at least 60 seconds"),
+    ("max_friends_per_user", lambda v: v >= 1,
+     "max_friends_per_user must be at least 1"),
+    ("max_blocked_users", lambda v: v >= 1,
+     "max_blocked_users must be at least 1"),
+    ("request_message_max_length", lambda v: v >= 0,
+     "request_message_max_length must be non-negative"),
+    ("request_expiry_hours", lambda v: v >= 1,
+     "request_expiry_hours must be at least 1 hour"),
+)
+
 
 @attr.s(auto_attribs=True, frozen=True, slots=True)
 class FriendsConfig(Config):
@@ -78,15 +94,6 @@ class FriendsConfig(Config):
         self.notify_on_friend_removed = notifications_config.get("on_friend_removed", False)
         
         # Validation
-        if self.max_requests_per_hour < 1:
-            raise ValueError("max_requests_per_hour must be at least 1")
-        if self.rate_limit_window < 60:
-            raise ValueError("rate_limit_window must be at least 60 seconds")
-        if self.max_friends_per_user < 1:
-            raise ValueError("max_friends_per_user must be at least 1")
-        if self.max_blocked_users < 1:
-            raise ValueError("max_blocked_users must be at least 1")
-        if self.request_message_max_length < 0:
-            raise ValueError("request_message_max_length must be non-negative")
-        if self.request_expiry_hours < 1:
-            raise ValueError("request_expiry_hours must be at least 1 hour")
\ No newline at end of file
+        for name, predicate, message in _VALIDATIONS:
+            if not predicate(getattr(self, name)):
+                raise ValueError(message)
\ No newline at end of file
@@ -12,13 +12,123 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import logging
-from typing import Any, Dict, Optional
+import math
+from array import array
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
 
 from synapse.config._base import Config
 
 logger = logging.getLogger(__name__)
 
+# Passwords rejected as too common when check_common_passwords is enabled.
+_COMMON_PASSWORDS_LOWER = frozenset({
+    "password", "123456", "123456789", "qwerty", "abc123",
+    "password123", "admin", "letmein", "welcome", "monkey",
+    "1234567890", "dragon", "master", "hello", "freedom",
+})
+
+# validate(password, username, server_name, server_name_lower)
+#     -> (is_valid, error_message)
+PasswordValidator = Callable[
+    [str, Optional[str], Optional[str], Optional[str]], Tuple[bool, str]
+]
+
+
+def _char_classes(password: str) -> Tuple[bool, bool, bool, bool]:
+    """Classify the characters of a password in a single pass.
+
+    Args:
+        password: The password to inspect.
+
+    Returns:
+        A tuple of (has_lower, has_upper, has_digit, has_symbol).
+    """
+    has_lower = has_upper = has_digit = has_symbol = False
+    for c in password:
+        if c.islower():
+            has_lower = True
+        elif c.isupper():
+            has_upper = True
+        elif c.isdigit():
+            has_digit = True
+        elif not c.isalnum():
+            has_symbol = True
+        else:
+            continue
+        if has_lower and has_upper and has_digit and has_symbol:
+            break
+    return has_lower, has_upper, has_digit, has_symbol
+
+
+def _password_digest(password_lower: str) -> int:
+    """Hash a lower-cased password to a 64-bit integer."""
+    return int.from_bytes(
+        hashlib.blake2b(password_lower.encode("utf-8"), digest_size=8).digest(),
+        "little",
+    )
+
+
+class _CommonPasswordCorpus:
+    """A compact, read-only set of lower-cased passwords, e.g. a breach corpus.
+
+    Entries are kept as a sorted array of 64-bit digests (8 bytes each, rather
+    than a str object per entry), fronted by a Bloom filter so that the usual
+    case -- a password that is *not* in the corpus -- is normally answered by a
+    handful of bit tests. Bloom filter hits are confirmed by binary search, so
+    false positives never reject a password.
+    """
+
+    __slots__ = ("_bits", "_num_bits", "_num_hashes", "_digests")
+
+    def __init__(self, passwords: Iterable[str], error_rate: float = 0.001):
+        self._digests = array("Q", sorted({_password_digest(p) for p in passwords}))
+
+        n = max(len(self._digests), 1)
+        self._num_bits = max(64, int(-n * math.log(error_rate) / math.log(2) ** 2))
+        self._num_hashes = max(1, round(self._num_bits / n * math.log(2)))
+        self._bits = bytearray((self._num_bits + 7) // 8)
+
+        for digest in self._digests:
+            for pos in self._positions(digest):
+                self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    @classmethod
+    def from_file(cls, path: str) -> "_CommonPasswordCorpus":
+        """Load a corpus with one password per line."""
+        try:
+            with open(path, encoding="utf-8", errors="replace") as f:
+                return cls(line.strip().lower() for line in f if line.strip())
+        except OSError as e:
+            raise ValueError(f"Unable to read common_passwords_file {path}: {e}")
+
+    def _positions(self, digest: int) -> Iterator[int]:
+        # Derive the k bit positions from the two halves of the digest
+        # (Kirsch-Mitzenmacher double hashing).
+        h1 = digest & 0xFFFFFFFF
+        h2 = (digest >> 32) | 1
+        num_bits = self._num_bits
+        return ((h1 + i * h2) % num_bits for i in range(self._num_hashes))
+
+    def __len__(self) -> int:
+        return len(self._digests)
+
+    def __contains__(self, password_lower: object) -> bool:
+        if not isinstance(password_lower, str):
+            return False
+
+        digest = _password_digest(password_lower)
+        bits = self._bits
+        for pos in self._positions(digest):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+
+        i = bisect_left(self._digests, digest)
+        return i < len(self._digests) and self._digests[i] == digest
+
+
 DEFAULT_CONFIG = """
 # Password policy configuration
 password_config:
@@ -60,6 +170,10 @@ password_config:
   # Whether to check against common password lists
   check_common_passwords: true
   
+  # Optional file of additional common passwords (e.g. a breach corpus), one
+  # per line, checked when check_common_passwords is enabled
+  #common_passwords_file: /path/to/common-passwords.txt
+  
   # Whether to prevent passwords that contain the username
   prevent_username_in_password: true
   
@@ -76,48 +190,52 @@ class PasswordPolicyConfig(Config):
     
     section = "password_policy"
     
+    # Default value of each option in the `password_config` section
+    _DEFAULTS: Dict[str, Any] = {
+        "enabled": True,
+        "minimum_length": 8,
+        "maximum_length": 0,  # No limit
+        "require_lowercase": True,
+        "require_uppercase": True,
+        "require_digit": True,
+        "require_symbol": True,
+        "forbidden_passwords": (
+            "password", "123456", "password123", "admin", "root",
+            "guest", "user", "test", "demo", "synapse", "matrix"
+        ),
+        "check_common_passwords": True,
+        "common_passwords_file": None,
+        "prevent_username_in_password": True,
+        "prevent_server_name_in_password": True,
+        "minimum_strength_score": 2,
+    }
+    
     def __init__(self, root_config: Optional[Dict[str, Any]] = None):
         super().__init__(root_config)
         
         # Default values
-        self.enabled = True
-        self.minimum_length = 8
-        self.maximum_length = 0  # No limit
-        self.require_lowercase = True
-        self.require_uppercase = True
-        self.require_digit = True
-        self.require_symbol = True
-        self.forbidden_passwords = [
-            "password", "123456", "password123", "admin", "root",
-            "guest", "user", "test", "demo", "synapse", "matrix"
-        ]
-        self.check_common_passwords = True
-        self.prevent_username_in_password = True
-        self.prevent_server_name_in_password = True
-        self.minimum_strength_score = 2
+        for name, default in self._DEFAULTS.items():
+            setattr(self, name, default)
+        self._common_corpus: Optional[_CommonPasswordCorpus] = None
+        self._forbidden_set = frozenset(p.lower() for p in self.forbidden_passwords)
+        self._validator = self._build_validator()
         
     def read_config(self, config: Dict[str, Any], **kwargs: Any) -> None:
         """Read password policy configuration from config dict."""
         password_config = config.get("password_config", {})
         
-        self.enabled = password_config.get("enabled", True)
-        self.minimum_length = password_config.get("minimum_length", 8)
-        self.maximum_length = password_config.get("maximum_length", 0)
-        self.require_lowercase = password_config.get("require_lowercase", True)
-        self.require_uppercase = password_config.get("require_uppercase", True)
-        self.require_digit = password_config.get("require_digit", True)
-        self.require_symbol = password_config.get("require_symbol", True)
-        
-        # Forbidden passwords list
-        self.forbidden_passwords = password_config.get("forbidden_passwords", [
-            "password", "123456", "password123", "admin", "root",
-            "guest", "user", "test", "demo", "synapse", "matrix"
-        ])
-        
-        self.check_common_passwords = password_config.get("check_common_passwords", True)
-        self.prevent_username_in_password = password_config.get("prevent_username_in_password", True)
-        self.prevent_server_name_in_password = password_config.get("prevent_server_name_in_password", True)
-        self.minimum_strength_score = password_config.get("minimum_strength_score", 2)
+        for name, default in self._DEFAULTS.items():
+            setattr(self, name, password_config.get(name, default))
+            
+        self._common_corpus = None
+        if self.check_common_passwords and self.common_passwords_file:
+            self._common_corpus = _CommonPasswordCorpus.from_file(
+                self.common_passwords_file
+            )
+            logger.info(
+                "Loaded %d common passwords from %s",
+                len(self._common_corpus), self.common_passwords_file,
+            )
         
         # Validate configuration
         self._validate_config()
@@ -130,88 +248,160 @@ class PasswordPolicyConfig(Config):
         if self.maximum_length > 0 and self.maximum_length < self.minimum_length:
             raise ValueError("maximum_length must be greater than minimum_length")
             
-        if not isinstance(self.forbidden_passwords, list):
+        if not isinstance(self.forbidden_passwords, (list, tuple)):
             raise ValueError("forbidden_passwords must be a list")
             
         if self.minimum_strength_score < 0 or self.minimum_strength_score > 4:
             raise ValueError("minimum_strength_score must be between 0 and 4")
             
+        # Lower-cased once here so that validate_password is a set lookup
+        self._forbidden_set = frozenset(p.lower() for p in self.forbidden_passwords)
+        self._validator = self._build_validator()
+            
     def generate_config_section(self, data_dir_path: str, **kwargs: Any) -> str:
         """Generate the password policy configuration section."""
         return DEFAULT_CONFIG
         
     def validate_password(self, password: str, username: str = None, 
-                         server_name: str = None) -> tuple[bool, str]:
+                         server_name: str = None,
+                         server_name_lower: str = None) -> tuple[bool, str]:
         """Validate a password against the configured policy.
         
         Args:
             password: The password to validate.
             username: The username (optional).
             server_name: The server name (optional).
+            server_name_lower: The server name, already lower-cased (optional).
+                Callers validating many passwords for the same server can pass
+                this instead of `server_name` to avoid lower-casing it each time.
             
         Returns:
             A tuple of (is_valid, error_message).
         """
+        return self._validator(password, username, server_name, server_name_lower)
+        
+    def _build_validator(self) -> PasswordValidator:
+        """Build a password validator specialised for the current policy.
+        
+        The policy settings are fixed once the config has been read, so they
+        are captured here as closure constants (along with the pre-formatted
+        error messages) rather than being re-read from the config object on
+        every validation. Disabled policies get a validator that accepts
+        everything.
+        
+        Returns:
+            The specialised validator.
+        """
         if not self.enabled:
-            return True, ""
-            
-        # Check minimum length
-        if len(password) < self.minimum_length:
-            return False, f"Password must be at least {self.minimum_length} characters long"
-            
-        # Check maximum length
-        if self.maximum_length > 0 and len(password) > self.maximum_length:
-            return False, f"Password must be no more than {self.maximum_length} characters long"
-            
-        # Check character requirements
-        if self.require_lowercase and not any(c.islower() for c in password):
-            return False, "Password must contain at least one lowercase letter"
-            
-        if self.require_uppercase and not any(c.isupper() for c in password):
-            return False, "Password must contain at least one uppercase letter"
-            
-        if self.require_digit and not any(c.isdigit() for c in password):
-            return False, "Password must contain at least one digit"
-            
-        if self.require_symbol and password.isalnum():
-            return False, "Password must contain at least one symbol or special character"
-            
-        # Check forbidden passwords
-        if password.lower() in [p.lower() for p in self.forbidden_passwords]:
-            return False, "This password is not allowed"
-            
-        # Check username in password
-        if (self.prevent_username_in_password and username and 
-            username.lower() in password.lower()):
-            return False, "Password must not contain the username"
+            def accept_all(password: str, username: Optional[str] = None,
+                           server_name: Optional[str] = None,
+                           server_name_lower: Optional[str] = None) -> Tuple[bool, str]:
+                return True, ""
+                
+            return accept_all
             
-        # Check server name in password
-        if (self.prevent_server_name_in_password and server_name and 
-            server_name.lower() in password.lower()):
-            return False, "Password must not contain the server name"
+        minimum_length = self.minimum_length
+        maximum_length = self.maximum_length
+        require_lowercase = self.require_lowercase
+        require_uppercase = self.require_uppercase
+        require_digit = self.require_digit
+        require_symbol = self.require_symbol
+        forbidden_set = self._forbidden_set
+        prevent_username = self.prevent_username_in_password
+        prevent_server_name = self.prevent_server_name_in_password
+        check_common = self.check_common_passwords
+        common_corpus = self._common_corpus
+        minimum_strength_score = self.minimum_strength_score
+        calculate_strength_score = self._calculate_strength_score
+        
+        # Skip the character scan and strength scoring entirely when nothing
+        # depends on them
+        needs_char_scan = (
+            require_lowercase or require_uppercase or require_digit or require_symbol
+        )
+        check_strength = minimum_strength_score > 0
+        
+        too_short = f"Password must be at least {minimum_length} characters long"
+        too_long = f"Password must be no more than {maximum_length} characters long"
+        
+        def validate(password: str, username: Optional[str] = None,
+                     server_name: Optional[str] = None,
+                     server_name_lower: Optional[str] = None) -> Tuple[bool, str]:
+            # Lower-cased once and shared by all the case-insensitive checks below
+            password_lower = password.lower()
             
-        # Check common passwords (basic implementation)
-        if self.check_common_passwords:
-            common_passwords = [
-                "password", "123456", "123456789", "qwerty", "abc123",
-                "password123", "admin", "letmein", "welcome", "monkey",
-                "1234567890", "dragon", "master", "hello", "freedom"
-            ]
-            if password.lower() in common_passwords:
+            # Check minimum length
+            if len(password) < minimum_length:
+                return False, too_short
+                
+            # Check maximum length
+            if maximum_length > 0 and len(password) > maximum_length:
+                return False, too_long
+                
+            # Check character requirements
+            char_classes = None
+            if needs_char_scan:
+                char_classes = _char_classes(password)
+                has_lower, has_upper, has_digit, has_symbol = char_classes
+                
+                if require_lowercase and not has_lower:
+                    return False, "Password must contain at least one lowercase letter"
+                    
+                if require_uppercase and not has_upper:
+                    return False, "Password must contain at least one uppercase letter"
+                    
+                if require_digit and not has_digit:
+                    return False, "Password must contain at least one digit"
+                    
+                if require_symbol and not has_symbol:
+                    return False, "Password must contain at least one symbol or special character"
+                
+            # Check forbidden passwords
+            if password_lower in forbidden_set:
+                return False, "This password is not allowed"
+                
+            # Check username in password. `in` on str uses the same C search
+            # as str.find, so test containment directly on the lowered forms.
+            if prevent_username and username:
+                username_lower = username.lower()
+                if username_lower in password_lower:
+                    return False, "Password must not contain the username"
+                    
+            # Check server name in password
+            if prevent_server_name and (server_name_lower or server_name):
+                if server_name_lower is None:
+                    server_name_lower = server_name.lower()
+                if server_name_lower in password_lower:
+                    return False, "Password must not contain the server name"
+                
+            # Check common passwords (basic implementation)
+            if check_common and (
+                password_lower in _COMMON_PASSWORDS_LOWER
+                or (common_corpus is not None and password_lower in common_corpus)
+            ):
                 return False, "This password is too common"
                 
-        # Check password strength (basic implementation)
-        strength_score = self._calculate_strength_score(password)
-        if strength_score < self.minimum_strength_score:
-            return False, f"Password is too weak (strength: {strength_score}/{4})"
+            # Check password strength (basic implementation)
+            if check_strength:
+                strength_score = calculate_strength_score(password, char_classes)
+                if strength_score < minimum_strength_score:
+                    return False, f"Password is too weak (strength: {strength_score}/{4})"
+                
+            return True, ""
             
-        return True, ""
+        return validate
         
-    def _calculate_strength_score(self, password: str) -> int:
+    def _calculate_strength_score(
+        self,
+        password: str,
+        char_classes: Optional[Tuple[bool, bool, bool, bool]] = None,
+    ) -> int:
         """Calculate a basic password strength score (0-4).
         
         Args:
             password: The password to score.
+            char_classes: The result of `_char_classes(password)`, if the
+                caller has already computed it.
             
         Returns:
             A strength score from 0 (weakest) to 4 (strongest).
@@ -225,12 +415,10 @@ class PasswordPolicyConfig(Config):
             score += 1
             
         # Character variety bonus
-        has_lower = any(c.islower() for c in password)
-        has_upper = any(c.isupper() for c in password)
-        has_digit = any(c.isdigit() for c in password)
-        has_symbol = not password.isalnum()
+        if char_classes is None:
+            char_classes = _char_classes(password)
         
-        char_variety = sum([has_lower, has_upper, has_digit, has_symbol])
+        char_variety = sum(char_classes)
         if char_variety >= 3:
             score += 1
         if char_variety >= 4:
@@ -19,13 +19,44 @@ Matrix Synapse 用户认证处理器
 这个模块处理用户认证相关的操作，包括登录、注册、密码验证等。
 """
 
-import logging
+import functools
 import hashlib
-import secrets
-from typing import Dict, Any, Optional, Tuple
+import hmac
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+import bcrypt
+
+from twisted.python.threadpool import ThreadPool
+
+from synapse.logging.context import defer_to_threadpool
+from synapse.metrics import register_threadpool
+from synapse.metrics.background_process_metrics import run_as_background_process
+from synapse.util.caches.lrucache import LruCache
+from synapse.util.stringutils import random_token_urlsafe
+
+try:
+    from argon2 import PasswordHasher
+    from argon2.exceptions import InvalidHash, VerificationError
+
+    # 模块级共享实例，参数只解析一次；参数会编码进哈希字符串中
+    _argon2_hasher: Optional[PasswordHasher] = PasswordHasher()
+except ImportError:
+    _argon2_hasher = None
 
 logger = logging.getLogger(__name__)
 
+R = TypeVar("R")
+
+# 访问令牌 -> 用户信息缓存的有效期（秒）和容量。令牌注销、设备删除、
+# 账户停用或修改密码时会主动失效，有效期只是兜底。
+TOKEN_CACHE_TTL_SECONDS = 30
+TOKEN_CACHE_SIZE = 10000
+
+# 访问令牌最后使用时间批量写入数据库的间隔（毫秒）
+LAST_USED_FLUSH_INTERVAL_MS = 10 * 1000
+
 
 class AuthHandler:
     """
@@ -34,12 +65,123 @@ class AuthHandler:
     处理用户认证、注册、登录和访问令牌管理。
     """
     
+    __slots__ = (
+        "hs",
+        "store",
+        "clock",
+        "config",
+        "password_policy",
+        "_bcrypt_rounds",
+        "_token_cache",
+        "_token_keys_by_user",
+        "_pending_last_used",
+        "_hash_threadpool",
+        "_server_name_lower",
+    )
+    
     def __init__(self, hs):
         self.hs = hs
         self.store = hs.get_datastore()
         self.clock = hs.get_clock()
         self.config = hs.config
         self.password_policy = hs.config.password_policy
+        self._bcrypt_rounds = hs.config.registration.bcrypt_rounds
+        self._server_name_lower = hs.hostname.lower() if hs.hostname else None
+        
+        # 密码哈希使用独立的线程池，避免大量并发登录占满 reactor 默认线程池；
+        # 哈希是 CPU 密集型操作，线程数与 CPU 核数一致即可
+        reactor = hs.get_reactor()
+        self._hash_threadpool = ThreadPool(
+            minthreads=1, maxthreads=os.cpu_count() or 1, name="password_hashing"
+        )
+        self._hash_threadpool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", self._hash_threadpool.stop)
+        register_threadpool("password_hashing", self._hash_threadpool)
+        
+        # 令牌摘要 -> (过期时间, 用户信息)
+        self._token_cache: LruCache[bytes, Tuple[float, Dict[str, Any]]] = LruCache(
+            max_size=TOKEN_CACHE_SIZE,
+            cache_name="auth_access_tokens",
+        )
+        # 用户ID -> {令牌摘要: 设备ID}，用于按用户或设备使缓存的令牌失效。
+        # 缓存条目被淘汰或删除时通过回调同步移除
+        self._token_keys_by_user: Dict[str, Dict[bytes, Optional[str]]] = {}
+        
+        # 访问令牌 -> 最近一次使用时间（毫秒），定期批量写入数据库
+        self._pending_last_used: Dict[str, int] = {}
+        self.clock.looping_call(
+            run_as_background_process,
+            LAST_USED_FLUSH_INTERVAL_MS,
+            "auth_handler.flush_last_used",
+            self._flush_last_used,
+        )
+        
+    def _check_password_policy(self, password: str, user_id: str) -> None:
+        """
+        按密码策略校验密码
+        
+        Raises:
+            ValueError: 密码不符合策略
+        """
+        if not self.password_policy:
+            return
+            
+        is_valid, error = self.password_policy.validate_password(
+            password, user_id, server_name_lower=self._server_name_lower
+        )
+        if not is_valid:
+            raise ValueError(error)
+            
+    async def _run_in_hash_threadpool(self, f: Callable[..., R], *args: Any) -> R:
+        """在密码哈希线程池中执行计算密集的密钥派生函数，不阻塞 reactor"""
+        return await defer_to_threadpool(
+            self.hs.get_reactor(), self._hash_threadpool, f, *args
+        )
+        
+    @staticmethod
+    def _token_cache_key(access_token: str) -> bytes:
+        """令牌缓存键，使用摘要避免在内存中保存原始令牌"""
+        return hashlib.blake2b(access_token.encode(), digest_size=16).digest()
+        
+    def _cache_token(self, key: bytes, user_id: str, device_id: Optional[str],
+                     expiry: float, user: Dict[str, Any]) -> None:
+        """缓存令牌的校验结果，并按用户和设备建立索引"""
+        self._token_cache.set(
+            key,
+            (expiry, user),
+            callbacks=[functools.partial(self._unindex_token, user_id, key)],
+        )
+        # 先写缓存再建索引：覆盖已有条目时旧条目的回调会先运行
+        self._token_keys_by_user.setdefault(user_id, {})[key] = device_id
+        
+    def _unindex_token(self, user_id: str, key: bytes) -> None:
+        """缓存条目被移除时，同步移除其索引"""
+        keys = self._token_keys_by_user.get(user_id)
+        if keys is None:
+            return
+        keys.pop(key, None)
+        if not keys:
+            del self._token_keys_by_user[user_id]
+            
+    def invalidate_cached_tokens(self, user_id: str,
+                                 device_id: Optional[str] = None) -> None:
+        """
+        使某个用户（或其某个设备）的令牌缓存失效
+        
+        在绕过 logout_user 删除访问令牌后调用，例如删除设备、停用账户或
+        修改密码。
+        
+        Args:
+            user_id: 用户ID
+            device_id: 设备ID，为None时使该用户的全部令牌失效
+        """
+        keys = self._token_keys_by_user.get(user_id)
+        if not keys:
+            return
+        for key, key_device_id in list(keys.items()):
+            if device_id is None or key_device_id == device_id:
+                # 条目的回调会移除索引
+                self._token_cache.pop(key)
         
     async def check_user_exists(self, user_id: str) -> bool:
         """
@@ -51,24 +193,27 @@ class AuthHandler:
         Returns:
             用户存在返回True，否则返回False
         """
-        logger.debug(f"Checking if user exists: {user_id}")
+        logger.debug("Checking if user exists: %s", user_id)
         user = await self.store.get_user_by_id(user_id)
         return user is not None
         
-    async def validate_password(self, user_id: str, password: str) -> bool:
+    async def validate_password(self, user_id: str, password: str,
+                              user: Optional[Dict[str, Any]] = None) -> bool:
         """
         验证用户密码
         
         Args:
             user_id: 用户ID
             password: 明文密码
+            user: 调用方已查询到的用户记录（可选），提供时不再重复查询
             
         Returns:
             密码正确返回True，否则返回False
         """
-        logger.debug(f"Validating password for user: {user_id}")
+        logger.debug("Validating password for user: %s", user_id)
         
-        user = await self.store.get_user_by_id(user_id)
+        if user is None:
+            user = await self.store.get_user_by_id(user_id)
         if not user:
             return False
             
@@ -76,28 +221,36 @@ class AuthHandler:
         if not stored_hash:
             return False
             
-        return self._verify_password(password, stored_hash)
+        return await self._run_in_hash_threadpool(
+            self._verify_password, password, stored_hash
+        )
         
     def _hash_password(self, password: str) -> str:
         """
         对密码进行哈希处理
         
+        优先使用 Argon2id，argon2-cffi 不可用时回退到 bcrypt。两者都会把
+        盐和计算参数编码进返回的哈希字符串中。
+        
         Args:
             password: 明文密码
             
         Returns:
             密码哈希值
         """
-        # 使用 bcrypt 或类似的安全哈希算法
-        # 这里简化为 SHA256 + salt
-        salt = secrets.token_hex(16)
-        password_hash = hashlib.sha256((password + salt).encode()).hexdigest()
-        return f"sha256${salt}${password_hash}"
+        if _argon2_hasher is not None:
+            return _argon2_hasher.hash(password)
+            
+        return bcrypt.hashpw(
+            password.encode("utf-8"), bcrypt.gensalt(self._bcrypt_rounds)
+        ).decode("ascii")
         
     def _verify_password(self, password: str, stored_hash: str) -> bool:
         """
         验证密码哈希
         
+        支持 Argon2、bcrypt 以及旧版的 ``sha256$salt$hash`` 格式。
+        
         Args:
             password: 明文密码
             stored_hash: 存储的密码哈希
@@ -105,11 +258,29 @@ class AuthHandler:
         Returns:
             密码匹配返回True，否则返回False
         """
+        if stored_hash.startswith("$argon2"):
+            if _argon2_hasher is None:
+                logger.warning("Argon2 password hash found but argon2-cffi is not installed")
+                return False
+            try:
+                return _argon2_hasher.verify(stored_hash, password)
+            except (VerificationError, InvalidHash):
+                return False
+                
+        if stored_hash.startswith("$2"):
+            try:
+                return bcrypt.checkpw(
+                    password.encode("utf-8"), stored_hash.encode("ascii")
+                )
+            except ValueError:
+                return False
+                
+        # 旧版 SHA256 + salt 格式，仅用于校验已有的密码
         try:
             algorithm, salt, hash_value = stored_hash.split("$")
             if algorithm == "sha256":
                 computed_hash = hashlib.sha256((password + salt).encode()).hexdigest()
-                return computed_hash == hash_value
+                return hmac.compare_digest(computed_hash, hash_value)
         except ValueError:
             pass
         return False
@@ -132,18 +303,20 @@ class AuthHandler:
         Raises:
             ValueError: 用户已存在或密码不符合策略
         """
-        logger.info(f"Registering new user: {user_id}")
+        logger.info("Registering new user: %s", user_id)
         
         # 检查用户是否已存在
-        if await self.check_user_exists(user_id):
+        existing_user = await self.store.get_user_by_id(user_id)
+        if existing_user is not None:
             raise ValueError(f"User {user_id} already exists")
             
         # 验证密码策略
-        if self.password_policy:
-            self.password_policy.validate_password(password, user_id)
+        self._check_password_policy(password, user_id)
             
         # 创建密码哈希
-        password_hash = self._hash_password(password)
+        password_hash = await self._run_in_hash_threadpool(
+            self._hash_password, password
+        )
         
         # 存储用户
         creation_ts = self.clock.time_msec()
@@ -158,7 +331,7 @@ class AuthHandler:
         if not success:
             raise RuntimeError("Failed to create user")
             
-        logger.info(f"User {user_id} registered successfully")
+        logger.info("User %s registered successfully", user_id)
         return {
             "user_id": user_id,
             "creation_ts": creation_ts,
@@ -183,10 +356,11 @@ class AuthHandler:
         Raises:
             ValueError: 用户不存在或密码错误
         """
-        logger.info(f"User login attempt: {user_id}")
+        logger.info("User login attempt: %s", user_id)
         
-        # 验证用户和密码
-        if not await self.validate_password(user_id, password):
+        # 验证用户和密码，用户记录只查询一次
+        user = await self.store.get_user_by_id(user_id)
+        if not await self.validate_password(user_id, password, user=user):
             raise ValueError("Invalid username or password")
             
         # 生成访问令牌
@@ -196,21 +370,16 @@ class AuthHandler:
         if not device_id:
             device_id = self._generate_device_id()
             
-        # 存储访问令牌和设备信息
-        await self.store.store_access_token(
+        # 在同一个事务中存储访问令牌和设备信息
+        await self.store.store_login_session(
             user_id=user_id,
             token=access_token,
-            device_id=device_id
-        )
-        
-        await self.store.store_device(
-            user_id=user_id,
             device_id=device_id,
             display_name=device_display_name,
             last_seen=self.clock.time_msec()
         )
         
-        logger.info(f"User {user_id} logged in successfully")
+        logger.info("User %s logged in successfully", user_id)
         return {
             "user_id": user_id,
             "access_token": access_token,
@@ -225,7 +394,7 @@ class AuthHandler:
         Returns:
             访问令牌字符串
         """
-        return f"syt_{secrets.token_urlsafe(32)}"
+        return f"syt_{random_token_urlsafe(32)}"
         
     def _generate_device_id(self) -> str:
         """
@@ -234,7 +403,7 @@ class AuthHandler:
         Returns:
             设备ID字符串
         """
-        return secrets.token_urlsafe(16)
+        return random_token_urlsafe(16)
         
     async def logout_user(self, access_token: str) -> bool:
         """
@@ -246,10 +415,12 @@ class AuthHandler:
         Returns:
             登出成功返回True，否则返回False
         """
-        logger.info(f"User logout with token: {access_token[:10]}...")
+        logger.info("User logout with token: %.10s...", access_token)
         
         # 删除访问令牌
         success = await self.store.delete_access_token(access_token)
+        self._token_cache.pop(self._token_cache_key(access_token))
+        self._pending_last_used.pop(access_token, None)
         
         if success:
             logger.info("User logged out successfully")
@@ -258,6 +429,31 @@ class AuthHandler:
             
         return success
         
+    async def delete_access_tokens_for_user(
+        self,
+        user_id: str,
+        except_token_id: Optional[int] = None,
+        device_id: Optional[str] = None,
+    ) -> List[Tuple[str, int, Optional[str]]]:
+        """
+        删除用户的访问令牌，并使对应的令牌缓存失效
+        
+        Args:
+            user_id: 用户ID
+            except_token_id: 不删除的访问令牌ID
+            device_id: 只删除该设备的令牌，为None时删除全部设备的令牌
+            
+        Returns:
+            被删除令牌的 (令牌, 令牌ID, 设备ID) 列表
+        """
+        deleted = await self.store.user_delete_access_tokens(
+            user_id, except_token_id=except_token_id, device_id=device_id
+        )
+        for access_token, _, _ in deleted:
+            self._token_cache.pop(self._token_cache_key(access_token))
+            self._pending_last_used.pop(access_token, None)
+        return deleted
+        
     async def get_user_by_access_token(self, access_token: str) -> Optional[Dict[str, Any]]:
         """
         根据访问令牌获取用户信息
@@ -268,8 +464,19 @@ class AuthHandler:
         Returns:
             用户信息字典，如果令牌无效则返回None
         """
-        logger.debug(f"Getting user by access token: {access_token[:10]}...")
-        
+        logger.debug("Getting user by access token: %.10s...", access_token)
+        
+        key = self._token_cache_key(access_token)
+        now = self.clock.time()
+        
+        cached = self._token_cache.get(key)
+        if cached is not None:
+            expiry, user = cached
+            if expiry > now:
+                self._mark_token_used(access_token)
+                return user
+            self._token_cache.pop(key)
+            
         token_info = await self.store.get_user_by_access_token(access_token)
         if not token_info:
             return None
@@ -281,13 +488,32 @@ class AuthHandler:
         user = await self.store.get_user_by_id(user_id)
         if user:
             # 更新最后使用时间
-            await self.store.update_access_token_last_used(
-                access_token, 
-                self.clock.time_msec()
+            self._mark_token_used(access_token)
+            self._cache_token(
+                key, user_id, token_info.get("device_id"),
+                now + TOKEN_CACHE_TTL_SECONDS, user,
             )
             
         return user
         
+    def _mark_token_used(self, access_token: str) -> None:
+        """记录令牌的最后使用时间，由 _flush_last_used 批量写入"""
+        self._pending_last_used[access_token] = self.clock.time_msec()
+        
+    async def _flush_last_used(self) -> None:
+        """将累积的令牌最后使用时间批量写入存储"""
+        if not self._pending_last_used:
+            return
+            
+        batch, self._pending_last_used = self._pending_last_used, {}
+        try:
+            await self.store.batch_update_access_token_last_used(batch)
+        except Exception:
+            logger.exception("Failed to flush last-used times for %d tokens", len(batch))
+            # 重新排队，但不覆盖在此期间记录的更新时间
+            for token, last_used in batch.items():
+                self._pending_last_used.setdefault(token, last_used)
+                
     async def change_password(self, user_id: str, old_password: str, 
                             new_password: str) -> bool:
         """
@@ -304,18 +530,19 @@ class AuthHandler:
         Raises:
             ValueError: 旧密码错误或新密码不符合策略
         """
-        logger.info(f"Changing password for user: {user_id}")
+        logger.info("Changing password for user: %s", user_id)
         
         # 验证旧密码
         if not await self.validate_password(user_id, old_password):
             raise ValueError("Invalid old password")
             
         # 验证新密码策略
-        if self.password_policy:
-            self.password_policy.validate_password(new_password, user_id)
+        self._check_password_policy(new_password, user_id)
             
         # 生成新密码哈希
-        new_password_hash = self._hash_password(new_password)
+        new_password_hash = await self._run_in_hash_threadpool(
+            self._hash_password, new_password
+        )
         
         # 更新密码
         success = await self.store.update_user_password(
@@ -324,10 +551,11 @@ class AuthHandler:
         )
         
         if success:
-            logger.info(f"Password changed successfully for user: {user_id}")
+            logger.info("Password changed successfully for user: %s", user_id)
             # 可选：使所有现有访问令牌失效
             await self.store.invalidate_user_access_tokens(user_id)
+            self.invalidate_cached_tokens(user_id)
         else:
-            logger.error(f"Failed to change password for user: {user_id}")
+            logger.error("Failed to change password for user: %s", user_id)
             
         return success
\ No newline at end of file
@@ -20,11 +20,25 @@ Matrix Synapse 设备管理处理器
 """
 
 import logging
-import secrets
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
+
+from synapse.metrics.background_process_metrics import run_as_background_process
+from synapse.util.async_helpers import concurrently_gather_results
+from synapse.util.caches.lrucache import LruCache
+from synapse.util.stringutils import random_token_urlsafe
 
 logger = logging.getLogger(__name__)
 
+# 批量删除设备时的最大并发数，避免瞬间压垮存储层
+DELETE_DEVICES_CONCURRENCY = 16
+
+# 设备信息缓存：同一请求内及短时间内的重复查询直接命中内存
+DEVICE_CACHE_TTL_SECONDS = 5
+DEVICE_CACHE_SIZE = 1024
+
+# 设备最后活跃信息批量写入数据库的间隔（毫秒）
+LAST_SEEN_FLUSH_INTERVAL_MS = 500
+
 
 class DeviceHandler:
     """
@@ -38,6 +52,57 @@ class DeviceHandler:
         self.store = hs.get_datastore()
         self.clock = hs.get_clock()
         self.config = hs.config
+        self._auth_handler = hs.get_auth_handler()
+        
+        # (user_id, device_id) -> (过期时间, 设备信息)
+        self._device_cache: LruCache[
+            Tuple[str, str], Tuple[float, Dict[str, Any]]
+        ] = LruCache(
+            max_size=DEVICE_CACHE_SIZE,
+            cache_name="device_handler_devices",
+        )
+        
+        # (user_id, device_id) -> (最后活跃时间, IP地址, 用户代理)，定期批量写入数据库
+        self._pending_last_seen: Dict[
+            Tuple[str, str], Tuple[int, Optional[str], Optional[str]]
+        ] = {}
+        self.clock.looping_call(
+            run_as_background_process,
+            LAST_SEEN_FLUSH_INTERVAL_MS,
+            "device_handler.flush_last_seen",
+            self._flush_last_seen,
+        )
+        
+    async def _get_device_cached(self, user_id: str,
+                                 device_id: str) -> Optional[Dict[str, Any]]:
+        """
+        获取设备的存储记录，优先使用短期缓存
+        
+        Args:
+            user_id: 用户ID
+            device_id: 设备ID
+            
+        Returns:
+            设备记录，如果设备不存在则返回None
+        """
+        key = (user_id, device_id)
+        now = self.clock.time()
+        
+        cached = self._device_cache.get(key)
+        if cached is not None:
+            expiry, device = cached
+            if expiry > now:
+                return device
+            self._device_cache.pop(key)
+            
+        device = await self.store.get_device(user_id, device_id)
+        if device:
+            self._device_cache.set(key, (now + DEVICE_CACHE_TTL_SECONDS, device))
+        return device
+        
+    def _invalidate_device(self, user_id: str, device_id: str) -> None:
+        """使设备缓存失效，在设备被写入或删除后调用"""
+        self._device_cache.pop((user_id, device_id))
         
     def _generate_device_id(self) -> str:
         """
@@ -46,7 +111,7 @@ class DeviceHandler:
         Returns:
             设备ID字符串
         """
-        return secrets.token_urlsafe(16)
+        return random_token_urlsafe(16)
         
     async def register_device(self, user_id: str, device_id: Optional[str] = None,
                              display_name: Optional[str] = None,
@@ -71,34 +136,27 @@ class DeviceHandler:
         if not device_id:
             device_id = self._generate_device_id()
             
-        # 检查设备是否已存在
-        existing_device = await self.store.get_device(user_id, device_id)
-        if existing_device:
-            # 更新现有设备信息
-            await self.store.update_device(
-                user_id=user_id,
-                device_id=device_id,
-                display_name=display_name,
-                last_seen=self.clock.time_msec(),
-                ip_address=ip_address,
-                user_agent=user_agent
-            )
+        now = self.clock.time_msec()
+        
+        # 一次 UPSERT 完成创建或更新，避免先查询再写入的竞态
+        created = await self.store.upsert_device(
+            user_id=user_id,
+            device_id=device_id,
+            display_name=display_name,
+            last_seen=now,
+            ip_address=ip_address,
+            user_agent=user_agent
+        )
+        self._invalidate_device(user_id, device_id)
+        
+        if created:
+            logger.info(f"Device {device_id} registered for user {user_id}")
         else:
-            # 创建新设备
-            await self.store.create_device(
-                user_id=user_id,
-                device_id=device_id,
-                display_name=display_name,
-                last_seen=self.clock.time_msec(),
-                ip_address=ip_address,
-                user_agent=user_agent
-            )
-            
-        logger.info(f"Device {device_id} registered for user {user_id}")
+            logger.info(f"Device {device_id} of user {user_id} updated on re-registration")
         return {
             "device_id": device_id,
             "display_name": display_name,
-            "last_seen_ts": self.clock.time_msec()
+            "last_seen_ts": now
         }
         
     async def get_device(self, user_id: str, device_id: str) -> Optional[Dict[str, Any]]:
@@ -114,16 +172,13 @@ class DeviceHandler:
         """
         logger.debug(f"Getting device {device_id} for user {user_id}")
         
-        device = await self.store.get_device(user_id, device_id)
+        # 存储层查询时已经使用响应中的字段名作为列别名，无需再逐个字段转换；
+        # 复制一份以免调用方修改缓存中的记录
+        device = await self._get_device_cached(user_id, device_id)
         if not device:
             return None
             
-        return {
-            "device_id": device["device_id"],
-            "display_name": device["display_name"],
-            "last_seen_ts": device["last_seen"],
-            "last_seen_ip": device["ip_address"]
-        }
+        return dict(device)
         
     async def get_user_devices(self, user_id: str) -> List[Dict[str, Any]]:
         """
@@ -137,17 +192,8 @@ class DeviceHandler:
         """
         logger.debug(f"Getting all devices for user {user_id}")
         
-        devices = await self.store.get_user_devices(user_id)
-        
-        return [
-            {
-                "device_id": device["device_id"],
-                "display_name": device["display_name"],
-                "last_seen_ts": device["last_seen"],
-                "last_seen_ip": device["ip_address"]
-            }
-            for device in devices
-        ]
+        # 存储层返回的行已经是响应格式
+        return await self.store.get_user_devices(user_id)
         
     async def update_device(self, user_id: str, device_id: str,
                            display_name: Optional[str] = None) -> bool:
@@ -165,7 +211,7 @@ class DeviceHandler:
         logger.info(f"Updating device {device_id} for user {user_id}")
         
         # 检查设备是否存在
-        device = await self.store.get_device(user_id, device_id)
+        device = await self._get_device_cached(user_id, device_id)
         if not device:
             raise ValueError(f"Device {device_id} not found for user {user_id}")
             
@@ -175,6 +221,7 @@ class DeviceHandler:
             device_id=device_id,
             display_name=display_name
         )
+        self._invalidate_device(user_id, device_id)
         
         if success:
             logger.info(f"Device {device_id} updated successfully")
@@ -196,26 +243,17 @@ class DeviceHandler:
         """
         logger.info(f"Deleting device {device_id} for user {user_id}")
         
-        # 检查设备是否存在
-        device = await self.store.get_device(user_id, device_id)
-        if not device:
+        # 在一个事务中删除访问令牌、加密密钥和设备本身；
+        # 设备不存在时不会删除任何行，据此判断是否找到设备
+        deleted = await self.store.delete_device_cascade(user_id, device_id)
+        self._invalidate_device(user_id, device_id)
+        # 设备的访问令牌已随设备删除，不能再从令牌缓存中通过校验
+        self._auth_handler.invalidate_cached_tokens(user_id, device_id)
+        if not deleted:
             raise ValueError(f"Device {device_id} not found for user {user_id}")
             
-        # 删除设备相关的访问令牌
-        await self.store.delete_access_tokens_for_device(user_id, device_id)
-        
-        # 删除设备的加密密钥
-        await self.store.delete_device_keys(user_id, device_id)
-        
-        # 删除设备
-        success = await self.store.delete_device(user_id, device_id)
-        
-        if success:
-            logger.info(f"Device {device_id} deleted successfully")
-        else:
-            logger.error(f"Failed to delete device {device_id}")
-            
-        return success
+        logger.info(f"Device {device_id} deleted successfully")
+        return True
         
     async def delete_devices(self, user_id: str, device_ids: List[str]) -> Dict[str, bool]:
         """
@@ -230,16 +268,19 @@ class DeviceHandler:
         """
         logger.info(f"Deleting {len(device_ids)} devices for user {user_id}")
         
-        results = {}
-        for device_id in device_ids:
+        async def _delete_one(device_id: str) -> bool:
             try:
-                success = await self.delete_device(user_id, device_id)
-                results[device_id] = success
+                return await self.delete_device(user_id, device_id)
             except Exception as e:
-                logger.error(f"Failed to delete device {device_id}: {e}")
-                results[device_id] = False
-                
-        return results
+                logger.error("Failed to delete device %s: %s", device_id, e)
+                return False
+
+        # 并发删除，总耗时由各设备耗时之和降为最慢的一次
+        outcomes = await concurrently_gather_results(
+            _delete_one, device_ids, DELETE_DEVICES_CONCURRENCY
+        )
+
+        return dict(zip(device_ids, outcomes))
         
     async def upload_device_keys(self, user_id: str, device_id: str,
                                 keys: Dict[str, Any]) -> Dict[str, Any]:
@@ -257,7 +298,7 @@ class DeviceHandler:
         logger.info(f"Uploading keys for device {device_id} of user {user_id}")
         
         # 验证设备存在
-        device = await self.store.get_device(user_id, device_id)
+        device = await self._get_device_cached(user_id, device_id)
         if not device:
             raise ValueError(f"Device {device_id} not found for user {user_id}")
             
@@ -268,20 +309,16 @@ class DeviceHandler:
         # 存储设备密钥
         await self.store.store_device_keys(user_id, device_id, keys)
         
-        # 存储一次性密钥
+        # 存储一次性密钥；存储层在写入的同时统计各算法的密钥数量
         one_time_keys = keys.get("one_time_keys", {})
+        one_time_key_counts: Dict[str, int] = {}
         if one_time_keys:
-            await self.store.store_one_time_keys(
+            one_time_key_counts = await self.store.store_one_time_keys(
                 user_id, device_id, one_time_keys
             )
             
         logger.info(f"Keys uploaded successfully for device {device_id}")
-        return {
-            "one_time_key_counts": {
-                algorithm: len(keys_for_alg)
-                for algorithm, keys_for_alg in one_time_keys.items()
-            }
-        }
+        return {"one_time_key_counts": one_time_key_counts}
         
     def _validate_device_keys(self, keys: Dict[str, Any], 
                              user_id: str, device_id: str) -> bool:
@@ -296,31 +333,25 @@ class DeviceHandler:
         Returns:
             密钥有效返回True，否则返回False
         """
-        try:
-            # 检查必需字段
-            if keys.get("user_id") != user_id:
-                return False
-            if keys.get("device_id") != device_id:
-                return False
-                
-            # 检查算法和密钥
-            algorithms = keys.get("algorithms", [])
-            device_keys = keys.get("keys", {})
-            
-            if not algorithms or not device_keys:
-                return False
-                
-            # 检查签名
-            signatures = keys.get("signatures", {})
-            if user_id not in signatures:
-                return False
-                
-            return True
+        # 按固定顺序逐项检查，先做最便宜的身份比较以便尽早拒绝；
+        # 同时检查各字段的类型，非法输入不会走到异常路径
+        if not isinstance(keys, dict):
+            return False
+        if keys.get("user_id") != user_id or keys.get("device_id") != device_id:
+            return False
             
-        except Exception as e:
-            logger.error(f"Error validating device keys: {e}")
+        # 检查算法和密钥
+        algorithms = keys.get("algorithms")
+        if not algorithms or not isinstance(algorithms, list):
+            return False
+        device_keys = keys.get("keys")
+        if not device_keys or not isinstance(device_keys, dict):
             return False
             
+        # 检查签名
+        signatures = keys.get("signatures")
+        return isinstance(signatures, dict) and user_id in signatures
+        
     async def get_device_keys(self, user_id: str, 
                              device_ids: Optional[List[str]] = None) -> Dict[str, Any]:
         """
@@ -339,12 +370,15 @@ class DeviceHandler:
             # 获取用户所有设备的密钥
             device_keys = await self.store.get_user_device_keys(user_id)
         else:
-            # 获取指定设备的密钥
-            device_keys = {}
-            for device_id in device_ids:
-                keys = await self.store.get_device_keys(user_id, device_id)
-                if keys:
-                    device_keys[device_id] = keys
+            # 一次查询获取指定设备的密钥，只保留存在密钥的设备
+            keys_by_device = await self.store.get_device_keys_multi(
+                user_id, device_ids
+            )
+            device_keys = {
+                device_id: keys
+                for device_id, keys in keys_by_device.items()
+                if keys
+            }
                     
         return {
             user_id: device_keys
@@ -362,22 +396,21 @@ class DeviceHandler:
         """
         logger.debug(f"Claiming one-time keys for {len(key_claims)} users")
         
-        claimed_keys = {}
-        
-        for user_id, device_claims in key_claims.items():
-            user_keys = {}
+        # 展平成 (user_id, device_id, algorithm) 列表，一次性领取所有密钥
+        claims = [
+            (user_id, device_id, algorithm)
+            for user_id, device_claims in key_claims.items()
+            for device_id, algorithm in device_claims.items()
+        ]
+        if not claims:
+            return {"one_time_keys": {}}
             
-            for device_id, algorithm in device_claims.items():
-                # 获取并删除一次性密钥
-                key = await self.store.claim_one_time_key(
-                    user_id, device_id, algorithm
-                )
-                
-                if key:
-                    user_keys[device_id] = {algorithm: key}
-                    
-            if user_keys:
-                claimed_keys[user_id] = user_keys
+        claimed = await self.store.claim_one_time_keys_bulk(claims)
+        
+        claimed_keys: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        for user_id, device_id, algorithm, key in claimed:
+            if key:
+                claimed_keys.setdefault(user_id, {})[device_id] = {algorithm: key}
                 
         return {"one_time_keys": claimed_keys}
         
@@ -387,16 +420,31 @@ class DeviceHandler:
         """
         更新设备最后使用时间
         
+        只记录在内存中，由 _flush_last_seen 定期批量写入；同一设备在一个
+        刷新周期内的多次更新只写入最后一次。
+        
         Args:
             user_id: 用户ID
             device_id: 设备ID
             ip_address: IP地址
             user_agent: 用户代理
         """
-        await self.store.update_device(
-            user_id=user_id,
-            device_id=device_id,
-            last_seen=self.clock.time_msec(),
-            ip_address=ip_address,
-            user_agent=user_agent
+        self._pending_last_seen[(user_id, device_id)] = (
+            self.clock.time_msec(),
+            ip_address,
+            user_agent,
         )
+        
+    async def _flush_last_seen(self) -> None:
+        """将累积的设备最后活跃信息批量写入存储"""
+        if not self._pending_last_seen:
+            return
+            
+        batch, self._pending_last_seen = self._pending_last_seen, {}
+        try:
+            await self.store.update_devices_last_seen_bulk(batch)
+        except Exception:
+            logger.exception("Failed to flush last-seen times for %d devices", len(batch))
+            # 重新排队，但不覆盖在此期间记录的更新
+            for key, last_seen in batch.items():
+                self._pending_last_seen.setdefault(key, last_seen)
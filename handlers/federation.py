@@ -20,10 +20,35 @@ Matrix Synapse 联邦API处理器
 """
 
 import logging
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
+
+from twisted.internet import defer
+
+from synapse.logging.context import make_deferred_yieldable, run_in_background
+from synapse.util.async_helpers import (
+    concurrently_execute,
+    concurrently_gather_results,
+)
+from synapse.util.caches.lrucache import LruCache
+from synapse.util.caches.response_cache import ResponseCache
+from synapse.util.stringutils import random_token_urlsafe
 
 logger = logging.getLogger(__name__)
 
+# 并发校验/存储事件时的最大并发数，避免压垮授权检查和存储层
+EVENT_CONCURRENCY_LIMIT = 32
+
+# 加入远程房间时同时探测的服务器数量上限
+JOIN_PROBE_CONCURRENCY = 4
+
+# 联邦事件必须包含的字段
+_REQUIRED_EVENT_FIELDS = frozenset(
+    ("event_id", "type", "room_id", "sender", "origin_server_ts")
+)
+
+# 最近处理过的入站事件ID数量，用于在不访问数据库的情况下识别重传
+SEEN_EVENTS_CACHE_SIZE = 65536
+
 
 class FederationHandler:
     """
@@ -40,6 +65,22 @@ class FederationHandler:
         self.federation_client = hs.get_federation_client()
         self.event_auth = hs.get_event_auth()
         
+        # 签名字段使用的服务器名和密钥名在进程生命周期内不变，只计算一次
+        self._origin = hs.hostname
+        self._sig_key_name = f"ed25519:{hs.signing_key_id}"
+        
+        # 本进程最近处理过的入站事件ID
+        self._seen_events: LruCache[str, bool] = LruCache(
+            max_size=SEEN_EVENTS_CACHE_SIZE,
+            cache_name="federation_seen_events",
+        )
+        
+        # 正在进行中的联邦读取请求：相同参数的并发调用共享同一个请求，
+        # 请求完成后立即移除，不缓存结果
+        self._inflight_reads: ResponseCache[Tuple[Any, ...]] = ResponseCache(
+            self.clock, "federation_handler_reads"
+        )
+        
     async def send_event_to_server(self, destination: str, event: Dict[str, Any]) -> bool:
         """
         向远程服务器发送事件
@@ -74,6 +115,16 @@ class FederationHandler:
         Returns:
             事件数据，如果获取失败则返回None
         """
+        return await self._inflight_reads.wrap(
+            ("get_event", destination, event_id),
+            self._do_get_event_from_server,
+            destination,
+            event_id,
+        )
+        
+    async def _do_get_event_from_server(self, destination: str,
+                                        event_id: str) -> Optional[Dict[str, Any]]:
+        """get_event_from_server 的实际实现"""
         logger.debug(f"Getting event {event_id} from {destination}")
         
         try:
@@ -103,12 +154,11 @@ class FederationHandler:
             事件有效返回True，否则返回False
         """
         try:
-            # 检查必需字段
-            required_fields = ["event_id", "type", "room_id", "sender", "origin_server_ts"]
-            for field in required_fields:
-                if field not in event:
-                    logger.warning(f"Event missing required field: {field}")
-                    return False
+            # 检查必需字段：键视图的超集比较在 C 层完成，只有失败时才计算缺失字段
+            if not event.keys() >= _REQUIRED_EVENT_FIELDS:
+                missing = sorted(_REQUIRED_EVENT_FIELDS - event.keys())
+                logger.warning("Event missing required fields: %s", missing)
+                return False
                     
             # 验证事件签名和授权
             auth_result = await self.event_auth.check_auth_rules_for_event(event)
@@ -122,6 +172,20 @@ class FederationHandler:
             logger.error(f"Error validating event: {e}")
             return False
             
+    async def _validate_events(self, events: List[Dict[str, Any]]) -> List[bool]:
+        """
+        并发验证一批事件
+        
+        Args:
+            events: 要验证的事件列表
+            
+        Returns:
+            与 events 一一对应的验证结果列表
+        """
+        return await concurrently_gather_results(
+            self._validate_event, events, EVENT_CONCURRENCY_LIMIT
+        )
+        
     async def join_room_via_federation(self, room_id: str, user_id: str,
                                       remote_servers: List[str]) -> Dict[str, Any]:
         """
@@ -137,38 +201,75 @@ class FederationHandler:
         """
         logger.info(f"Joining room {room_id} via federation for user {user_id}")
         
-        for server in remote_servers:
+        # 并发探测各服务器，按响应先后依次尝试加入。探测是只读的，可以安全地
+        # 并发；真正的 make_join/send_join 仍然逐个进行，避免产生多个加入事件。
+        # 每个服务器探测结束后放入一个结果：可用时为服务器名，否则为None。
+        available: "defer.DeferredQueue[Optional[str]]" = defer.DeferredQueue()
+        
+        async def _probe(server: str) -> None:
             try:
-                # 尝试从服务器获取房间信息
                 room_info = await self.federation_client.get_room_state(
                     server, room_id
                 )
-                
-                if room_info:
-                    # 创建加入事件
-                    join_event = await self._create_join_event(
-                        room_id, user_id, server
-                    )
-                    
-                    # 发送加入请求
-                    join_result = await self.federation_client.send_join(
-                        server, room_id, join_event
-                    )
-                    
-                    if join_result:
-                        # 存储房间状态和事件
-                        await self._store_room_state(room_id, join_result["state"])
-                        await self.store.store_event(join_event)
-                        
-                        logger.info(f"Successfully joined room {room_id} via {server}")
-                        return {"room_id": room_id, "server": server}
-                        
             except Exception as e:
                 logger.warning(f"Failed to join room via {server}: {e}")
-                continue
-                
+                room_info = None
+            available.put(server if room_info else None)
+            
+        probes = run_in_background(
+            concurrently_execute, _probe, remote_servers, JOIN_PROBE_CONCURRENCY
+        )
+        
+        try:
+            for _ in remote_servers:
+                server = await make_deferred_yieldable(available.get())
+                if server is None:
+                    continue
+                    
+                if await self._try_join_via(server, room_id, user_id):
+                    logger.info(f"Successfully joined room {room_id} via {server}")
+                    return {"room_id": room_id, "server": server}
+        finally:
+            # 已经成功或全部失败，剩余的探测不再需要
+            probes.addErrback(lambda f: f.trap(defer.CancelledError))
+            probes.cancel()
+            
         raise RuntimeError(f"Failed to join room {room_id} via any server")
         
+    async def _try_join_via(self, server: str, room_id: str, user_id: str) -> bool:
+        """
+        通过指定服务器加入房间
+        
+        Args:
+            server: 远程服务器
+            room_id: 房间ID
+            user_id: 用户ID
+            
+        Returns:
+            加入成功返回True，否则返回False
+        """
+        try:
+            # 创建加入事件
+            join_event = await self._create_join_event(
+                room_id, user_id, server
+            )
+            
+            # 发送加入请求
+            join_result = await self.federation_client.send_join(
+                server, room_id, join_event
+            )
+            
+            if join_result:
+                # 存储房间状态和事件
+                await self._store_room_state(room_id, join_result["state"])
+                await self.store.store_event(join_event)
+                return True
+                
+        except Exception as e:
+            logger.warning(f"Failed to join room via {server}: {e}")
+            
+        return False
+        
     async def _create_join_event(self, room_id: str, user_id: str, 
                                 via_server: str) -> Dict[str, Any]:
         """
@@ -208,9 +309,7 @@ class FederationHandler:
         # 这里应该实现实际的事件签名逻辑
         # 简化实现
         event["signatures"] = {
-            self.hs.hostname: {
-                f"ed25519:{self.hs.signing_key_id}": "signature_placeholder"
-            }
+            self._origin: {self._sig_key_name: "signature_placeholder"}
         }
         
     async def _store_room_state(self, room_id: str, state_events: List[Dict[str, Any]]):
@@ -223,13 +322,20 @@ class FederationHandler:
         """
         logger.debug(f"Storing state for room {room_id}")
         
-        for event in state_events:
-            # 验证事件
-            if await self._validate_event(event):
-                await self.store.store_event(event)
+        valid_flags = await self._validate_events(state_events)
+        
+        valid_events = []
+        for event, valid in zip(state_events, valid_flags):
+            if valid:
+                valid_events.append(event)
             else:
                 logger.warning(f"Skipping invalid state event: {event.get('event_id')}")
                 
+        # 状态事件之间没有因果顺序要求，可以并发存储
+        await concurrently_execute(
+            self.store.store_event, valid_events, EVENT_CONCURRENCY_LIMIT
+        )
+                
     async def invite_user_to_room(self, room_id: str, inviter_id: str,
                                  invitee_id: str) -> Dict[str, Any]:
         """
@@ -307,8 +413,7 @@ class FederationHandler:
         Returns:
             事件ID本地部分
         """
-        import secrets
-        return secrets.token_urlsafe(32)
+        return random_token_urlsafe(32)
         
     async def get_room_state_from_server(self, destination: str, 
                                        room_id: str) -> Optional[List[Dict[str, Any]]]:
@@ -322,6 +427,17 @@ class FederationHandler:
         Returns:
             房间状态事件列表，如果获取失败则返回None
         """
+        return await self._inflight_reads.wrap(
+            ("room_state", destination, room_id),
+            self._do_get_room_state_from_server,
+            destination,
+            room_id,
+        )
+        
+    async def _do_get_room_state_from_server(
+        self, destination: str, room_id: str
+    ) -> Optional[List[Dict[str, Any]]]:
+        """get_room_state_from_server 的实际实现"""
         logger.debug(f"Getting room state for {room_id} from {destination}")
         
         try:
@@ -329,10 +445,12 @@ class FederationHandler:
                 destination, room_id
             )
             
-            # 验证所有状态事件
+            # 并发验证所有状态事件
+            valid_flags = await self._validate_events(state_events)
+            
             validated_events = []
-            for event in state_events:
-                if await self._validate_event(event):
+            for event, valid in zip(state_events, valid_flags):
+                if valid:
                     validated_events.append(event)
                 else:
                     logger.warning(f"Invalid state event from {destination}: {event.get('event_id')}")
@@ -356,6 +474,17 @@ class FederationHandler:
         Returns:
             历史事件列表
         """
+        return await self._inflight_reads.wrap(
+            ("backfill", destination, room_id, limit),
+            self._do_backfill_events,
+            destination,
+            room_id,
+            limit,
+        )
+        
+    async def _do_backfill_events(self, destination: str, room_id: str,
+                                  limit: int) -> List[Dict[str, Any]]:
+        """backfill_events 的实际实现"""
         logger.info(f"Backfilling events for room {room_id} from {destination}")
         
         try:
@@ -363,15 +492,19 @@ class FederationHandler:
                 destination, room_id, limit
             )
             
-            # 验证和存储事件
+            # 并发验证，然后按原顺序一次性批量存储，保持历史事件的因果顺序
+            valid_flags = await self._validate_events(events)
+            
             stored_events = []
-            for event in events:
-                if await self._validate_event(event):
-                    await self.store.store_event(event)
+            for event, valid in zip(events, valid_flags):
+                if valid:
                     stored_events.append(event)
                 else:
                     logger.warning(f"Invalid backfilled event: {event.get('event_id')}")
                     
+            if stored_events:
+                await self.store.store_events(stored_events)
+                
             logger.info(f"Backfilled {len(stored_events)} events for room {room_id}")
             return stored_events
             
@@ -399,19 +532,28 @@ class FederationHandler:
                 logger.warning(f"Event origin mismatch: {event.get('origin')} != {origin}")
                 return False
                 
+            # 远程服务器重传的事件直接命中内存，不再做授权检查和数据库查询
+            event_id = event.get("event_id")
+            if event_id and self._seen_events.get(event_id):
+                logger.debug(f"Event {event_id} already processed")
+                return True
+                
             # 验证事件
             if not await self._validate_event(event):
                 logger.warning(f"Invalid incoming event from {origin}")
                 return False
                 
-            # 检查是否已经处理过这个事件
+            # 检查是否已经处理过这个事件；缓存未命中不代表事件是新的
+            # （例如重启前或其他进程存储的事件），所以仍需查询数据库
             existing_event = await self.store.get_event_by_id(event["event_id"])
             if existing_event:
+                self._seen_events.set(event["event_id"], True)
                 logger.debug(f"Event {event['event_id']} already processed")
                 return True
                 
             # 存储事件
             await self.store.store_event(event)
+            self._seen_events.set(event["event_id"], True)
             
             logger.debug(f"Successfully processed incoming event {event['event_id']}")
             return True
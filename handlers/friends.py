@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import logging
+import re
 import time
 from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Any
 
@@ -23,7 +24,9 @@ from synapse.api.errors import (
     SynapseError,
 )
 from synapse.types import JsonDict, Requester, UserID
+from synapse.util.async_helpers import concurrently_gather_results
 from synapse.util.caches.descriptors import cached
+from synapse.util.caches.lrucache import LruCache
 from synapse.util.stringutils import random_string
 
 if TYPE_CHECKING:
@@ -40,6 +43,18 @@ FRIEND_REQUEST_REJECTED = "rejected"
 FRIEND_STATUS_ACTIVE = "active"
 FRIEND_STATUS_BLOCKED = "blocked"
 
+# 内存速率限制最多跟踪的用户数，超出时淘汰最久未发送请求的用户
+RATE_LIMIT_MAX_USERS = 100000
+
+# 并发获取远程用户资料的最大数量
+REMOTE_PROFILE_CONCURRENCY = 10
+
+# Matrix 用户ID：@localpart:server_name，server_name 为域名、IPv4 或
+# [IPv6] 地址，可以带端口
+_MXID_RE = re.compile(
+    r"@[^:]+:(?:\[[0-9A-Fa-f:.]+\]|[A-Za-z0-9.\-]+)(?::[0-9]{1,5})?"
+)
+
 
 class FriendsHandler:
     """处理好友关系管理的业务逻辑
@@ -61,32 +76,42 @@ class FriendsHandler:
         self._max_requests_per_hour = self.config.max_requests_per_hour
         self._rate_limit_window = self.config.rate_limit_window
         
+        # 用户ID -> (上一窗口请求数, 当前窗口请求数, 当前窗口序号)。
+        # 按最近访问排序，最先被淘汰的用户窗口也最旧，通常已经完全过期。
+        # Redis 失败时也会回退到这里，所以总是创建。
+        self._rate_limit_cache: LruCache[str, Tuple[int, int, int]] = LruCache(
+            max_size=RATE_LIMIT_MAX_USERS,
+            cache_name="friend_request_rate_limit",
+        )
+        
         # 使用Redis或内存缓存进行速率限制
         if hasattr(hs, 'get_redis_client') and hs.config.redis.redis_enabled:
             self._redis_client = hs.get_redis_client()
             self._use_redis_rate_limit = True
         else:
-            self._rate_limit_cache: Dict[str, List[float]] = {}
             self._use_redis_rate_limit = False
     
     async def _check_rate_limit(self, user_id: str) -> None:
         """检查用户是否超过速率限制"""
-        current_time = time.time()
-        
         if self._use_redis_rate_limit and hasattr(self, '_redis_client'):
-            # 使用Redis进行分布式速率限制
-            await self._check_rate_limit_redis(user_id, current_time)
+            # 使用Redis进行分布式速率限制，各进程共享的分数必须使用墙上时间
+            await self._check_rate_limit_redis(user_id, time.time())
         else:
             # 使用内存缓存（仅适用于单进程部署）
-            self._check_rate_limit_memory(user_id, current_time)
+            self._check_rate_limit_memory(user_id, time.monotonic())
     
     async def _check_rate_limit_redis(self, user_id: str, current_time: float) -> None:
-        """使用Redis进行速率限制检查"""
+        """使用Redis进行速率限制检查
+        
+        所有工作进程共享同一个 sorted set，清理、计数、记录和续期放在一个
+        MULTI/EXEC 事务中，一次往返完成。
+        """
+        redis_key = f"friend_request_rate_limit:{user_id}"
+        # 同一时刻的多个请求需要不同的成员，否则会被合并为一条记录
+        member = f"{current_time}:{random_string(8)}"
+        
         try:
-            redis_key = f"friend_request_rate_limit:{user_id}"
-            
-            # 使用Redis的sorted set来存储请求时间戳
-            pipeline = self._redis_client.pipeline()
+            pipeline = self._redis_client.pipeline(transaction=True)
             
             # 清理过期的请求记录
             pipeline.zremrangebyscore(redis_key, 0, current_time - self._rate_limit_window)
@@ -95,40 +120,61 @@ class FriendsHandler:
             pipeline.zcard(redis_key)
             
             # 添加当前请求
-            pipeline.zadd(redis_key, {str(current_time): current_time})
+            pipeline.zadd(redis_key, {member: current_time})
             
             # 设置过期时间
             pipeline.expire(redis_key, self._rate_limit_window)
             
             results = await pipeline.execute()
-            
             current_count = results[1]
-            
-            if current_count >= self._max_requests_per_hour:
-                raise SynapseError(
-                    429, 
-                    f"Rate limit exceeded. Maximum {self._max_requests_per_hour} friend requests per hour.",
-                    Codes.LIMIT_EXCEEDED
-                )
                 
         except Exception as e:
-            logger.error(f"Redis rate limit check failed for user {user_id}: {e}")
+            logger.error("Redis rate limit check failed for user %s: %s", user_id, e)
             # 如果Redis失败，回退到内存限制
-            self._check_rate_limit_memory(user_id, current_time)
+            self._check_rate_limit_memory(user_id, time.monotonic())
+            return
+            
+        # 在 try 之外抛出，避免超限错误被当成 Redis 故障而回退到内存限制
+        if current_count >= self._max_requests_per_hour:
+            # 被拒绝的请求不计入配额
+            try:
+                await self._redis_client.zrem(redis_key, member)
+            except Exception as e:
+                logger.warning(
+                    "Failed to drop rejected request for user %s: %s",
+                    user_id,
+                    e,
+                )
+            raise SynapseError(
+                429, 
+                f"Rate limit exceeded. Maximum {self._max_requests_per_hour} friend requests per hour.",
+                Codes.LIMIT_EXCEEDED
+            )
     
     def _check_rate_limit_memory(self, user_id: str, current_time: float) -> None:
-        """使用内存缓存进行速率限制检查"""
-        if user_id not in self._rate_limit_cache:
-            self._rate_limit_cache[user_id] = []
-            
-        # 清理过期的请求记录
-        self._rate_limit_cache[user_id] = [
-            timestamp for timestamp in self._rate_limit_cache[user_id]
-            if current_time - timestamp < self._rate_limit_window
-        ]
+        """使用内存缓存进行速率限制检查
         
+        采用滑动窗口计数器：每个用户只保存上一窗口和当前窗口的请求数，
+        按当前窗口已经过去的比例对上一窗口的计数加权，估算最近一个
+        窗口长度内的请求数。
+        
+        current_time 使用 time.monotonic()，系统时间被回拨时窗口不会错乱。
+        """
+        window = self._rate_limit_window
+        window_index = int(current_time // window)
+        
+        prev_count, curr_count, stored_index = self._rate_limit_cache.get(
+            user_id, (0, 0, window_index)
+        )
+        if stored_index != window_index:
+            # 进入新窗口：紧邻的上一窗口计数保留用于加权，更早的直接清零
+            prev_count = curr_count if stored_index == window_index - 1 else 0
+            curr_count = 0
+            
         # 检查是否超过限制
-        if len(self._rate_limit_cache[user_id]) >= self._max_requests_per_hour:
+        elapsed_fraction = (current_time - window_index * window) / window
+        estimated = curr_count + prev_count * (1 - elapsed_fraction)
+        if estimated >= self._max_requests_per_hour:
             raise SynapseError(
                 429, 
                 f"Rate limit exceeded. Maximum {self._max_requests_per_hour} friend requests per hour.",
@@ -136,7 +182,7 @@ class FriendsHandler:
             )
             
         # 记录当前请求
-        self._rate_limit_cache[user_id].append(current_time)
+        self._rate_limit_cache.set(user_id, (prev_count, curr_count + 1, window_index))
         
     def _validate_user_id(self, user_id: str) -> None:
         """验证用户ID格式"""
@@ -144,9 +190,54 @@ class FriendsHandler:
             raise SynapseError(400, "Invalid user ID", Codes.INVALID_PARAM)
         if len(user_id) > 255:  # 防止过长的用户ID
             raise SynapseError(400, "User ID too long", Codes.INVALID_PARAM)
-        if user_id.startswith('@') and ':' not in user_id:
+        if not _MXID_RE.fullmatch(user_id):
             raise SynapseError(400, "Invalid user ID format", Codes.INVALID_PARAM)
 
+    async def _get_profiles(self, user_ids: List[str]) -> Dict[str, JsonDict]:
+        """批量获取用户资料
+        
+        本地用户的资料通过一次数据库查询获取；远程用户需要走联邦，
+        并发获取。获取失败或没有资料的用户使用空的资料。
+        
+        Args:
+            user_ids: 用户ID列表
+            
+        Returns:
+            用户ID到 {"displayname", "avatar_url"} 的映射，包含所有传入的用户
+        """
+        local_ids = []
+        remote_ids = []
+        for user_id in set(user_ids):
+            try:
+                is_local = self._is_mine_server_name(UserID.from_string(user_id).domain)
+            except SynapseError:
+                is_local = False
+            (local_ids if is_local else remote_ids).append(user_id)
+            
+        profiles: Dict[str, JsonDict] = {}
+        if local_ids:
+            profiles.update(await self.store.get_profiles_batch(local_ids))
+            
+        async def _get_remote_profile(user_id: str) -> Optional[JsonDict]:
+            try:
+                return await self.profile_handler.get_profile(user_id)
+            except Exception as e:
+                logger.warning("Failed to get profile for %s: %s", user_id, e)
+                return None
+                
+        if remote_ids:
+            remote_profiles = await concurrently_gather_results(
+                _get_remote_profile, remote_ids, REMOTE_PROFILE_CONCURRENCY
+            )
+            for user_id, profile in zip(remote_ids, remote_profiles):
+                if profile is not None:
+                    profiles[user_id] = profile
+                    
+        empty_profile = {"displayname": None, "avatar_url": None}
+        return {
+            user_id: profiles.get(user_id, empty_profile) for user_id in user_ids
+        }
+
     async def send_friend_request(
         self, requester: Requester, target_user_id: str, message: Optional[str] = None
     ) -> JsonDict:
@@ -164,70 +255,78 @@ class FriendsHandler:
             SynapseError: 如果用户已经是好友或已有待处理请求
         """
         sender_user_id = requester.user.to_string()
-        logger.info(f"User {sender_user_id} sending friend request to {target_user_id}")
+        logger.info(
+            "User %s sending friend request to %s",
+            sender_user_id,
+            target_user_id,
+        )
         
-        try:
-            # 验证输入
-            self._validate_user_id(sender_user_id)
-            self._validate_user_id(target_user_id)
-            
-            # 检查速率限制
-            self._check_rate_limit(sender_user_id)
-            
-            # 验证目标用户ID格式
-            if not UserID.is_valid(target_user_id):
-                logger.warning(f"Invalid target user ID format: {target_user_id}")
-                raise SynapseError(400, "Invalid user ID", Codes.INVALID_PARAM)
-                
-            target_user = UserID.from_string(target_user_id)
-            
-            # 不能向自己发送好友请求
-            if sender_user_id == target_user_id:
-                logger.warning(f"User {sender_user_id} attempted to send friend request to self")
-                raise SynapseError(400, "Cannot send friend request to yourself", Codes.INVALID_PARAM)
-                
-            # 检查是否被屏蔽
-            is_blocked = await self.store.is_user_blocked(target_user_id, sender_user_id)
-            if is_blocked:
-                logger.warning(f"User {sender_user_id} is blocked by {target_user_id}")
-                raise SynapseError(403, "Cannot send friend request to this user", Codes.FORBIDDEN)
-                
-            # 检查是否已经是好友
-            existing_friendship = await self.store.get_friendship(
-                sender_user_id, target_user_id
+        # 验证输入
+        self._validate_user_id(sender_user_id)
+        self._validate_user_id(target_user_id)
+        
+        # 不能向自己发送好友请求，放在速率限制之前，无效请求不占用配额
+        if sender_user_id == target_user_id:
+            logger.warning(
+                "User %s attempted to send friend request to self",
+                sender_user_id,
             )
-            if existing_friendship:
-                logger.warning(f"Users {sender_user_id} and {target_user_id} are already friends")
-                raise SynapseError(400, "Users are already friends", Codes.INVALID_PARAM)
-                
-            # 检查是否已有待处理的请求
-            existing_request = await self.store.get_friend_request(
-                sender_user_id, target_user_id
+            raise SynapseError(400, "Cannot send friend request to yourself", Codes.INVALID_PARAM)
+            
+        # 检查速率限制
+        await self._check_rate_limit(sender_user_id)
+        
+        # 屏蔽、好友关系和待处理请求在一次查询中检查
+        (
+            is_blocked,
+            is_friend,
+            has_pending_request,
+        ) = await self.store.get_friend_precheck(sender_user_id, target_user_id)
+        
+        # 检查是否被屏蔽
+        if is_blocked:
+            logger.warning("User %s is blocked by %s", sender_user_id, target_user_id)
+            raise SynapseError(403, "Cannot send friend request to this user", Codes.FORBIDDEN)
+            
+        # 检查是否已经是好友
+        if is_friend:
+            logger.warning(
+                "Users %s and %s are already friends",
+                sender_user_id,
+                target_user_id,
             )
-            if existing_request and existing_request["status"] == FRIEND_REQUEST_PENDING:
-                logger.warning(f"Pending friend request already exists from {sender_user_id} to {target_user_id}")
-                raise SynapseError(400, "Friend request already pending", Codes.INVALID_PARAM)
-                
-            # 创建好友请求
-            request_id = await self.store.create_friend_request(
-                sender_user_id=sender_user_id,
-                target_user_id=target_user_id,
-                message=message,
-                created_ts=self.clock.time_msec(),
+            raise SynapseError(400, "Users are already friends", Codes.INVALID_PARAM)
+            
+        # 检查是否已有待处理的请求
+        if has_pending_request:
+            logger.warning(
+                "Pending friend request already exists from %s to %s",
+                sender_user_id,
+                target_user_id,
             )
-            
-            logger.info(f"Friend request {request_id} created successfully from {sender_user_id} to {target_user_id}")
-            
-            return {
-                "request_id": request_id,
-                "status": FRIEND_REQUEST_PENDING,
-                "created_ts": self.clock.time_msec(),
-            }
-        except SynapseError:
-            raise
-        except Exception as e:
-            logger.error(f"Unexpected error in send_friend_request: {e}")
-            raise SynapseError(500, "Internal server error", Codes.UNKNOWN)
+            raise SynapseError(400, "Friend request already pending", Codes.INVALID_PARAM)
+            
+        # 创建好友请求
+        now = self.clock.time_msec()
+        request_id = await self.store.create_friend_request(
+            sender_user_id=sender_user_id,
+            target_user_id=target_user_id,
+            message=message,
+            created_ts=now,
+        )
+        
+        logger.info(
+            "Friend request %s created successfully from %s to %s",
+            request_id,
+            sender_user_id,
+            target_user_id,
+        )
+        
+        return {
+            "request_id": request_id,
+            "status": FRIEND_REQUEST_PENDING,
+            "created_ts": now,
+        }
 
     async def respond_to_friend_request(
         self, requester: Requester, request_id: str, accept: bool
@@ -248,54 +347,68 @@ class FriendsHandler:
         """
         user_id = requester.user.to_string()
         action = "accepting" if accept else "rejecting"
-        logger.info(f"User {user_id} {action} friend request {request_id}")
+        logger.info("User %s %s friend request %s", user_id, action, request_id)
         
-        try:
-            # 获取好友请求
-            friend_request = await self.store.get_friend_request_by_id(request_id)
-            if not friend_request:
-                logger.warning(f"Friend request {request_id} not found")
-                raise NotFoundError("Friend request not found")
-                
-            # 验证用户权限（只有目标用户可以响应请求）
-            if friend_request["target_user_id"] != user_id:
-                logger.warning(f"User {user_id} attempted to respond to request {request_id} not sent to them")
-                raise AuthError(403, "You can only respond to requests sent to you")
-                
-            # 检查请求状态
-            if friend_request["status"] != FRIEND_REQUEST_PENDING:
-                logger.warning(f"Friend request {request_id} is no longer pending (status: {friend_request['status']})")
+        # 获取好友请求
+        friend_request = await self.store.get_friend_request_by_id(request_id)
+        if not friend_request:
+            logger.warning("Friend request %s not found", request_id)
+            raise NotFoundError("Friend request not found")
+            
+        # 验证用户权限（只有目标用户可以响应请求）
+        if friend_request["target_user_id"] != user_id:
+            logger.warning(
+                "User %s attempted to respond to request %s not sent to them",
+                user_id,
+                request_id,
+            )
+            raise AuthError(403, "You can only respond to requests sent to you")
+            
+        # 检查请求状态
+        if friend_request["status"] != FRIEND_REQUEST_PENDING:
+            logger.warning(
+                "Friend request %s is no longer pending (status: %s)",
+                request_id,
+                friend_request["status"],
+            )
+            raise SynapseError(400, "Friend request is no longer pending", Codes.INVALID_PARAM)
+            
+        new_status = FRIEND_REQUEST_ACCEPTED if accept else FRIEND_REQUEST_REJECTED
+        now = self.clock.time_msec()
+        
+        if accept:
+            # 更新请求状态并创建好友关系，在同一个事务中完成
+            accepted = await self.store.accept_friend_request(
+                request_id,
+                friend_request["sender_user_id"],
+                friend_request["target_user_id"],
+                now,
+            )
+            if not accepted:
+                # 请求在读取之后已被其他请求处理
                 raise SynapseError(400, "Friend request is no longer pending", Codes.INVALID_PARAM)
                 
-            # 更新请求状态
-            new_status = FRIEND_REQUEST_ACCEPTED if accept else FRIEND_REQUEST_REJECTED
+            # 清除双方的好友列表缓存
+            self._get_friends_list_by_uid.invalidate(
+                (friend_request["sender_user_id"],)
+            )
+            self._get_friends_list_by_uid.invalidate((user_id,))
+            logger.info(
+                "Friendship created between %s and %s",
+                friend_request["sender_user_id"],
+                friend_request["target_user_id"],
+            )
+        else:
             await self.store.update_friend_request_status(
-                request_id, new_status, self.clock.time_msec()
+                request_id, new_status, now
             )
+            logger.info("Friend request %s rejected by %s", request_id, user_id)
             
-            # 如果接受请求，创建好友关系
-            if accept:
-                await self.store.create_friendship(
-                    user1_id=friend_request["sender_user_id"],
-                    user2_id=friend_request["target_user_id"],
-                    created_ts=self.clock.time_msec(),
-                )
-                # 清除缓存
-                self.get_friends_list.invalidate((requester,))
-                logger.info(f"Friendship created between {friend_request['sender_user_id']} and {friend_request['target_user_id']}")
-            else:
-                logger.info(f"Friend request {request_id} rejected by {user_id}")
-                
-            return {
-                "request_id": request_id,
-                "status": new_status,
-                "accepted": accept,
-            }
-        except (NotFoundError, AuthError, SynapseError):
-            raise
-        except Exception as e:
-            logger.error(f"Unexpected error in respond_to_friend_request: {e}")
-            raise SynapseError(500, "Internal server error", Codes.UNKNOWN)
+        return {
+            "request_id": request_id,
+            "status": new_status,
+            "accepted": accept,
+        }
 
     async def get_friend_requests(
         self, requester: Requester, direction: str = "received"
@@ -318,28 +431,16 @@ class FriendsHandler:
         else:
             raise SynapseError(400, "Invalid direction parameter", Codes.INVALID_PARAM)
             
-        # 为每个请求添加用户信息
-        enriched_requests = []
+        # 为每个请求添加对方用户的基本信息，资料一次性批量获取
+        other_key = "target_user_id" if direction == "sent" else "sender_user_id"
+        profiles = await self._get_profiles(
+            [request[other_key] for request in requests]
+        )
         for request in requests:
-            # 获取对方用户的基本信息
-            other_user_id = (
-                request["target_user_id"] if direction == "sent" 
-                else request["sender_user_id"]
-            )
-            try:
-                profile = await self.profile_handler.get_profile(other_user_id)
-                request["user_profile"] = profile
-            except Exception:
-                # 如果获取用户信息失败，使用默认值
-                request["user_profile"] = {
-                    "displayname": None,
-                    "avatar_url": None,
-                }
-            enriched_requests.append(request)
-            
-        return enriched_requests
+            request["user_profile"] = profiles[request[other_key]]
+            
+        return requests
 
-    @cached()
     async def get_friends_list(self, requester: Requester) -> List[JsonDict]:
         """获取好友列表
         
@@ -349,43 +450,41 @@ class FriendsHandler:
         Returns:
             好友列表，包含用户信息
         """
-        user_id = requester.user.to_string()
+        return await self._get_friends_list_by_uid(requester.user.to_string())
+
+    @cached(num_args=1)
+    async def _get_friends_list_by_uid(self, user_id: str) -> List[JsonDict]:
+        """按用户ID获取好友列表
         
+        缓存以用户ID字符串为键，每次请求的 Requester 都是新对象，
+        不能作为缓存键。缓存未命中时，同一用户的并发请求会等待同一个
+        进行中的查询（DeferredCache 会保存未完成的 Deferred），不需要
+        再额外做请求合并。
+        
+        Args:
+            user_id: 用户ID
+            
+        Returns:
+            好友列表，包含用户信息
+        """
         # 获取好友关系
         friendships = await self.store.get_user_friendships(user_id)
         
-        # 为每个好友添加详细信息
-        friends_list = []
-        for friendship in friendships:
-            friend_user_id = (
-                friendship["user2_id"] if friendship["user1_id"] == user_id
-                else friendship["user1_id"]
-            )
-            
-            try:
-                # 获取好友的个人资料
-                profile = await self.profile_handler.get_profile(friend_user_id)
-                friend_info = {
-                    "user_id": friend_user_id,
-                    "displayname": profile.get("displayname"),
-                    "avatar_url": profile.get("avatar_url"),
-                    "friendship_created_ts": friendship["created_ts"],
-                    "status": friendship["status"],
-                }
-                friends_list.append(friend_info)
-            except Exception as e:
-                logger.warning(f"Failed to get profile for friend {friend_user_id}: {e}")
-                # 即使获取资料失败，也要包含基本信息
-                friend_info = {
-                    "user_id": friend_user_id,
-                    "displayname": None,
-                    "avatar_url": None,
-                    "friendship_created_ts": friendship["created_ts"],
-                    "status": friendship["status"],
-                }
-                friends_list.append(friend_info)
-                
-        return friends_list
+        # 一次性获取所有好友的资料
+        profiles = await self._get_profiles(
+            [friendship["friend_id"] for friendship in friendships]
+        )
+        
+        return [
+            {
+                "user_id": friendship["friend_id"],
+                "displayname": profiles[friendship["friend_id"]].get("displayname"),
+                "avatar_url": profiles[friendship["friend_id"]].get("avatar_url"),
+                "friendship_created_ts": friendship["created_ts"],
+                "status": friendship["status"],
+            }
+            for friendship in friendships
+        ]
 
     async def remove_friend(
         self, requester: Requester, friend_user_id: str
@@ -416,8 +515,9 @@ class FriendsHandler:
         # 删除好友关系
         await self.store.remove_friendship(user_id, friend_user_id)
         
-        # 清除缓存
-        self.get_friends_list.invalidate((requester,))
+        # 清除双方的好友列表缓存
+        self._get_friends_list_by_uid.invalidate((user_id,))
+        self._get_friends_list_by_uid.invalidate((friend_user_id,))
         
         return {
             "removed": True,
@@ -444,27 +544,18 @@ class FriendsHandler:
             user_id, search_term, limit
         )
         
-        # 为搜索结果添加好友状态信息
-        enriched_results = []
-        for user in search_results.get("results", []):
-            result_user_id = user["user_id"]
-            
-            # 检查是否已经是好友
-            friendship = await self.store.get_friendship(user_id, result_user_id)
-            is_friend = friendship is not None
-            
-            # 检查是否有待处理的好友请求
-            pending_request = await self.store.get_friend_request(user_id, result_user_id)
-            has_pending_request = (
-                pending_request is not None and 
-                pending_request["status"] == FRIEND_REQUEST_PENDING
-            )
-            
+        # 为搜索结果添加好友状态信息，一次查询得到所有结果用户的状态
+        results = search_results.get("results", [])
+        statuses = await self.store.get_friendship_and_request_bulk(
+            user_id, [user["user_id"] for user in results]
+        )
+        
+        for user in results:
+            is_friend, has_pending_request = statuses[user["user_id"]]
             user["is_friend"] = is_friend
             user["has_pending_request"] = has_pending_request
-            enriched_results.append(user)
             
-        return enriched_results
+        return results
 
     async def block_user(
         self, requester: Requester, target_user_id: str
@@ -488,17 +579,15 @@ class FriendsHandler:
         if user_id == target_user_id:
             raise SynapseError(400, "Cannot block yourself", Codes.INVALID_PARAM)
             
-        # 如果存在好友关系，先删除
-        friendship = await self.store.get_friendship(user_id, target_user_id)
-        if friendship:
-            await self.store.remove_friendship(user_id, target_user_id)
-            
-        # 创建屏蔽关系
-        await self.store.create_user_block(
+        # 删除好友关系并创建屏蔽关系，在同一个事务中完成
+        friendship_removed = await self.store.block_user_atomic(
             blocker_user_id=user_id,
             blocked_user_id=target_user_id,
             created_ts=self.clock.time_msec(),
         )
+        if friendship_removed:
+            self._get_friends_list_by_uid.invalidate((user_id,))
+            self._get_friends_list_by_uid.invalidate((target_user_id,))
         
         return {
             "blocked": True,
@@ -550,28 +639,17 @@ class FriendsHandler:
         # 获取屏蔽关系
         blocks = await self.store.get_user_blocks(user_id)
         
-        # 为每个被屏蔽用户添加基本信息
-        blocked_users = []
-        for block in blocks:
-            blocked_user_id = block["blocked_user_id"]
-            
-            try:
-                profile = await self.profile_handler.get_profile(blocked_user_id)
-                user_info = {
-                    "user_id": blocked_user_id,
-                    "displayname": profile.get("displayname"),
-                    "avatar_url": profile.get("avatar_url"),
-                    "blocked_ts": block["created_ts"],
-                }
-                blocked_users.append(user_info)
-            except Exception as e:
-                logger.warning(f"Failed to get profile for blocked user {blocked_user_id}: {e}")
-                user_info = {
-                    "user_id": blocked_user_id,
-                    "displayname": None,
-                    "avatar_url": None,
-                    "blocked_ts": block["created_ts"],
-                }
-                blocked_users.append(user_info)
-                
-        return blocked_users
\ No newline at end of file
+        # 为每个被屏蔽用户添加基本信息，资料一次性批量获取
+        profiles = await self._get_profiles(
+            [block["blocked_user_id"] for block in blocks]
+        )
+        
+        return [
+            {
+                "user_id": block["blocked_user_id"],
+                "displayname": profiles[block["blocked_user_id"]].get("displayname"),
+                "avatar_url": profiles[block["blocked_user_id"]].get("avatar_url"),
+                "blocked_ts": block["created_ts"],
+            }
+            for block in blocks
+        ]
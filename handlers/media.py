@@ -19,15 +19,166 @@ Matrix Synapse 媒体处理器
 这个模块处理媒体文件的上传、下载、缩略图生成等操作。
 """
 
+import functools
 import logging
 import os
+import shutil
+import threading
 import hashlib
 import mimetypes
-from typing import Dict, Any, Optional, Tuple, IO
+from enum import Enum, auto
+from io import BytesIO
+from typing import Dict, Any, Iterable, Optional, Tuple, IO, Union
 from urllib.parse import quote
 
+from synapse.logging.context import defer_to_thread
+from synapse.media._base import _can_encode_filename_as_token
+from synapse.media.thumbnailer import ThumbnailError, Thumbnailer
+from synapse.util.caches.lrucache import LruCache
+from synapse.util.caches.response_cache import ResponseCache
+from synapse.util.caches.treecache import TreeCache
+from synapse.util.stringutils import random_token_urlsafe
+
 logger = logging.getLogger(__name__)
 
+# 支持的媒体类型
+ALLOWED_MEDIA_TYPES = frozenset({
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp',
+    'video/mp4', 'video/webm', 'video/ogg',
+    'audio/mp3', 'audio/ogg', 'audio/wav', 'audio/flac',
+    'application/pdf', 'text/plain'
+})
+
+
+class MediaKind(Enum):
+    """媒体的大类，决定上传后的处理方式"""
+
+    IMAGE = auto()
+    VIDEO = auto()
+    AUDIO = auto()
+    DOC = auto()
+
+
+# 支持的媒体类型到媒体大类的映射，一次字典查询同时完成类型检查和分类
+_CT_KIND: Dict[str, MediaKind] = {
+    content_type: {
+        'image': MediaKind.IMAGE,
+        'video': MediaKind.VIDEO,
+        'audio': MediaKind.AUDIO,
+    }.get(content_type.split('/', 1)[0], MediaKind.DOC)
+    for content_type in ALLOWED_MEDIA_TYPES
+}
+
+# 上传时生成的缩略图尺寸
+THUMBNAIL_SIZES: Tuple[Tuple[int, int], ...] = (
+    (32, 32), (96, 96), (320, 240), (640, 480), (800, 600)
+)
+
+# 上传内容每次读取和写入的块大小
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# 缓存的媒体ID路径分片前缀数量
+SHARD_PREFIX_CACHE_SIZE = 4096
+
+# 内存缩略图缓存的总字节数，以及可缓存的单个缩略图最大字节数
+THUMBNAIL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+THUMBNAIL_CACHE_MAX_ENTRY_BYTES = 256 * 1024
+
+
+# 按扩展名缓存的MIME类型数量
+CONTENT_TYPE_CACHE_SIZE = 256
+
+
+@functools.lru_cache(maxsize=CONTENT_TYPE_CACHE_SIZE)
+def _ext_to_mime(ext: str) -> str:
+    """根据小写扩展名（含点号）查询MIME类型，未知时返回application/octet-stream"""
+    # 仍通过 guess_type 查询，以便 mimetypes 按需加载系统的类型表
+    content_type, _ = mimetypes.guess_type(f"file{ext}") if ext else (None, None)
+    return content_type or 'application/octet-stream'
+
+
+# 以下文件操作都是阻塞的，通过 defer_to_thread 在线程池中调用
+
+
+def _read_file(path: str) -> Optional[bytes]:
+    """读取文件内容，文件不存在时返回None"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _replace_file(path: str, content: bytes) -> None:
+    """写入已存在目录中的文件；先写临时文件再替换，读取方不会看到写了一半的文件"""
+    # 临时文件名包含进程和线程标识，并发写入同一文件时不会互相覆盖
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def _write_file(path: str, content: bytes) -> None:
+    """写入文件，必要时创建目录"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _replace_file(path, content)
+
+
+def _write_stream(path: str, content: IO[bytes], max_size: int) -> Tuple[int, str]:
+    """
+    分块写入上传内容，同时计算SHA-256，整个文件只经过一遍
+    
+    超过大小限制时删除已写入的部分并抛出ValueError。
+    
+    Returns:
+        (文件长度, SHA-256十六进制摘要)
+    """
+    hasher = hashlib.sha256()
+    length = 0
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                chunk = content.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                length += len(chunk)
+                if length > max_size:
+                    raise ValueError(
+                        f"File too large: more than {max_size} bytes"
+                    )
+                hasher.update(chunk)
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        _remove_files([tmp_path])
+        raise
+    return length, hasher.hexdigest()
+
+
+def _first_existing_path(*paths: str) -> Optional[str]:
+    """返回第一个存在的路径，都不存在时返回None"""
+    for path in paths:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _remove_files(paths: Iterable[str]) -> None:
+    """删除文件，忽略不存在的文件"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _remove_media_files(file_path: str, thumbnail_dir: str) -> None:
+    """删除媒体文件及其缩略图目录（包括按需生成的各种尺寸）"""
+    _remove_files([file_path])
+    shutil.rmtree(thumbnail_dir, ignore_errors=True)
+
 
 class MediaHandler:
     """
@@ -46,19 +197,35 @@ class MediaHandler:
         self.media_store_path = getattr(self.config, 'media_store_path', '/data/media')
         self.max_upload_size = getattr(self.config, 'max_upload_size', 50 * 1024 * 1024)  # 50MB
         self.max_image_pixels = getattr(self.config, 'max_image_pixels', 32 * 1024 * 1024)  # 32M pixels
+        Thumbnailer.set_limits(self.max_image_pixels)
         
         # 支持的媒体类型
-        self.allowed_types = {
-            'image/jpeg', 'image/png', 'image/gif', 'image/webp',
-            'video/mp4', 'video/webm', 'video/ogg',
-            'audio/mp3', 'audio/ogg', 'audio/wav', 'audio/flac',
-            'application/pdf', 'text/plain'
-        }
+        self.allowed_types = ALLOWED_MEDIA_TYPES
         
         # 缩略图尺寸
-        self.thumbnail_sizes = [
-            (32, 32), (96, 96), (320, 240), (640, 480), (800, 600)
-        ]
+        self.thumbnail_sizes = THUMBNAIL_SIZES
+        
+        # 同一缩略图的并发生成请求共用一次生成
+        self._thumbnail_generation: ResponseCache[
+            Tuple[str, int, int, str]
+        ] = ResponseCache(self.clock, "media_thumbnail_generation")
+        
+        # 小缩略图的内存缓存，按字节数限制大小；键为
+        # (服务器名称, 媒体ID, 宽度, 高度, 缩放方法)，删除媒体时按前缀整体清除
+        self._thumbnail_cache: LruCache[
+            Tuple[str, str, int, int, str], bytes
+        ] = LruCache(
+            max_size=THUMBNAIL_CACHE_MAX_BYTES,
+            cache_name="media_thumbnails",
+            cache_type=TreeCache,
+            size_callback=len,
+        )
+        
+        # 媒体ID到路径分片前缀的缓存，同一媒体的原文件和各尺寸缩略图共用
+        self._shard_prefix_cache: LruCache[str, str] = LruCache(
+            max_size=SHARD_PREFIX_CACHE_SIZE,
+            cache_name="media_shard_prefix",
+        )
         
     def _generate_media_id(self) -> str:
         """
@@ -67,8 +234,23 @@ class MediaHandler:
         Returns:
             媒体ID字符串
         """
-        import secrets
-        return secrets.token_urlsafe(24)
+        return random_token_urlsafe(24)
+        
+    def _get_shard_prefix(self, media_id: str) -> str:
+        """
+        获取媒体ID的路径分片前缀（SHA-256的前两位十六进制字符）
+        
+        Args:
+            media_id: 媒体ID
+            
+        Returns:
+            分片前缀
+        """
+        hash_prefix = self._shard_prefix_cache.get(media_id)
+        if hash_prefix is None:
+            hash_prefix = hashlib.sha256(media_id.encode()).hexdigest()[:2]
+            self._shard_prefix_cache.set(media_id, hash_prefix)
+        return hash_prefix
         
     def _get_media_path(self, media_id: str, server_name: str) -> str:
         """
@@ -82,7 +264,7 @@ class MediaHandler:
             文件路径
         """
         # 使用哈希分散存储
-        hash_prefix = hashlib.sha256(media_id.encode()).hexdigest()[:2]
+        hash_prefix = self._get_shard_prefix(media_id)
         return os.path.join(
             self.media_store_path,
             'local_content' if server_name == self.hs.hostname else 'remote_content',
@@ -91,6 +273,25 @@ class MediaHandler:
             media_id
         )
         
+    def _get_thumbnail_dir(self, media_id: str, server_name: str) -> str:
+        """
+        获取媒体的缩略图目录，该媒体的所有缩略图都存放在这个目录下
+        
+        Args:
+            media_id: 媒体ID
+            server_name: 服务器名称
+            
+        Returns:
+            缩略图目录
+        """
+        return os.path.join(
+            self.media_store_path,
+            'local_thumbnails' if server_name == self.hs.hostname else 'remote_thumbnails',
+            server_name,
+            self._get_shard_prefix(media_id),
+            media_id,
+        )
+        
     def _get_thumbnail_path(self, media_id: str, server_name: str,
                            width: int, height: int, method: str = 'scale') -> str:
         """
@@ -106,25 +307,17 @@ class MediaHandler:
         Returns:
             缩略图路径
         """
-        hash_prefix = hashlib.sha256(media_id.encode()).hexdigest()[:2]
         filename = f"{width}x{height}_{method}"
-        return os.path.join(
-            self.media_store_path,
-            'local_thumbnails' if server_name == self.hs.hostname else 'remote_thumbnails',
-            server_name,
-            hash_prefix,
-            media_id,
-            filename
-        )
+        return os.path.join(self._get_thumbnail_dir(media_id, server_name), filename)
         
-    async def upload_media(self, content: bytes, content_type: str,
+    async def upload_media(self, content: Union[bytes, IO[bytes]], content_type: str,
                           filename: Optional[str] = None,
                           user_id: Optional[str] = None) -> Dict[str, Any]:
         """
         上传媒体文件
         
         Args:
-            content: 文件内容
+            content: 文件内容，或可分块读取的请求体流
             content_type: MIME类型
             filename: 文件名
             user_id: 上传用户ID
@@ -132,38 +325,41 @@ class MediaHandler:
         Returns:
             上传结果，包含媒体ID和URI
         """
-        logger.info(f"Uploading media: {filename}, type: {content_type}, size: {len(content)}")
-        
-        # 检查文件大小
-        if len(content) > self.max_upload_size:
-            raise ValueError(f"File too large: {len(content)} bytes (max: {self.max_upload_size})")
-            
-        # 检查媒体类型
-        if content_type not in self.allowed_types:
+        logger.info(f"Uploading media: {filename}, type: {content_type}")
+        
+        if isinstance(content, bytes):
+            # 检查文件大小
+            if len(content) > self.max_upload_size:
+                raise ValueError(f"File too large: {len(content)} bytes (max: {self.max_upload_size})")
+            # BytesIO 在写入前与原始 bytes 共享内存，不会复制
+            content = BytesIO(content)
+            
+        # 检查并分类媒体类型
+        kind = _CT_KIND.get(content_type)
+        if kind is None:
             logger.warning(f"Unsupported media type: {content_type}")
             
         # 生成媒体ID
         media_id = self._generate_media_id()
         server_name = self.hs.hostname
         
-        # 计算文件哈希
-        content_hash = hashlib.sha256(content).hexdigest()
-        
         # 获取存储路径
         file_path = self._get_media_path(media_id, server_name)
         
-        # 确保目录存在
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        
-        # 写入文件
-        with open(file_path, 'wb') as f:
-            f.write(content)
+        # 写入文件并计算文件哈希，流式内容在写入过程中检查大小
+        media_length, content_hash = await defer_to_thread(
+            self.hs.get_reactor(),
+            _write_stream,
+            file_path,
+            content,
+            self.max_upload_size,
+        )
             
         # 存储媒体信息到数据库
         await self.store.store_local_media(
             media_id=media_id,
             media_type=content_type,
-            media_length=len(content),
+            media_length=media_length,
             user_id=user_id,
             created_ts=self.clock.time_msec(),
             upload_name=filename,
@@ -172,7 +368,7 @@ class MediaHandler:
         )
         
         # 如果是图片，生成缩略图
-        if content_type.startswith('image/'):
+        if kind is MediaKind.IMAGE:
             try:
                 await self._generate_thumbnails(media_id, server_name, file_path, content_type)
             except Exception as e:
@@ -185,7 +381,7 @@ class MediaHandler:
             "media_id": media_id,
             "content_uri": media_uri,
             "content_type": content_type,
-            "content_length": len(content)
+            "content_length": media_length
         }
         
     async def download_media(self, server_name: str, media_id: str) -> Tuple[bytes, str, str]:
@@ -222,18 +418,19 @@ class MediaHandler:
         if not media_info:
             raise FileNotFoundError(f"Media {media_id} not found")
             
+        # 读取文件内容
         file_path = media_info['file_path']
-        if not os.path.exists(file_path):
+        content = await defer_to_thread(self.hs.get_reactor(), _read_file, file_path)
+        if content is None:
             # 尝试重新构建路径
             file_path = self._get_media_path(media_id, self.hs.hostname)
+            content = await defer_to_thread(
+                self.hs.get_reactor(), _read_file, file_path
+            )
             
-        if not os.path.exists(file_path):
+        if content is None:
             raise FileNotFoundError(f"Media file not found: {file_path}")
             
-        # 读取文件内容
-        with open(file_path, 'rb') as f:
-            content = f.read()
-            
         return (
             content,
             media_info['media_type'],
@@ -254,10 +451,10 @@ class MediaHandler:
         # 检查本地缓存
         cached_media = await self.store.get_cached_remote_media(server_name, media_id)
         if cached_media:
-            file_path = cached_media['file_path']
-            if os.path.exists(file_path):
-                with open(file_path, 'rb') as f:
-                    content = f.read()
+            content = await defer_to_thread(
+                self.hs.get_reactor(), _read_file, cached_media['file_path']
+            )
+            if content is not None:
                 return (
                     content,
                     cached_media['media_type'],
@@ -288,38 +485,95 @@ class MediaHandler:
         """
         logger.debug(f"Getting thumbnail: {server_name}/{media_id} {width}x{height}")
         
+        cache_key = (server_name, media_id, width, height, method)
+        content = self._thumbnail_cache.get(cache_key)
+        if content is not None:
+            return content, 'image/jpeg'
+            
         # 获取缩略图路径
         thumbnail_path = self._get_thumbnail_path(
             media_id, server_name, width, height, method
         )
         
         # 检查缩略图是否存在
-        if os.path.exists(thumbnail_path):
-            with open(thumbnail_path, 'rb') as f:
-                content = f.read()
+        content = await defer_to_thread(
+            self.hs.get_reactor(), _read_file, thumbnail_path
+        )
+        if content is not None:
+            self._cache_thumbnail(cache_key, content)
             return content, 'image/jpeg'
             
         # 如果缩略图不存在，尝试生成
         if server_name == self.hs.hostname:
-            media_info = await self.store.get_local_media(media_id)
-            if media_info and media_info['media_type'].startswith('image/'):
-                file_path = media_info['file_path']
-                if not os.path.exists(file_path):
-                    file_path = self._get_media_path(media_id, server_name)
-                    
-                if os.path.exists(file_path):
-                    thumbnail_content = await self._generate_single_thumbnail(
-                        file_path, width, height, method
-                    )
-                    if thumbnail_content:
-                        # 保存缩略图
-                        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
-                        with open(thumbnail_path, 'wb') as f:
-                            f.write(thumbnail_content)
-                        return thumbnail_content, 'image/jpeg'
+            thumbnail_content = await self._thumbnail_generation.wrap(
+                (media_id, width, height, method),
+                self._generate_local_thumbnail,
+                media_id,
+                width,
+                height,
+                method,
+                thumbnail_path,
+            )
+            if thumbnail_content:
+                self._cache_thumbnail(cache_key, thumbnail_content)
+                return thumbnail_content, 'image/jpeg'
                         
         raise FileNotFoundError(f"Thumbnail not found: {width}x{height}")
         
+    def _cache_thumbnail(self, cache_key: Tuple[str, str, int, int, str],
+                         content: bytes) -> None:
+        """
+        把缩略图放入内存缓存，较大的缩略图不缓存
+        
+        Args:
+            cache_key: (服务器名称, 媒体ID, 宽度, 高度, 缩放方法)
+            content: 缩略图内容
+        """
+        if len(content) <= THUMBNAIL_CACHE_MAX_ENTRY_BYTES:
+            self._thumbnail_cache.set(cache_key, content)
+            
+    async def _generate_local_thumbnail(self, media_id: str, width: int, height: int,
+                                        method: str, thumbnail_path: str) -> Optional[bytes]:
+        """
+        为本地媒体生成缩略图并保存
+        
+        Args:
+            media_id: 媒体ID
+            width: 宽度
+            height: 高度
+            method: 缩放方法
+            thumbnail_path: 缩略图保存路径
+            
+        Returns:
+            缩略图内容，无法生成时返回None
+        """
+        server_name = self.hs.hostname
+        media_info = await self.store.get_local_media(media_id)
+        if not media_info or _CT_KIND.get(media_info['media_type']) is not MediaKind.IMAGE:
+            return None
+            
+        file_path = await defer_to_thread(
+            self.hs.get_reactor(),
+            _first_existing_path,
+            media_info['file_path'],
+            self._get_media_path(media_id, server_name),
+        )
+        if file_path is None:
+            return None
+            
+        thumbnail_content = await self._generate_single_thumbnail(
+            file_path, width, height, method
+        )
+        if thumbnail_content:
+            # 保存缩略图
+            await defer_to_thread(
+                self.hs.get_reactor(),
+                _write_file,
+                thumbnail_path,
+                thumbnail_content,
+            )
+        return thumbnail_content
+        
     async def _generate_thumbnails(self, media_id: str, server_name: str,
                                   file_path: str, content_type: str):
         """
@@ -331,30 +585,73 @@ class MediaHandler:
             file_path: 原始文件路径
             content_type: MIME类型
         """
-        if not content_type.startswith('image/'):
+        if _CT_KIND.get(content_type) is not MediaKind.IMAGE:
             return
             
         logger.debug(f"Generating thumbnails for {media_id}")
         
-        for width, height in self.thumbnail_sizes:
-            try:
-                thumbnail_content = await self._generate_single_thumbnail(
-                    file_path, width, height, 'scale'
-                )
-                
-                if thumbnail_content:
-                    thumbnail_path = self._get_thumbnail_path(
-                        media_id, server_name, width, height, 'scale'
+        thumbnail_paths = {
+            (width, height): self._get_thumbnail_path(
+                media_id, server_name, width, height, 'scale'
+            )
+            for width, height in self.thumbnail_sizes
+        }
+        
+        # 所有尺寸共用一次解码，整个过程在线程池中执行
+        generated = await defer_to_thread(
+            self.hs.get_reactor(),
+            self._write_scaled_thumbnails,
+            file_path,
+            thumbnail_paths,
+        )
+        logger.debug(f"Generated {generated} thumbnails for {media_id}")
+        
+    def _write_scaled_thumbnails(self, file_path: str,
+                                 thumbnail_paths: Dict[Tuple[int, int], str]) -> int:
+        """
+        解码一次原图，生成并写入所有尺寸的缩略图
+        
+        Args:
+            file_path: 原始文件路径
+            thumbnail_paths: (宽度, 高度) 到缩略图路径的映射
+            
+        Returns:
+            成功生成的缩略图数量
+        """
+        try:
+            thumbnailer = Thumbnailer(file_path)
+        except ThumbnailError as e:
+            logger.warning(f"Unable to open {file_path} for thumbnailing: {e}")
+            return 0
+            
+        generated = 0
+        with thumbnailer:
+            # JPEG 可以在解码时直接按 1/2、1/4、1/8 缩小，只要不小于最大的
+            # 缩略图尺寸即可；按最长边请求，EXIF 旋转后同样足够大。其他格式
+            # 会忽略这个设置
+            max_side = max(max(size) for size in thumbnail_paths)
+            thumbnailer.image.draft(None, (max_side, max_side))
+            m_width, m_height = thumbnailer.transpose()
+            
+            # 同一媒体的所有缩略图在同一个目录下，只需创建一次
+            thumbnail_dir = os.path.dirname(next(iter(thumbnail_paths.values())))
+            os.makedirs(thumbnail_dir, exist_ok=True)
+            
+            for (width, height), thumbnail_path in thumbnail_paths.items():
+                try:
+                    t_width, t_height = thumbnailer.aspect(width, height)
+                    output = thumbnailer.scale(
+                        min(m_width, t_width), min(m_height, t_height), 'image/jpeg'
                     )
-                    
-                    os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
-                    with open(thumbnail_path, 'wb') as f:
-                        f.write(thumbnail_content)
+                    with output:
+                        _replace_file(thumbnail_path, output.getvalue())
                         
+                    generated += 1
                     logger.debug(f"Generated thumbnail: {width}x{height}")
+                except Exception as e:
+                    logger.warning(f"Failed to generate {width}x{height} thumbnail: {e}")
                     
-            except Exception as e:
-                logger.warning(f"Failed to generate {width}x{height} thumbnail: {e}")
+        return generated
                 
     async def _generate_single_thumbnail(self, file_path: str, width: int, height: int,
                                         method: str = 'scale') -> Optional[bytes]:
@@ -370,23 +667,56 @@ class MediaHandler:
         Returns:
             缩略图内容，失败返回None
         """
+        logger.debug(f"Generating thumbnail: {width}x{height} from {file_path}")
+        
         try:
-            # 这里应该使用PIL或其他图像处理库
-            # 为了简化，我们返回一个占位符
-            logger.debug(f"Generating thumbnail: {width}x{height} from {file_path}")
+            # 解码和缩放是CPU密集型操作，放到线程池中执行
+            return await defer_to_thread(
+                self.hs.get_reactor(),
+                self._thumbnail_file,
+                file_path,
+                width,
+                height,
+                method,
+            )
+        except Exception as e:
+            logger.error(f"Error generating thumbnail: {e}")
+            return None
             
-            # 简单的占位符实现
-            # 实际实现应该使用PIL:
-            # from PIL import Image
-            # with Image.open(file_path) as img:
-            #     img.thumbnail((width, height), Image.LANCZOS)
-            #     ...
+    def _thumbnail_file(self, file_path: str, width: int, height: int,
+                        method: str) -> Optional[bytes]:
+        """
+        在线程池中生成JPEG缩略图
+        
+        Args:
+            file_path: 原始文件路径
+            width: 宽度
+            height: 高度
+            method: 缩放方法，'crop' 或 'scale'
             
+        Returns:
+            缩略图内容，无法生成时返回None
+        """
+        try:
+            thumbnailer = Thumbnailer(file_path)
+        except ThumbnailError as e:
+            logger.warning("Unable to open %s for thumbnailing: %s", file_path, e)
             return None
             
-        except Exception as e:
-            logger.error(f"Error generating thumbnail: {e}")
-            return None
+        with thumbnailer:
+            m_width, m_height = thumbnailer.transpose()
+            
+            if method == 'crop':
+                output = thumbnailer.crop(width, height, 'image/jpeg')
+            else:
+                # 按比例缩放，不放大比目标尺寸更小的图片
+                t_width, t_height = thumbnailer.aspect(width, height)
+                output = thumbnailer.scale(
+                    min(m_width, t_width), min(m_height, t_height), 'image/jpeg'
+                )
+                
+        with output:
+            return output.getvalue()
             
     async def delete_media(self, media_id: str, server_name: Optional[str] = None) -> bool:
         """
@@ -404,20 +734,14 @@ class MediaHandler:
             
         logger.info(f"Deleting media: {server_name}/{media_id}")
         
-        # 获取文件路径
-        file_path = self._get_media_path(media_id, server_name)
-        
-        # 删除原始文件
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            
-        # 删除缩略图
-        for width, height in self.thumbnail_sizes:
-            thumbnail_path = self._get_thumbnail_path(
-                media_id, server_name, width, height, 'scale'
-            )
-            if os.path.exists(thumbnail_path):
-                os.remove(thumbnail_path)
+        # 删除原始文件和整个缩略图目录
+        await defer_to_thread(
+            self.hs.get_reactor(),
+            _remove_media_files,
+            self._get_media_path(media_id, server_name),
+            self._get_thumbnail_dir(media_id, server_name),
+        )
+        self._thumbnail_cache.del_multi((server_name, media_id))
                 
         # 从数据库删除记录
         if server_name == self.hs.hostname:
@@ -465,12 +789,14 @@ class MediaHandler:
         Returns:
             Content-Disposition字符串
         """
-        if filename:
-            # 对文件名进行URL编码以支持非ASCII字符
-            encoded_filename = quote(filename.encode('utf-8'))
-            return f'inline; filename*=UTF-8\'\'\'{encoded_filename}'
-        else:
+        if not filename:
             return 'inline'
+        # 可作为token的纯ASCII文件名直接输出，无需编码
+        if _can_encode_filename_as_token(filename):
+            return f'inline; filename={filename}'
+        # 其余文件名按RFC 5987 3.2.1进行百分号编码，quote会自行做UTF-8编码
+        encoded_filename = quote(filename, safe='')
+        return f"inline; filename*=UTF-8''{encoded_filename}"
             
     def guess_content_type(self, filename: str) -> str:
         """
@@ -482,5 +808,6 @@ class MediaHandler:
         Returns:
             MIME类型
         """
-        content_type, _ = mimetypes.guess_type(filename)
-        return content_type or 'application/octet-stream'
\ No newline at end of file
+        # 只有扩展名决定结果，按扩展名缓存可避免每次都完整解析文件名
+        ext = os.path.splitext(filename)[1].lower()
+        return _ext_to_mime(ext)
\ No newline at end of file
@@ -20,8 +20,13 @@ Matrix Synapse 消息处理器
 """
 
 import logging
-import secrets
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
+
+from synapse.api.errors import AuthError, Codes, NotFoundError
+from synapse.logging.context import make_deferred_yieldable, run_in_background
+from synapse.util import unwrapFirstError
+from synapse.util.async_helpers import gather_results
+from synapse.util.stringutils import random_token_urlsafe
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +40,7 @@ class MessageHandler:
     
     def __init__(self, hs):
         self.hs = hs
+        self.server_name = hs.hostname
         self.store = hs.get_datastore()
         self.clock = hs.get_clock()
         self.config = hs.config
@@ -47,8 +53,8 @@ class MessageHandler:
         Returns:
             事件ID字符串
         """
-        event_localpart = secrets.token_urlsafe(32)
-        return f"${event_localpart}:{self.hs.hostname}"
+        event_localpart = random_token_urlsafe(32)
+        return f"${event_localpart}:{self.server_name}"
         
     async def send_message(self, room_id: str, sender_id: str, 
                           message_type: str, content: Dict[str, Any],
@@ -68,43 +74,57 @@ class MessageHandler:
         """
         logger.info(f"Sending message to room {room_id} from {sender_id}")
         
-        # 检查用户是否在房间中
-        membership = await self.store.get_room_membership(sender_id, room_id)
-        if membership != "join":
-            raise ValueError(f"User {sender_id} is not in room {room_id}")
-            
-        # 如果提供了事务ID，检查是否已经处理过
+        # 检查用户是否在房间中；如果提供了事务ID，同时检查是否已经处理过
         if txn_id:
-            existing_event = await self.store.get_event_by_txn_id(
-                sender_id, room_id, txn_id
+            membership, existing_event = await make_deferred_yieldable(
+                gather_results(
+                    (
+                        run_in_background(
+                            self.store.get_room_membership, sender_id, room_id
+                        ),
+                        run_in_background(
+                            self.store.get_event_by_txn_id, sender_id, room_id, txn_id
+                        ),
+                    ),
+                    consumeErrors=True,
+                ).addErrback(unwrapFirstError)
+            )
+        else:
+            membership = await self.store.get_room_membership(sender_id, room_id)
+            existing_event = None
+            
+        if membership != "join":
+            raise AuthError(
+                403, f"User {sender_id} is not in room {room_id}", Codes.FORBIDDEN
             )
-            if existing_event:
-                return {"event_id": existing_event["event_id"]}
+            
+        if existing_event:
+            return {"event_id": existing_event["event_id"]}
                 
         # 生成事件ID
         event_id = self._generate_event_id()
         
+        # 复制一次内容再设置消息类型，不修改调用方的字典
+        msg_content = dict(content)
+        msg_content["msgtype"] = message_type
+        
         # 创建消息事件
         event = await self.event_builder.create_event(
             event_type=f"m.room.message",
             room_id=room_id,
             sender=sender_id,
-            content={
-                "msgtype": message_type,
-                **content
-            },
+            content=msg_content,
             event_id=event_id,
             txn_id=txn_id
         )
         
-        # 存储事件
-        await self.store.store_event(event)
-        
-        # 如果有事务ID，存储映射关系
+        # 存储事件；如果有事务ID，在同一个事务中存储映射关系
         if txn_id:
-            await self.store.store_txn_id_mapping(
-                sender_id, room_id, txn_id, event_id
+            await self.store.store_event_with_txn_id(
+                event, sender_id, room_id, txn_id
             )
+        else:
+            await self.store.store_event(event)
             
         logger.info(f"Message sent successfully: {event_id}")
         return {"event_id": event_id}
@@ -207,19 +227,18 @@ class MessageHandler:
         # 检查原始事件是否存在且属于发送者
         original_event = await self.store.get_event_by_id(original_event_id)
         if not original_event:
-            raise ValueError(f"Event {original_event_id} not found")
+            raise NotFoundError(f"Event {original_event_id} not found")
             
         if original_event["sender"] != sender_id:
-            raise ValueError("Cannot edit message from another user")
+            raise AuthError(403, "Cannot edit message from another user")
             
-        # 创建编辑事件
-        content = {
-            "m.new_content": new_content,
-            "m.relates_to": {
-                "rel_type": "m.replace",
-                "event_id": original_event_id
-            },
-            **new_content  # 向后兼容
+        # 创建编辑事件：顶层保留新内容用于向后兼容，替换关系必须覆盖
+        # 新内容中可能带有的 m.relates_to
+        content = dict(new_content)
+        content["m.new_content"] = new_content
+        content["m.relates_to"] = {
+            "rel_type": "m.replace",
+            "event_id": original_event_id
         }
         
         return await self.send_message(
@@ -248,7 +267,7 @@ class MessageHandler:
         # 检查目标事件是否存在
         target_event = await self.store.get_event_by_id(target_event_id)
         if not target_event:
-            raise ValueError(f"Event {target_event_id} not found")
+            raise NotFoundError(f"Event {target_event_id} not found")
             
         # 生成事件ID
         event_id = self._generate_event_id()
@@ -296,7 +315,7 @@ class MessageHandler:
         # 检查目标事件是否存在
         target_event = await self.store.get_event_by_id(target_event_id)
         if not target_event:
-            raise ValueError(f"Event {target_event_id} not found")
+            raise NotFoundError(f"Event {target_event_id} not found")
             
         # 检查权限（只能删除自己的消息或有管理员权限）
         if target_event["sender"] != sender_id:
@@ -307,7 +326,7 @@ class MessageHandler:
             redact_level = await self.store.get_room_redact_level(room_id)
             
             if power_level < redact_level:
-                raise ValueError("Insufficient permissions to redact message")
+                raise AuthError(403, "Insufficient permissions to redact message")
                 
         # 生成事件ID
         event_id = self._generate_event_id()
@@ -360,7 +379,9 @@ class MessageHandler:
         # 检查用户是否有权限查看房间消息
         membership = await self.store.get_room_membership(user_id, room_id)
         if membership not in ["join", "invite", "leave"]:
-            raise ValueError(f"User {user_id} cannot view room {room_id} messages")
+            raise AuthError(
+                403, f"User {user_id} cannot view room {room_id} messages"
+            )
             
         # 获取消息
         messages = await self.store.get_room_messages(
@@ -398,7 +419,7 @@ class MessageHandler:
         # 检查用户是否有权限查看房间
         membership = await self.store.get_room_membership(user_id, room_id)
         if membership not in ["join", "invite", "leave"]:
-            raise ValueError(f"User {user_id} cannot view room {room_id}")
+            raise AuthError(403, f"User {user_id} cannot view room {room_id}")
             
         # 获取事件上下文
         context = await self.store.get_event_context(
@@ -412,4 +433,36 @@ class MessageHandler:
             "start": context["start"],
             "end": context["end"],
             "state": context["state"]
-        }
\ No newline at end of file
+        }
+        
+    async def set_typing_state_bulk(
+        self, updates: List[Tuple[str, str, bool, int]]
+    ) -> None:
+        """
+        批量设置输入状态
+        
+        Args:
+            updates: (user_id, room_id, typing, timeout) 列表，每个
+                (用户, 房间) 至多出现一次
+        """
+        if not updates:
+            return
+            
+        logger.debug(f"Flushing {len(updates)} typing updates")
+        await self.store.set_typing_states(updates)
+        
+    async def set_receipt_bulk(
+        self, receipts: List[Tuple[str, str, str, str]]
+    ) -> None:
+        """
+        批量设置已读回执
+        
+        Args:
+            receipts: (user_id, room_id, event_id, receipt_type) 列表，每个
+                (用户, 房间, 回执类型) 至多出现一次
+        """
+        if not receipts:
+            return
+            
+        logger.debug(f"Flushing {len(receipts)} receipts")
+        await self.store.insert_receipts(receipts)
@@ -407,6 +407,64 @@ class RoomHandler:
         logger.info(f"User {invitee_id} invited to room {room_id} successfully")
         return {"room_id": room_id}
         
+    async def invite_users_bulk(self, inviter_id: str, invitee_ids: List[str],
+                               room_id: str) -> Dict[str, Exception]:
+        """
+        批量邀请多个用户加入同一房间
+        
+        邀请者的成员身份只检查一次，所有邀请事件通过一次批量写入存储。
+        
+        Args:
+            inviter_id: 邀请者ID
+            invitee_ids: 被邀请者ID列表
+            room_id: 房间ID
+            
+        Returns:
+            邀请失败的用户ID到失败异常的映射，异常类型与 invite_user 在同样
+            情况下抛出的一致
+        """
+        logger.info(
+            "User %s inviting %d users to room %s", inviter_id, len(invitee_ids), room_id
+        )
+        
+        # 检查邀请者是否有权限邀请
+        inviter_membership = await self.store.get_room_membership(
+            inviter_id, room_id
+        )
+        
+        if inviter_membership != "join":
+            raise ValueError(f"User {inviter_id} cannot invite to room {room_id}")
+            
+        # 一次查询所有被邀请者的当前状态
+        invitee_ids = list(dict.fromkeys(invitee_ids))
+        memberships = await self.store.get_room_memberships_for_users(
+            room_id, invitee_ids
+        )
+        
+        failures: Dict[str, Exception] = {}
+        invite_events = []
+        for invitee_id in invitee_ids:
+            if memberships.get(invitee_id) == "join":
+                failures[invitee_id] = ValueError(
+                    f"User {invitee_id} is already in room {room_id}"
+                )
+                continue
+                
+            invite_events.append(
+                await self._create_member_event(
+                    room_id, inviter_id, invitee_id, "invite"
+                )
+            )
+            
+        # 批量存储事件
+        if invite_events:
+            await self.store.store_events(invite_events)
+            
+        logger.info(
+            "%d users invited to room %s successfully", len(invite_events), room_id
+        )
+        return failures
+        
     async def get_room_state(self, room_id: str, 
                            user_id: Optional[str] = None) -> List[Dict[str, Any]]:
         """
@@ -432,6 +490,20 @@ class RoomHandler:
         
         return state_events
         
+    async def get_current_state_group(self, room_id: str) -> Optional[int]:
+        """
+        获取房间当前的状态组ID
+        
+        状态组ID只在房间状态变化时改变，调用方可以用它判断缓存的状态是否过期。
+        
+        Args:
+            room_id: 房间ID
+            
+        Returns:
+            当前状态组ID，无法确定时返回None
+        """
+        return await self.store.get_current_state_group(room_id)
+        
     async def get_room_members(self, room_id: str, 
                              user_id: Optional[str] = None) -> List[Dict[str, Any]]:
         """
@@ -455,4 +527,35 @@ class RoomHandler:
         # 获取房间成员
         members = await self.store.get_room_members(room_id)
         
-        return members  # pyright: ignore[reportUnreachable]
\ No newline at end of file
+        return members  # pyright: ignore[reportUnreachable]
+        
+    async def get_user_joined_rooms(self, user_id: str) -> List[str]:
+        """
+        获取用户已加入的房间列表
+        
+        Args:
+            user_id: 用户ID
+            
+        Returns:
+            房间ID列表
+        """
+        logger.debug(f"Getting joined rooms for {user_id}")
+        
+        rooms = await self.store.get_rooms_for_user(user_id)
+        
+        return list(rooms)
+        
+    async def get_membership_version(self, user_id: str) -> Optional[int]:
+        """
+        获取用户成员关系的版本号
+        
+        用户的任何成员关系变更（加入、离开、邀请、踢出）都会推进该版本号，
+        调用方可以用它作为缓存键的一部分来判断缓存是否过期。
+        
+        Args:
+            user_id: 用户ID
+            
+        Returns:
+            最近一次成员关系变更的流位置，无法确定时返回None
+        """
+        return await self.store.get_membership_stream_pos_for_user(user_id)
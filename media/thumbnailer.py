@@ -183,7 +183,12 @@ class Thumbnailer:
         fmt = self.FORMATS[output_type]
         if fmt == "JPEG":
             output_image = output_image.convert("RGB")
-        output_image.save(output_bytes_io, fmt, quality=80)
+            # Computing optimal Huffman tables is lossless and noticeably shrinks
+            # thumbnails, which are written once but served many times. Metadata
+            # such as EXIF is never copied over, so the output is already stripped.
+            output_image.save(output_bytes_io, fmt, quality=80, optimize=True)
+        else:
+            output_image.save(output_bytes_io, fmt, quality=80)
         return output_bytes_io
 
     def close(self) -> None:
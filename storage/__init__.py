@@ -21,7 +21,7 @@ Matrix Synapse 数据库存储层
 """
 
 import logging
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -66,6 +66,201 @@ class DataStore:
         logger.info(f"Creating user: {user_id}")
         return True
         
+    async def store_login_session(self, user_id: str, token: str, device_id: str,
+                                  display_name: Optional[str] = None,
+                                  last_seen: Optional[int] = None) -> bool:
+        """
+        在同一个事务中存储登录产生的访问令牌和设备信息
+        
+        Args:
+            user_id: 用户ID
+            token: 访问令牌
+            device_id: 设备ID
+            display_name: 设备显示名称
+            last_seen: 设备最后活跃时间（毫秒）
+            
+        Returns:
+            存储成功返回True，否则返回False
+        """
+        logger.debug(f"Storing login session for user {user_id}, device {device_id}")
+        return True
+        
+    async def store_one_time_keys(self, user_id: str, device_id: str,
+                                  one_time_keys: Dict[str, Dict[str, Any]]) -> Dict[str, int]:
+        """
+        存储设备的一次性密钥
+        
+        Args:
+            user_id: 用户ID
+            device_id: 设备ID
+            one_time_keys: 算法 -> {密钥ID: 密钥}
+            
+        Returns:
+            本次写入的各算法密钥数量，在写入时顺带统计，无需再次遍历
+        """
+        logger.debug(f"Storing one-time keys for device {device_id} of user {user_id}")
+        return {
+            algorithm: len(keys_for_alg)
+            for algorithm, keys_for_alg in one_time_keys.items()
+        }
+        
+    async def store_events(self, events: List[Dict[str, Any]]) -> bool:
+        """
+        用一条多行 INSERT 按顺序批量存储事件，已存在的事件会被忽略
+        
+        Args:
+            events: 事件列表
+            
+        Returns:
+            存储成功返回True，否则返回False
+        """
+        logger.debug(f"Storing {len(events)} events")
+        return True
+        
+    async def get_device(self, user_id: str, device_id: str) -> Optional[Dict[str, Any]]:
+        """
+        获取设备信息
+        
+        查询时将列直接别名为客户端响应使用的字段名：
+        device_id, display_name, last_seen AS last_seen_ts,
+        ip_address AS last_seen_ip。
+        
+        Args:
+            user_id: 用户ID
+            device_id: 设备ID
+            
+        Returns:
+            设备信息，如果设备不存在则返回None
+        """
+        logger.debug(f"Getting device {device_id} for user {user_id}")
+        return None
+        
+    async def get_user_devices(self, user_id: str) -> List[Dict[str, Any]]:
+        """
+        获取用户的所有设备，列别名与 get_device 相同
+        
+        Args:
+            user_id: 用户ID
+            
+        Returns:
+            设备列表
+        """
+        logger.debug(f"Getting all devices for user {user_id}")
+        return []
+        
+    async def upsert_device(self, user_id: str, device_id: str,
+                            display_name: Optional[str] = None,
+                            last_seen: Optional[int] = None,
+                            ip_address: Optional[str] = None,
+                            user_agent: Optional[str] = None) -> bool:
+        """
+        插入设备，如果 (user_id, device_id) 已存在则更新
+        
+        使用 INSERT ... ON CONFLICT DO UPDATE 在一次往返中完成。
+        
+        Args:
+            user_id: 用户ID
+            device_id: 设备ID
+            display_name: 设备显示名称
+            last_seen: 设备最后活跃时间（毫秒）
+            ip_address: IP地址
+            user_agent: 用户代理
+            
+        Returns:
+            新建设备返回True，更新已有设备返回False
+        """
+        logger.debug(f"Upserting device {device_id} for user {user_id}")
+        return True
+        
+    async def delete_device_cascade(self, user_id: str, device_id: str) -> bool:
+        """
+        在同一个事务中删除设备的访问令牌、加密密钥以及设备本身
+        
+        Args:
+            user_id: 用户ID
+            device_id: 设备ID
+            
+        Returns:
+            设备存在并被删除返回True，设备不存在返回False
+        """
+        logger.debug(f"Deleting device {device_id} of user {user_id} with cascade")
+        return True
+        
+    async def user_delete_access_tokens(
+        self,
+        user_id: str,
+        except_token_id: Optional[int] = None,
+        device_id: Optional[str] = None,
+    ) -> List[Tuple[str, int, Optional[str]]]:
+        """
+        删除用户的访问令牌和刷新令牌
+        
+        Args:
+            user_id: 用户ID
+            except_token_id: 不删除的访问令牌ID
+            device_id: 只删除该设备的令牌，为None时删除全部设备的令牌
+            
+        Returns:
+            被删除令牌的 (令牌, 令牌ID, 设备ID) 列表
+        """
+        logger.debug(f"Deleting access tokens for user {user_id}")
+        return []
+        
+    async def get_device_keys_multi(self, user_id: str,
+                                    device_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        一次查询获取用户多个设备的加密密钥
+        
+        Args:
+            user_id: 用户ID
+            device_ids: 设备ID列表
+            
+        Returns:
+            设备ID到密钥数据的映射，没有密钥的设备不包含在内
+        """
+        logger.debug(f"Getting keys for {len(device_ids)} devices of user {user_id}")
+        return {}
+        
+    async def claim_one_time_keys_bulk(
+        self, claims: List[Tuple[str, str, str]]
+    ) -> List[Tuple[str, str, str, Any]]:
+        """
+        在一条语句中领取（查询并删除）多个设备的一次性密钥
+        
+        Args:
+            claims: (user_id, device_id, algorithm) 列表
+            
+        Returns:
+            成功领取的 (user_id, device_id, algorithm, key) 列表
+        """
+        logger.debug(f"Claiming {len(claims)} one-time keys in bulk")
+        return []
+        
+    async def update_devices_last_seen_bulk(
+        self,
+        updates: Dict[Tuple[str, str], Tuple[int, Optional[str], Optional[str]]],
+    ) -> None:
+        """
+        用一条语句批量更新多个设备的最后活跃信息
+        
+        Args:
+            updates: (user_id, device_id) -> (最后活跃时间, IP地址, 用户代理)
+        """
+        logger.debug(f"Updating last seen for {len(updates)} devices")
+        
+    async def batch_update_access_token_last_used(
+        self, updates: Dict[str, int]
+    ) -> None:
+        """
+        用一条语句批量更新多个访问令牌的最后使用时间
+        
+        已被删除的令牌不会匹配任何行，直接忽略。
+        
+        Args:
+            updates: 访问令牌 -> 最后使用时间（毫秒）
+        """
+        logger.debug(f"Updating last used for {len(updates)} access tokens")
+        
     async def get_room_by_id(self, room_id: str) -> Optional[Dict[str, Any]]:
         """
         根据房间ID获取房间信息
@@ -79,6 +274,48 @@ class DataStore:
         logger.debug(f"Getting room by ID: {room_id}")
         return None
         
+    async def get_room_memberships_for_users(
+        self, room_id: str, user_ids: List[str]
+    ) -> Dict[str, str]:
+        """
+        一次查询获取多个用户在房间中的当前成员状态
+        
+        Args:
+            room_id: 房间ID
+            user_ids: 用户ID列表
+            
+        Returns:
+            用户ID到成员状态的映射，没有成员记录的用户不包含在内
+        """
+        logger.debug(f"Getting memberships of {len(user_ids)} users in room {room_id}")
+        return {}
+        
+    async def get_membership_stream_pos_for_user(self, user_id: str) -> Optional[int]:
+        """
+        获取用户最近一次成员关系变更（加入、离开、邀请、踢出）的流位置
+        
+        Args:
+            user_id: 用户ID
+            
+        Returns:
+            流位置，用户没有任何成员事件时返回None
+        """
+        logger.debug(f"Getting membership stream position for user {user_id}")
+        return None
+        
+    async def get_current_state_group(self, room_id: str) -> Optional[int]:
+        """
+        获取房间当前前沿事件所在的状态组ID
+        
+        Args:
+            room_id: 房间ID
+            
+        Returns:
+            状态组ID，房间不存在或没有状态时返回None
+        """
+        logger.debug(f"Getting current state group for room {room_id}")
+        return None
+        
     async def store_event(self, event: Dict[str, Any]) -> bool:
         """
         存储事件
@@ -92,6 +329,23 @@ class DataStore:
         logger.debug(f"Storing event: {event.get('event_id', 'unknown')}")
         return True
 
+    async def store_event_with_txn_id(self, event: Dict[str, Any], sender_id: str,
+                                      room_id: str, txn_id: str) -> bool:
+        """
+        在同一个事务中存储事件和客户端事务ID到事件ID的映射
+        
+        Args:
+            event: 事件数据
+            sender_id: 发送者ID
+            room_id: 房间ID
+            txn_id: 客户端事务ID
+            
+        Returns:
+            存储成功返回True，否则返回False
+        """
+        logger.debug(f"Storing event {event.get('event_id', 'unknown')} for txn {txn_id}")
+        return True
+
 
 class DatabasePool:
     """
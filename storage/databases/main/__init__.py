@@ -147,11 +147,11 @@ class DataStore(
     CensorEventsStore,
     UIAuthStore,
     EventForwardExtremitiesStore,
+    FriendsWorkerStore,
     CacheInvalidationWorkerStore,
     LockStore,
     SessionStore,
     TaskSchedulerWorkerStore,
-    FriendsWorkerStore,
 ):
     def __init__(
         self,
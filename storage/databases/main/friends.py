@@ -14,18 +14,29 @@
 
 import logging
 import uuid
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Collection,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+)
 
 from synapse.api.errors import StoreError
-from synapse.storage._base import SQLBaseStore
 from synapse.storage.database import (
     DatabasePool,
     LoggingDatabaseConnection,
     LoggingTransaction,
+    make_in_list_sql_clause,
 )
+from synapse.storage.databases.main.cache import CacheInvalidationWorkerStore
 from synapse.storage.engines import PostgresEngine
 from synapse.types import JsonDict
 from synapse.util import json_encoder
+from synapse.util.caches.descriptors import cached, cachedList
 
 if TYPE_CHECKING:
     from synapse.server import HomeServer
@@ -33,7 +44,12 @@ if TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 
 
-class FriendsWorkerStore(SQLBaseStore):
+def _normalize_pair(user_a: str, user_b: str) -> Tuple[str, str]:
+    """按 user_friendships 表的约束（user1_id < user2_id）排列两个用户ID"""
+    return (user_a, user_b) if user_a < user_b else (user_b, user_a)
+
+
+class FriendsWorkerStore(CacheInvalidationWorkerStore):
     """好友关系数据存储的工作类"""
 
     def __init__(
@@ -45,6 +61,17 @@ class FriendsWorkerStore(SQLBaseStore):
         super().__init__(database, db_conn, hs)
         self.database_engine = database.engine
 
+    def _invalidate_friend_status_txn(
+        self, txn: LoggingTransaction, user1_id: str, user2_id: str
+    ) -> None:
+        """事务提交后清除两个用户之间双向的好友状态缓存，并通知其他工作进程"""
+        self._invalidate_cache_and_stream(
+            txn, self.get_friend_status, (user1_id, user2_id)
+        )
+        self._invalidate_cache_and_stream(
+            txn, self.get_friend_status, (user2_id, user1_id)
+        )
+
     async def get_friendship(
         self, user1_id: str, user2_id: str
     ) -> Optional[Dict[str, Any]]:
@@ -69,11 +96,9 @@ class FriendsWorkerStore(SQLBaseStore):
                 sql = """
                     SELECT user1_id, user2_id, status, created_ts
                     FROM user_friendships
-                    WHERE (user1_id = ? AND user2_id = ?)
-                       OR (user1_id = ? AND user2_id = ?)
-                    LIMIT 1
+                    WHERE user1_id = ? AND user2_id = ?
                 """
-                txn.execute(sql, (user1_id, user2_id, user2_id, user1_id))
+                txn.execute(sql, _normalize_pair(user1_id, user2_id))
                 row = txn.fetchone()
                 if row:
                     return {
@@ -165,8 +190,7 @@ class FriendsWorkerStore(SQLBaseStore):
             raise StoreError(400, "Cannot create friendship with self")
             
         # 确保user1_id < user2_id，保持一致性
-        if user1_id > user2_id:
-            user1_id, user2_id = user2_id, user1_id
+        user1_id, user2_id = _normalize_pair(user1_id, user2_id)
             
         def _create_friendship_txn(txn: LoggingTransaction) -> None:
             try:
@@ -186,6 +210,7 @@ class FriendsWorkerStore(SQLBaseStore):
                     VALUES (?, ?, 'active', ?)
                 """
                 txn.execute(sql, (user1_id, user2_id, created_ts))
+                self._invalidate_friend_status_txn(txn, user1_id, user2_id)
                 logger.info(f"Created friendship between {user1_id} and {user2_id}")
             except Exception as e:
                 logger.error(f"Failed to create friendship between {user1_id} and {user2_id}: {e}")
@@ -212,10 +237,10 @@ class FriendsWorkerStore(SQLBaseStore):
         def _remove_friendship_txn(txn: LoggingTransaction) -> bool:
             sql = """
                 DELETE FROM user_friendships
-                WHERE (user1_id = ? AND user2_id = ?)
-                   OR (user1_id = ? AND user2_id = ?)
+                WHERE user1_id = ? AND user2_id = ?
             """
-            txn.execute(sql, (user1_id, user2_id, user2_id, user1_id))
+            txn.execute(sql, _normalize_pair(user1_id, user2_id))
+            self._invalidate_friend_status_txn(txn, user1_id, user2_id)
             return txn.rowcount > 0
 
         return await self.db_pool.runInteraction(
@@ -349,6 +374,9 @@ class FriendsWorkerStore(SQLBaseStore):
                     request_id, sender_user_id, target_user_id, message, 
                     created_ts, created_ts
                 ))
+                self._invalidate_friend_status_txn(
+                    txn, sender_user_id, target_user_id
+                )
                 logger.info(f"Created friend request {request_id} from {sender_user_id} to {target_user_id}")
                 return request_id
             except StoreError:
@@ -376,17 +404,79 @@ class FriendsWorkerStore(SQLBaseStore):
             updated_ts: 更新时间戳
         """
         def _update_friend_request_status_txn(txn: LoggingTransaction) -> None:
+            row = self.db_pool.simple_select_one_txn(
+                txn,
+                table="friend_requests",
+                keyvalues={"request_id": request_id},
+                retcols=("sender_user_id", "target_user_id"),
+                allow_none=True,
+            )
+            if row is None:
+                return
+                
             sql = """
                 UPDATE friend_requests
                 SET status = ?, updated_ts = ?
                 WHERE request_id = ?
             """
             txn.execute(sql, (status, updated_ts, request_id))
+            self._invalidate_friend_status_txn(txn, row[0], row[1])
 
         await self.db_pool.runInteraction(
             "update_friend_request_status", _update_friend_request_status_txn
         )
 
+    async def accept_friend_request(
+        self,
+        request_id: str,
+        sender_user_id: str,
+        target_user_id: str,
+        updated_ts: int,
+    ) -> bool:
+        """接受好友请求：更新请求状态并创建好友关系，在同一个事务中完成
+        
+        只有仍处于待处理状态的请求才会被接受，并发的重复响应只有一个
+        会成功。好友关系已存在时插入会被忽略。
+        
+        Args:
+            request_id: 请求ID
+            sender_user_id: 发送者用户ID
+            target_user_id: 目标用户ID
+            updated_ts: 更新时间戳，同时作为好友关系的创建时间
+            
+        Returns:
+            请求是否被接受；请求已不是待处理状态时返回False
+        """
+        # 确保user1_id < user2_id，与 create_friendship 一致
+        user1_id, user2_id = _normalize_pair(sender_user_id, target_user_id)
+        
+        def _accept_friend_request_txn(txn: LoggingTransaction) -> bool:
+            txn.execute(
+                """
+                UPDATE friend_requests
+                SET status = 'accepted', updated_ts = ?
+                WHERE request_id = ? AND status = 'pending'
+                """,
+                (updated_ts, request_id),
+            )
+            if txn.rowcount == 0:
+                return False
+                
+            txn.execute(
+                """
+                INSERT INTO user_friendships (user1_id, user2_id, status, created_ts)
+                VALUES (?, ?, 'active', ?)
+                ON CONFLICT (user1_id, user2_id) DO NOTHING
+                """,
+                (user1_id, user2_id, updated_ts),
+            )
+            self._invalidate_friend_status_txn(txn, sender_user_id, target_user_id)
+            return True
+
+        return await self.db_pool.runInteraction(
+            "accept_friend_request", _accept_friend_request_txn
+        )
+
     async def get_friend_requests_sent_by_user(
         self, user_id: str, status: Optional[str] = None, limit: int = 50, offset: int = 0
     ) -> List[Dict[str, Any]]:
@@ -577,6 +667,59 @@ class FriendsWorkerStore(SQLBaseStore):
             logger.error(f"Database error in create_user_block: {e}")
             raise
 
+    async def block_user_atomic(
+        self, blocker_user_id: str, blocked_user_id: str, created_ts: int
+    ) -> bool:
+        """在同一个事务中删除好友关系并创建屏蔽关系
+        
+        DELETE 本身是幂等的，因此无需先查询好友关系；屏蔽关系已存在时
+        插入会被忽略。两条语句要么全部提交，要么全部回滚。
+        
+        Args:
+            blocker_user_id: 屏蔽者用户ID
+            blocked_user_id: 被屏蔽用户ID
+            created_ts: 创建时间戳
+            
+        Returns:
+            是否删除了已有的好友关系
+            
+        Raises:
+            StoreError: 参数无效时抛出
+        """
+        if not blocker_user_id or not blocked_user_id:
+            raise StoreError(400, "User IDs cannot be empty")
+            
+        if blocker_user_id == blocked_user_id:
+            raise StoreError(400, "Cannot block self")
+            
+        def _block_user_atomic_txn(txn: LoggingTransaction) -> bool:
+            txn.execute(
+                """
+                DELETE FROM user_friendships
+                WHERE user1_id = ? AND user2_id = ?
+                """,
+                _normalize_pair(blocker_user_id, blocked_user_id),
+            )
+            friendship_removed = txn.rowcount > 0
+            if friendship_removed:
+                self._invalidate_friend_status_txn(
+                    txn, blocker_user_id, blocked_user_id
+                )
+            
+            txn.execute(
+                """
+                INSERT INTO user_blocks (blocker_user_id, blocked_user_id, created_ts)
+                VALUES (?, ?, ?)
+                ON CONFLICT (blocker_user_id, blocked_user_id) DO NOTHING
+                """,
+                (blocker_user_id, blocked_user_id, created_ts),
+            )
+            return friendship_removed
+
+        return await self.db_pool.runInteraction(
+            "block_user_atomic", _block_user_atomic_txn
+        )
+
     async def remove_user_block(
         self, blocker_user_id: str, blocked_user_id: str
     ) -> bool:
@@ -657,6 +800,156 @@ class FriendsWorkerStore(SQLBaseStore):
             "is_user_blocked", _is_user_blocked_txn
         )
 
+    async def get_friend_precheck(
+        self, sender_user_id: str, target_user_id: str
+    ) -> Tuple[bool, bool, bool]:
+        """发送好友请求前的检查，一次查询完成
+        
+        Args:
+            sender_user_id: 发送者用户ID
+            target_user_id: 目标用户ID
+            
+        Returns:
+            (目标用户是否屏蔽了发送者, 是否已经是好友,
+             发送者最新的一条请求是否仍在等待处理)
+        """
+        def _get_friend_precheck_txn(
+            txn: LoggingTransaction,
+        ) -> Tuple[bool, bool, bool]:
+            sql = """
+                SELECT
+                    EXISTS (
+                        SELECT 1 FROM user_blocks
+                        WHERE blocker_user_id = ? AND blocked_user_id = ?
+                    ),
+                    EXISTS (
+                        SELECT 1 FROM user_friendships
+                        WHERE user1_id = ? AND user2_id = ?
+                    ),
+                    (
+                        SELECT status FROM friend_requests
+                        WHERE sender_user_id = ? AND target_user_id = ?
+                        ORDER BY created_ts DESC
+                        LIMIT 1
+                    )
+            """
+            txn.execute(
+                sql,
+                (
+                    target_user_id, sender_user_id,
+                    *_normalize_pair(sender_user_id, target_user_id),
+                    sender_user_id, target_user_id,
+                ),
+            )
+            is_blocked, is_friend, latest_status = txn.fetchone()
+            return bool(is_blocked), bool(is_friend), latest_status == "pending"
+
+        return await self.db_pool.runInteraction(
+            "get_friend_precheck", _get_friend_precheck_txn
+        )
+
+    @cached(max_entries=10000)
+    def get_friend_status(self, user_id: str, other_user_id: str) -> Tuple[bool, bool]:
+        """获取 (是否为好友, 是否有该用户发出的待处理请求)
+        
+        只作为 get_friendship_and_request_bulk 的缓存使用。搜索结果中大部分
+        用户都不是好友，这种否定结果同样会被缓存，直到好友关系或请求变化。
+        """
+        raise NotImplementedError()
+
+    @cachedList(cached_method_name="get_friend_status", list_name="other_user_ids")
+    async def get_friendship_and_request_bulk(
+        self, user_id: str, other_user_ids: Collection[str]
+    ) -> Mapping[str, Tuple[bool, bool]]:
+        """批量查询用户与一组用户之间的好友关系和待处理请求
+        
+        在同一个事务中用两条查询完成，取代逐个用户调用 get_friendship
+        和 get_friend_request。结果按用户对缓存在 get_friend_status 中。
+        
+        Args:
+            user_id: 用户ID
+            other_user_ids: 其他用户ID列表
+            
+        Returns:
+            其他用户ID到 (是否为好友, 是否有该用户发出的待处理请求) 的映射，
+            包含所有传入的用户
+        """
+        def _get_friendship_and_request_bulk_txn(
+            txn: LoggingTransaction,
+        ) -> Mapping[str, Tuple[bool, bool]]:
+            # 好友关系总是以 user1_id < user2_id 存储，按大小拆分后
+            # 每个用户只需在一侧查找
+            user2_clause, user2_args = make_in_list_sql_clause(
+                self.database_engine,
+                "user2_id",
+                [other_id for other_id in other_user_ids if other_id > user_id],
+            )
+            user1_clause, user1_args = make_in_list_sql_clause(
+                self.database_engine,
+                "user1_id",
+                [other_id for other_id in other_user_ids if other_id < user_id],
+            )
+            sql = f"""
+                SELECT user2_id FROM user_friendships
+                WHERE user1_id = ? AND {user2_clause}
+                UNION
+                SELECT user1_id FROM user_friendships
+                WHERE user2_id = ? AND {user1_clause}
+            """
+            txn.execute(sql, [user_id, *user2_args, user_id, *user1_args])
+            friend_ids = {row[0] for row in txn}
+            
+            target_clause, target_args = make_in_list_sql_clause(
+                self.database_engine, "target_user_id", other_user_ids
+            )
+            sql = f"""
+                SELECT target_user_id, status
+                FROM friend_requests
+                WHERE sender_user_id = ? AND {target_clause}
+                ORDER BY created_ts ASC
+            """
+            txn.execute(sql, [user_id, *target_args])
+            # 与 get_friend_request 一致，只看每个目标用户最新的一条请求
+            latest_status = {row[0]: row[1] for row in txn}
+            
+            return {
+                other_id: (
+                    other_id in friend_ids,
+                    latest_status.get(other_id) == "pending",
+                )
+                for other_id in other_user_ids
+            }
+
+        return await self.db_pool.runInteraction(
+            "get_friendship_and_request_bulk", _get_friendship_and_request_bulk_txn
+        )
+
+    async def get_profiles_batch(
+        self, user_ids: List[str]
+    ) -> Dict[str, Dict[str, Optional[str]]]:
+        """批量获取本地用户的个人资料
+        
+        Args:
+            user_ids: 本地用户ID列表
+            
+        Returns:
+            用户ID到 {"displayname", "avatar_url"} 的映射，没有资料的用户不包含在内
+        """
+        if not user_ids:
+            return {}
+            
+        rows = await self.db_pool.simple_select_many_batch(
+            table="profiles",
+            column="full_user_id",
+            iterable=user_ids,
+            retcols=("full_user_id", "displayname", "avatar_url"),
+            desc="get_profiles_batch",
+        )
+        return {
+            full_user_id: {"displayname": displayname, "avatar_url": avatar_url}
+            for full_user_id, displayname, avatar_url in rows
+        }
+
     def _generate_request_id(self) -> str:
         """生成唯一的请求ID"""
         return str(uuid.uuid4())
@@ -208,6 +208,9 @@ class TestFriendsHandler(unittest.TestCase):
         self.mock_hs.get_user_directory_handler.return_value = self.mock_user_directory_handler
         self.mock_hs.get_profile_handler.return_value = self.mock_profile_handler
         self.mock_hs.is_mine_server_name.return_value = True
+        self.mock_hs.config.friends.max_requests_per_hour = 10
+        self.mock_hs.config.friends.rate_limit_window = 3600
+        self.mock_hs.config.redis.redis_enabled = False
         
         self.handler = FriendsHandler(self.mock_hs)
 
@@ -260,9 +263,7 @@ class TestFriendsHandler(unittest.TestCase):
         mock_requester = MagicMock()
         mock_requester.user.to_string.return_value = "@sender:example.com"
         
-        self.mock_store.is_user_blocked.return_value = False
-        self.mock_store.get_friendship.return_value = None
-        self.mock_store.get_friend_request.return_value = None
+        self.mock_store.get_friend_precheck.return_value = (False, False, False)
         self.mock_store.create_friend_request.return_value = "request123"
         self.mock_clock.time_msec.return_value = 1640995200000
         
@@ -288,7 +289,7 @@ class TestFriendsHandler(unittest.TestCase):
         mock_requester = MagicMock()
         mock_requester.user.to_string.return_value = "@sender:example.com"
         
-        self.mock_store.is_user_blocked.return_value = True
+        self.mock_store.get_friend_precheck.return_value = (True, False, False)
         
         with self.assertRaises(SynapseError):
             asyncio.run(self.handler.send_friend_request(
@@ -308,6 +309,7 @@ class TestFriendsHandler(unittest.TestCase):
             "created_ts": 1640995200000,
             "updated_ts": 1640995200000
         }
+        self.mock_store.accept_friend_request.return_value = True
         self.mock_clock.time_msec.return_value = 1640995200000
         
         result = asyncio.run(self.handler.respond_to_friend_request(
@@ -367,10 +369,11 @@ class TestFriendsHandler(unittest.TestCase):
             }
         ]
         
-        self.mock_profile_handler.get_profile.side_effect = [
-            {"displayname": "Friend One", "avatar_url": "mxc://example.com/avatar1"},
-            {"displayname": "Friend Two", "avatar_url": "mxc://example.com/avatar2"}
-        ]
+        # Local users' profiles are fetched in one batch from the store
+        self.mock_store.get_profiles_batch.return_value = {
+            "@friend1:example.com": {"displayname": "Friend One", "avatar_url": "mxc://example.com/avatar1"},
+            "@friend2:example.com": {"displayname": "Friend Two", "avatar_url": "mxc://example.com/avatar2"},
+        }
         
         result = asyncio.run(self.handler.get_friends_list(mock_requester))
         
@@ -416,7 +419,7 @@ class TestFriendsHandler(unittest.TestCase):
         mock_requester = MagicMock()
         mock_requester.user.to_string.return_value = "@user:example.com"
         
-        self.mock_store.get_friendship.return_value = None
+        self.mock_store.block_user_atomic.return_value = False
         
         result = asyncio.run(self.handler.block_user(
             mock_requester, "@target:example.com"
@@ -436,5 +439,132 @@ class TestFriendsHandler(unittest.TestCase):
             ))
 
 
+
+class TestFriendsRateLimit(unittest.TestCase):
+    """Test friend request rate limiting"""
+
+    WINDOW = 3600
+
+    def setUp(self):
+        """Set up test fixtures"""
+        self.mock_hs = MagicMock()
+        self.mock_hs.config.friends.max_requests_per_hour = 4
+        self.mock_hs.config.friends.rate_limit_window = self.WINDOW
+        self.mock_hs.config.redis.redis_enabled = False
+        
+        self.handler = FriendsHandler(self.mock_hs)
+        self.user_id = "@user:example.com"
+
+    def _at(self, window_index, offset):
+        """Return a timestamp `offset` seconds into the given window"""
+        return float(window_index * self.WINDOW + offset)
+
+    def test_memory_rejects_at_max_requests(self):
+        """Test that the request reaching max_requests_per_hour is rejected"""
+        for i in range(4):
+            self.handler._check_rate_limit_memory(self.user_id, self._at(10, i))
+            
+        with self.assertRaises(SynapseError) as cm:
+            self.handler._check_rate_limit_memory(self.user_id, self._at(10, 5))
+        self.assertEqual(cm.exception.code, 429)
+        
+        # The rejected request is not counted
+        self.assertEqual(
+            self.handler._rate_limit_cache.get(self.user_id), (0, 4, 10)
+        )
+
+    def test_memory_weights_previous_window(self):
+        """Test the previous window's count is weighted across the boundary"""
+        for i in range(4):
+            self.handler._check_rate_limit_memory(
+                self.user_id, self._at(10, self.WINDOW - 10 + i)
+            )
+            
+        # Right after the boundary the previous window still counts in full
+        with self.assertRaises(SynapseError):
+            self.handler._check_rate_limit_memory(self.user_id, self._at(11, 0))
+            
+        # Half way through, it counts for half: 4 * 0.5 = 2 requests
+        self.handler._check_rate_limit_memory(self.user_id, self._at(11, 1800))
+        self.handler._check_rate_limit_memory(self.user_id, self._at(11, 1800))
+        with self.assertRaises(SynapseError):
+            self.handler._check_rate_limit_memory(self.user_id, self._at(11, 1800))
+
+    def test_memory_forgets_older_windows(self):
+        """Test that counts older than the previous window are dropped"""
+        for i in range(4):
+            self.handler._check_rate_limit_memory(self.user_id, self._at(10, i))
+            
+        # Window 11 is skipped entirely, so window 10 no longer counts
+        for i in range(4):
+            self.handler._check_rate_limit_memory(self.user_id, self._at(12, i))
+        self.assertEqual(
+            self.handler._rate_limit_cache.get(self.user_id), (0, 4, 12)
+        )
+
+    def test_memory_evicts_least_recent_user(self):
+        """Test that the least recently limited user is evicted when full"""
+        with patch("synapse.handlers.friends.RATE_LIMIT_MAX_USERS", 10):
+            handler = FriendsHandler(self.mock_hs)
+        max_size = handler._rate_limit_cache.max_size
+        self.assertGreater(max_size, 0)
+        
+        for i in range(4):
+            handler._check_rate_limit_memory(self.user_id, self._at(10, i))
+        with self.assertRaises(SynapseError):
+            handler._check_rate_limit_memory(self.user_id, self._at(10, 5))
+            
+        # Fill the cache with other users, pushing the first one out
+        for i in range(max_size):
+            handler._check_rate_limit_memory(f"@other{i}:example.com", self._at(10, 6))
+            
+        self.assertEqual(len(handler._rate_limit_cache), max_size)
+        self.assertIsNone(handler._rate_limit_cache.get(self.user_id))
+        handler._check_rate_limit_memory(self.user_id, self._at(10, 7))
+
+    def _setup_redis(self, current_count):
+        """Use a mock Redis client whose window already holds `current_count`"""
+        redis_client = MagicMock()
+        pipeline = redis_client.pipeline.return_value
+        pipeline.execute = AsyncMock(return_value=[0, current_count, 1, True])
+        redis_client.zrem = AsyncMock()
+        
+        self.handler._redis_client = redis_client
+        self.handler._use_redis_rate_limit = True
+        return redis_client, pipeline
+
+    def test_redis_under_limit(self):
+        """Test that a Redis request under the limit is kept"""
+        redis_client, pipeline = self._setup_redis(current_count=3)
+        
+        asyncio.run(self.handler._check_rate_limit_redis(self.user_id, 1000.0))
+        
+        redis_client.pipeline.assert_called_once_with(transaction=True)
+        pipeline.zadd.assert_called_once()
+        redis_client.zrem.assert_not_called()
+
+    def test_redis_rejected_request_is_removed(self):
+        """Test that a rejected Redis request is removed again with zrem"""
+        redis_client, pipeline = self._setup_redis(current_count=4)
+        
+        with self.assertRaises(SynapseError) as cm:
+            asyncio.run(self.handler._check_rate_limit_redis(self.user_id, 1000.0))
+        self.assertEqual(cm.exception.code, 429)
+        
+        redis_key, members = pipeline.zadd.call_args[0]
+        self.assertEqual(redis_key, f"friend_request_rate_limit:{self.user_id}")
+        (member,) = members
+        redis_client.zrem.assert_awaited_once_with(redis_key, member)
+
+    def test_redis_failure_falls_back_to_memory(self):
+        """Test that a Redis failure falls back to the in-memory limiter"""
+        redis_client, pipeline = self._setup_redis(current_count=0)
+        pipeline.execute.side_effect = ConnectionError("redis down")
+        
+        asyncio.run(self.handler._check_rate_limit_redis(self.user_id, 1000.0))
+        
+        self.assertIsNotNone(self.handler._rate_limit_cache.get(self.user_id))
+        redis_client.zrem.assert_not_called()
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
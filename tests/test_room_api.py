@@ -0,0 +1,184 @@
+# Copyright 2024 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+import asyncio
+
+from synapse.api.room import RoomAPI
+
+
+class TestRoomAPIBatch(unittest.TestCase):
+    """Test RoomAPI.handle_batch"""
+
+    def setUp(self):
+        """Set up test fixtures"""
+        self.mock_hs = MagicMock()
+        self.mock_auth_handler = MagicMock()
+        self.mock_room_handler = MagicMock()
+
+        self.mock_hs.get_auth_handler.return_value = self.mock_auth_handler
+        self.mock_hs.get_room_handler.return_value = self.mock_room_handler
+
+        self.mock_auth_handler.get_user_by_access_token = AsyncMock(
+            return_value={"user_id": "@alice:example.com"}
+        )
+        self.mock_room_handler.join_room = AsyncMock(
+            return_value={"success": True, "room_id": "!room1:example.com"}
+        )
+        self.mock_room_handler.leave_room = AsyncMock(return_value=True)
+        self.mock_room_handler.invite_user = AsyncMock(
+            return_value={"room_id": "!room1:example.com"}
+        )
+        self.mock_room_handler.invite_users_bulk = AsyncMock(return_value={})
+
+        self.api = RoomAPI(self.mock_hs)
+
+    def _batch(self, ops):
+        body, status = asyncio.run(self.api.handle_batch("token", ops))
+        self.assertEqual(status, 200)
+        return body["responses"]
+
+    @staticmethod
+    def _invite(room_id, invitee_id):
+        return {
+            "op": "invite",
+            "params": {"room_id": room_id, "request_data": {"user_id": invitee_id}},
+        }
+
+    def test_invalid_token(self):
+        """Test that an invalid token rejects the whole batch"""
+        self.mock_auth_handler.get_user_by_access_token.return_value = None
+
+        body, status = asyncio.run(self.api.handle_batch("bad", [
+            {"op": "leave", "params": {"room_id": "!room1:example.com"}},
+        ]))
+
+        self.assertEqual(status, 401)
+        self.assertEqual(body["errcode"], "M_UNKNOWN_TOKEN")
+        self.mock_room_handler.leave_room.assert_not_called()
+
+    def test_mixed_ops(self):
+        """Test that responses line up with a mix of ops"""
+        responses = self._batch([
+            {"op": "join", "params": {"room_id": "!room1:example.com"}},
+            self._invite("!room2:example.com", "@bob:example.com"),
+            {"op": "leave", "params": {"room_id": "!room3:example.com"}},
+        ])
+
+        self.assertEqual(len(responses), 3)
+        self.assertEqual(responses[0]["status"], 200)
+        self.assertEqual(responses[0]["body"], {"room_id": "!room1:example.com"})
+        self.assertEqual(responses[1]["status"], 200)
+        self.assertEqual(responses[2]["status"], 200)
+
+        # The token is only checked once for the whole batch
+        self.mock_auth_handler.get_user_by_access_token.assert_called_once_with("token")
+        self.mock_room_handler.leave_room.assert_called_once_with(
+            user_id="@alice:example.com", room_id="!room3:example.com"
+        )
+
+    def test_per_op_errors(self):
+        """Test that a failing op only affects its own response"""
+        self.mock_room_handler.join_room.side_effect = RuntimeError("boom")
+        self.mock_room_handler.leave_room.return_value = False
+
+        responses = self._batch([
+            {"op": "unknown", "params": {}},
+            {"op": "leave", "params": {}},
+            {"op": "join", "params": {"room_id": "!room1:example.com"}},
+            {"op": "leave", "params": {"room_id": "!room1:example.com"}},
+            self._invite("!room2:example.com", "@bob:example.com"),
+        ])
+
+        self.assertEqual(responses[0]["status"], 400)
+        self.assertEqual(responses[0]["body"]["errcode"], "M_UNRECOGNIZED")
+        # Missing room_id
+        self.assertEqual(responses[1]["status"], 400)
+        self.assertEqual(responses[1]["body"]["errcode"], "M_INVALID_PARAM")
+        self.assertEqual(responses[2]["status"], 500)
+        self.assertEqual(responses[2]["body"]["errcode"], "M_UNKNOWN")
+        self.assertEqual(responses[3]["status"], 403)
+        self.assertEqual(responses[3]["body"]["errcode"], "M_FORBIDDEN")
+        self.assertEqual(responses[4]["status"], 200)
+
+    def test_single_invite_path(self):
+        """Test that a lone invite for a room uses invite_user"""
+        responses = self._batch([
+            self._invite("!room1:example.com", "@bob:example.com"),
+            self._invite("!room2:example.com", "@carol:example.com"),
+        ])
+
+        self.assertEqual([r["status"] for r in responses], [200, 200])
+        self.assertEqual(self.mock_room_handler.invite_user.call_count, 2)
+        self.mock_room_handler.invite_users_bulk.assert_not_called()
+
+    def test_bulk_invite_path(self):
+        """Test that several invites for one room use a single bulk call"""
+        self.mock_room_handler.invite_users_bulk.return_value = {
+            "@carol:example.com": ValueError(
+                "User @carol:example.com is already in room !room1:example.com"
+            ),
+        }
+
+        responses = self._batch([
+            self._invite("!room1:example.com", "@bob:example.com"),
+            self._invite("!room1:example.com", "@carol:example.com"),
+        ])
+
+        self.mock_room_handler.invite_users_bulk.assert_called_once_with(
+            inviter_id="@alice:example.com",
+            invitee_ids=["@bob:example.com", "@carol:example.com"],
+            room_id="!room1:example.com",
+        )
+        self.mock_room_handler.invite_user.assert_not_called()
+        self.assertEqual(responses[0]["status"], 200)
+        self.assertEqual(responses[1]["status"], 404)
+        self.assertEqual(responses[1]["body"]["errcode"], "M_NOT_FOUND")
+
+    def test_invite_errors_match_across_paths(self):
+        """Test that single and bulk invites map the same error the same way"""
+        error = ValueError("User @alice:example.com cannot invite to room")
+        self.mock_room_handler.invite_user.side_effect = error
+        self.mock_room_handler.invite_users_bulk.side_effect = error
+
+        single = self._batch([
+            self._invite("!room1:example.com", "@bob:example.com"),
+        ])
+        bulk = self._batch([
+            self._invite("!room1:example.com", "@bob:example.com"),
+            self._invite("!room1:example.com", "@carol:example.com"),
+        ])
+
+        self.assertEqual(single[0]["status"], 404)
+        self.assertEqual(single[0]["body"]["errcode"], "M_NOT_FOUND")
+        for response in bulk:
+            self.assertEqual(response["status"], single[0]["status"])
+            self.assertEqual(response["body"]["errcode"], single[0]["body"]["errcode"])
+
+    def test_bulk_invite_unexpected_error(self):
+        """Test that an unexpected bulk failure only fails its invites"""
+        self.mock_room_handler.invite_users_bulk.side_effect = RuntimeError("boom")
+
+        responses = self._batch([
+            self._invite("!room1:example.com", "@bob:example.com"),
+            self._invite("!room1:example.com", "@carol:example.com"),
+            {"op": "leave", "params": {"room_id": "!room2:example.com"}},
+        ])
+
+        self.assertEqual([r["status"] for r in responses], [500, 500, 200])
+
+
+if __name__ == '__main__':
+    unittest.main()
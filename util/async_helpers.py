@@ -342,6 +342,41 @@ async def yieldable_gather_results_delaying_cancellation(
         raise dfe.subFailure.value from None
 
 
+async def concurrently_gather_results(
+    func: Callable[[T], Awaitable[R]],
+    args: Iterable[T],
+    limit: int,
+) -> List[R]:
+    """Executes the function with each argument concurrently, with at most
+    `limit` invocations in flight at once, and gathers the results.
+
+    This is `concurrently_execute`, but keeping the return values. It is
+    useful for fan-outs that may be large (e.g. one call per device or per
+    event), where `yieldable_gather_results` would start every call at once.
+
+    Args:
+        func: Function to execute, should return a coroutine or Deferred.
+        args: Arguments to pass to func, one per invocation.
+        limit: Maximum number of concurrent executions.
+
+    Returns:
+        A list containing the results of the function, in the same order as
+        `args`.
+
+    Raises:
+        The first exception raised by any invocation of func.
+    """
+    items = list(args)
+    results: List[Optional[R]] = [None] * len(items)
+
+    async def _run(item: Tuple[int, T]) -> None:
+        index, value = item
+        results[index] = await func(value)
+
+    await concurrently_execute(_run, enumerate(items), limit)
+    return cast(List[R], results)
+
+
 T1 = TypeVar("T1")
 T2 = TypeVar("T2")
 T3 = TypeVar("T3")